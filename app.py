@@ -1,5 +1,5 @@
 # app.py
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, joinedload
@@ -8,13 +8,34 @@ import os
 from dotenv import load_dotenv
 from models import (
     Base, User, Beneficiary, Asset, AssetLivret, AssetImmo, AssetPortfolio, PortfolioLine,
-    AssetOther, UserIncome, UserExpense, PortfolioProduct, ImmoLoan, ImmoExpense,
-    ProduitInvest, ProduitHisto, ProduitIndicateurs, ProduitIntraday, BrokerLink, AssetEvent, # ✅ ajout
+    AssetOther, UserIncome, PortfolioProduct, ImmoLoan, ImmoExpense,
+    ProduitInvest, ProduitHisto, ProduitIndicateurs, ProduitIntraday, ProduitIntradayBar, BrokerLink, AssetEvent, # ✅ ajout
+    ProjectionSnapshot, NetWorthHistory, NetWorthHistoryState, PortfolioPerformance,
 )
 from werkzeug.exceptions import HTTPException
 import re
 from utils import amortization_monthly_payment
-from datetime import datetime, timedelta
+from projection_engine import (
+    SCENARIOS, RATE_KEYS, STACK_KEYS, RESOLUTIONS, ENCODINGS, DEFAULT_MONTHS, first_of_month, months_between,
+    safe_float, is_default_params, state_version, load_state, simulate, simulate_incremental, projection_payload,
+    loan_milestones, goal_seek_dca, goal_seek_rate, round_list, period_bounds, resample_flow,
+)
+from immo_risk import simulate_immo_risk, percentile_bands
+from product_returns import RETURN_MODES, product_stats_for, apply_product_returns
+from networth_history import (
+    HISTORY_RESOLUTIONS, HISTORY_MAX_YEARS, ledger_version, load_ledger, reconstruct, month_ends, stored_cash,
+)
+from performance_engine import asset_versions, portfolio_performance
+from intraday_rollup import TIER_NAMES as INTRADAY_TIERS, live_bars, live_from, pick_tier
+from histo_series import (
+    INTERVALS as HISTO_INTERVALS, OHLCV, STORE_FIELDS, load_daily, load_many, from_store, align, aggregate_sql,
+    downsample, columnar, epoch_seconds
+)
+from price_store import get_store
+from lot_engine import LOT_METHODS, update_lots, latest_closes, lots_summary
+from loan_engine import PREPAYMENT_MODES, SCHEDULE_COLUMNS, loan_params, prepayment_params, property_schedules, schedule_summary
+import numpy as np
+from datetime import datetime, timedelta, timezone
 import traceback
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
@@ -28,6 +49,8 @@ from cryptography.fernet import Fernet, InvalidToken
 from typing import Union
 import hashlib
 from decimal import Decimal
+import time
+import gzip
 
 # Configure root logger
 logging.basicConfig(
@@ -1857,8 +1880,43 @@ def delete_produit(pid):
 def get_produit_histo(pid):
     session = Session()
     try:
-        dfrom = request.args.get("from")  # YYYY-MM-DD
-        dto   = request.args.get("to")    # YYYY-MM-DD
+        # bornes typées : filtre sur la colonne brute, seules les partitions annuelles concernées sont lues
+        dfrom = parse_date(request.args.get("from"))  # YYYY-MM-DD
+        dto   = parse_date(request.args.get("to"))    # YYYY-MM-DD
+        if (request.args.get("from") and not dfrom) or (request.args.get("to") and not dto):
+            return jsonify({"ok": False, "error": "from/to invalides (YYYY-MM-DD)"}), 400
+
+        # graphiques : agrégation calendaire (interval=week|month) et/ou LTTB (max_points),
+        # réponse en colonnes parallèles ; sans paramètre, liste d'objets historique
+        interval = request.args.get("interval")
+        max_points = request.args.get("max_points")
+        fields = tuple(f.strip() for f in request.args.get("fields", "").split(",") if f.strip()) or OHLCV
+        if interval or max_points or request.args.get("fields") or request.args.get("format") == "columns":
+            interval = interval or "day"
+            if interval not in HISTO_INTERVALS:
+                return jsonify({"ok": False, "error": f"interval invalide ({', '.join(HISTO_INTERVALS)})"}), 400
+            if not set(fields) <= set(OHLCV):
+                return jsonify({"ok": False, "error": f"fields invalides ({', '.join(OHLCV)})"}), 400
+            try:
+                max_points = int(max_points) if max_points else None
+            except ValueError:
+                max_points = 0
+            if max_points is not None and max_points < 3:
+                return jsonify({"ok": False, "error": "max_points doit être un entier >= 3"}), 400
+            # clôtures / volumes seuls : tranches du magasin mappé, sans aller-retour Postgres
+            store = get_store(Session) if interval == "day" and set(fields) <= set(STORE_FIELDS) else None
+            series = store.series(pid, dfrom, dto) if store is not None else None
+            if series is None:
+                series = (load_daily(session, pid, dfrom, dto) if interval == "day"
+                          else aggregate_sql(session, pid, interval, dfrom, dto))
+            n_source = len(series["day"])
+            if max_points:
+                series = downsample(series, max_points)
+            return jsonify({"ok": True, "produit_id": pid, "interval": interval,
+                            "points": len(series["day"]), "source_points": n_source,
+                            "downsampled": len(series["day"]) < n_source,
+                            **columnar(series, fields)}), 200
+
         q = session.query(ProduitHisto).filter(ProduitHisto.produit_id == pid)
         if dfrom:
             q = q.filter(ProduitHisto.date >= dfrom)
@@ -1876,6 +1934,82 @@ def get_produit_histo(pid):
     finally:
         session.close()
 
+HISTO_BATCH_MAX_IDS = int(os.getenv("HISTO_BATCH_MAX_IDS", "100"))
+
+def _list_arg(payload, key):
+    """Liste depuis le JSON (liste ou 'a,b') ou la query string (?k=a,b ou ?k=a&k=b)."""
+    val = payload.get(key) if payload else None
+    if val is None:
+        val = ",".join(request.args.getlist(key))
+    if isinstance(val, str):
+        val = val.split(",")
+    return [str(v).strip() for v in val if str(v).strip()]
+
+@app.route("/api/produits/histo/batch", methods=["GET", "POST"])
+@jwt_required()
+def get_produits_histo_batch():
+    """
+    Historique de plusieurs produits en une requête : ids et/ou isins, from / to,
+    fields (défaut close), align=1 pour un index de dates commun (report de la
+    dernière valeur). Réponse en colonnes parallèles par produit.
+    """
+    payload = (request.get_json(silent=True) or {}) if request.method == "POST" else {}
+
+    def arg(key):
+        return payload.get(key) if key in payload else request.args.get(key)
+
+    try:
+        ids = [int(v) for v in _list_arg(payload, "ids")]
+    except ValueError:
+        return jsonify({"ok": False, "error": "ids doit être une liste d'entiers"}), 400
+    isins = [v.upper() for v in _list_arg(payload, "isins")]
+    fields = tuple(_list_arg(payload, "fields")) or ("close",)
+    if not set(fields) <= set(OHLCV):
+        return jsonify({"ok": False, "error": f"fields invalides ({', '.join(OHLCV)})"}), 400
+    dfrom, dto = parse_date(arg("from")), parse_date(arg("to"))
+    if (arg("from") and not dfrom) or (arg("to") and not dto):
+        return jsonify({"ok": False, "error": "from/to invalides (YYYY-MM-DD)"}), 400
+    if not ids and not isins:
+        return jsonify({"ok": False, "error": "ids ou isins requis"}), 400
+    if len(ids) + len(isins) > HISTO_BATCH_MAX_IDS:
+        return jsonify({"ok": False, "error": f"{HISTO_BATCH_MAX_IDS} produits maximum"}), 400
+    aligned = str(arg("align") or "").lower() in ("1", "true", "yes")
+
+    session = Session()
+    try:
+        q = session.query(ProduitInvest.id, ProduitInvest.isin)
+        q = q.filter((ProduitInvest.id.in_(ids)) | (func.upper(ProduitInvest.isin).in_(isins)))
+        known = {pid: isin for pid, isin in q.all()}
+        missing = [v for v in ids if v not in known]
+        found_isins = {(i or "").upper() for i in known.values()}
+        missing += [v for v in isins if v not in found_isins]
+
+        store = get_store(Session) if set(fields) <= set(STORE_FIELDS) else None
+        if store is not None:
+            by_pid, rest = from_store(store, list(known), dfrom, dto)
+            if rest:
+                by_pid.update(load_many(session, rest, dfrom, dto, fields))
+        else:
+            by_pid = load_many(session, list(known), dfrom, dto, fields)
+        if aligned:
+            index, series = align(by_pid, fields)
+            produits = {str(pid): {"isin": known[pid], **columnar(series[pid], fields, with_time=False)}
+                        for pid in sorted(series)}
+            body = {"t": epoch_seconds(index)}
+        else:
+            produits = {str(pid): {"isin": known[pid], **columnar(by_pid[pid], fields)} for pid in sorted(by_pid)}
+            body = {}
+        return jsonify({"ok": True, "fields": list(fields), "aligned": aligned,
+                        **body, "produits": produits,
+                        "empty": sorted(str(pid) for pid in known if pid not in by_pid),
+                        "missing": missing}), 200
+    except Exception as e:
+        session.rollback()
+        app.logger.exception("❌ histo batch failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        session.close()
+
 
 @app.route("/api/produits/<int:pid>/indicateurs", methods=["GET"])
 @jwt_required()
@@ -1902,22 +2036,86 @@ def get_produit_indicateurs(pid):
         session.close()
 
 
+INTRADAY_MAX_POINTS = int(os.getenv("INTRADAY_MAX_POINTS", "5000"))
+
+def _parse_ts(val):
+    """ISO date / datetime -> datetime UTC (naïf = UTC), None si absent ou invalide."""
+    if not val:
+        return None
+    try:
+        ts = datetime.fromisoformat(str(val).strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts.astimezone(timezone.utc)
+
 @app.route("/api/produits/<int:pid>/intraday", methods=["GET"])
 @jwt_required()
 def get_produit_intraday(pid):
+    """
+    Sans fenêtre : derniers ticks bruts (limit, défaut 500), du plus récent au plus ancien.
+    Avec from (et to, défaut maintenant) : barres du palier adapté à la fenêtre
+    (brut, 1m, 1h ou 1d, cf. intraday_rollup.pick_tier ; forçable par tier=),
+    ordre chronologique ; palier servi dans l'en-tête X-Intraday-Tier.
+    Au-delà du dernier passage d'agrégation, les barres sont calculées à la volée
+    depuis les ticks bruts. Au plus `limit` points (défaut INTRADAY_MAX_POINTS) :
+    X-Intraday-Truncated = 1 si la fenêtre en contient davantage (les plus récents manquent).
+    """
     session = Session()
     try:
         limit = int(request.args.get("limit", 500))
-        rows = (session.query(ProduitIntraday)
-                .filter(ProduitIntraday.produit_id == pid)
-                .order_by(ProduitIntraday.ts.desc())
-                .limit(limit)
-                .all())
-        return jsonify([{
-            "ts": r.ts.isoformat(),
-            "price": float(r.price) if r.price is not None else None,
-            "volume": int(r.volume) if r.volume is not None else None
-        } for r in rows]), 200
+        start = _parse_ts(request.args.get("from"))
+        if start is None:
+            rows = (session.query(ProduitIntraday)
+                    .filter(ProduitIntraday.produit_id == pid)
+                    .order_by(ProduitIntraday.ts.desc())
+                    .limit(limit)
+                    .all())
+            return jsonify([{
+                "ts": r.ts.isoformat(),
+                "price": float(r.price) if r.price is not None else None,
+                "volume": int(r.volume) if r.volume is not None else None
+            } for r in rows]), 200
+
+        end = _parse_ts(request.args.get("to")) or datetime.now(timezone.utc)
+        if end <= start:
+            return jsonify({"ok": False, "error": "to must be after from"}), 400
+        tier = request.args.get("tier") or pick_tier(start, end)
+        if tier not in INTRADAY_TIERS:
+            return jsonify({"ok": False, "error": f"tier must be one of {', '.join(INTRADAY_TIERS)}"}), 400
+        limit = min(limit, INTRADAY_MAX_POINTS) if "limit" in request.args else INTRADAY_MAX_POINTS
+
+        if tier == "raw":
+            rows = (session.query(ProduitIntraday.ts, ProduitIntraday.price, ProduitIntraday.volume)
+                    .filter(ProduitIntraday.produit_id == pid,
+                            ProduitIntraday.ts >= start, ProduitIntraday.ts < end)
+                    .order_by(ProduitIntraday.ts.asc())
+                    .limit(limit + 1).all())
+            out = [{"ts": ts.isoformat(),
+                    "price": float(price) if price is not None else None,
+                    "volume": int(volume) if volume is not None else None} for ts, price, volume in rows]
+        else:
+            # barres agrégées jusqu'au dernier passage, puis fin de fenêtre depuis les ticks bruts
+            split = min(live_from(session, tier, start), end)
+            rows = (session.query(ProduitIntradayBar)
+                    .filter(ProduitIntradayBar.produit_id == pid,
+                            ProduitIntradayBar.tier == tier,
+                            ProduitIntradayBar.ts >= start, ProduitIntradayBar.ts < split)
+                    .order_by(ProduitIntradayBar.ts.asc())
+                    .limit(limit + 1).all())
+            if len(rows) <= limit and split < end:
+                rows += live_bars(session, pid, tier, split, end, limit + 1 - len(rows))
+            out = [{
+                "ts": r.ts.isoformat(),
+                "price": float(r.close) if r.close is not None else None,
+                "open": float(r.open) if r.open is not None else None,
+                "high": float(r.high) if r.high is not None else None,
+                "low": float(r.low) if r.low is not None else None,
+                "volume": int(r.volume) if r.volume is not None else None,
+            } for r in rows]
+        resp = jsonify(out[:limit])
+        resp.headers["X-Intraday-Tier"] = tier
+        resp.headers["X-Intraday-Truncated"] = "1" if len(out) > limit else "0"
+        return resp, 200
     finally:
         session.close()
 
@@ -2524,56 +2722,150 @@ def delete_event(event_id):
     finally:
         session.close()
 
-from math import isfinite
-
-def _first_of_month(d: datetime.date) -> datetime.date:
-    return datetime(d.year, d.month, 1).date()
-
-def _add_months(d: datetime.date, k: int) -> datetime.date:
-    y = d.year + (d.month - 1 + k) // 12
-    m = ((d.month - 1 + k) % 12) + 1
-    return datetime(y, m, 1).date()
-
-def _months_between(a: datetime.date, b: datetime.date) -> int:
-    # nombre de mois entiers (b - a) en prenant 1er du mois
-    a1, b1 = _first_of_month(a), _first_of_month(b)
-    return (b1.year - a1.year) * 12 + (b1.month - a1.month)
-
-def _freq_to_monthly(freq: str | None) -> float:
-    if not freq:
-        return 0.0
-    f = str(freq).strip().lower()
-    if f in ("mensuel", "monthly"):
-        return 1.0
-    if f in ("trimestriel", "quarterly"):
-        return 1.0 / 3.0
-    if f in ("annuel", "annual", "yearly"):
-        return 1.0 / 12.0
-    return 0.0
-
-def _apy_to_monthly(apy: float) -> float:
+# ---------------------------------------------------------
+# Échéanciers de prêts (moteur : loan_engine.py)
+# ---------------------------------------------------------
+def _property_loan_schedules(s, uid: int, im: AssetImmo, mode: str, planned: bool) -> dict:
+    """Échéanciers de tous les prêts du bien `im`, remboursements anticipés posted (+ planned) inclus."""
+    statuses = ["posted", "planned"] if planned else ["posted"]
+    events = (s.query(AssetEvent)
+                .filter(AssetEvent.user_id == uid,
+                        AssetEvent.asset_id == im.asset_id,
+                        AssetEvent.kind == "loan_prepayment",
+                        AssetEvent.status.in_(statuses))
+                .order_by(AssetEvent.id).all())
+    return property_schedules([loan_params(ln) for ln in im.loans or []],
+                              [prepayment_params(ev) for ev in events], mode)
+
+def _loan_schedule_args():
+    mode = (request.args.get("mode") or "duration").strip().lower()
+    planned = (request.args.get("planned") or "1").lower() in ("1", "true", "yes")
+    return mode, planned
+
+def _serialize_schedule(ln: ImmoLoan, sched: dict, mode: str) -> dict:
+    cols = sched["with"]
+    return {
+        "loan_id": ln.id,
+        "mode": mode,
+        "start": sched["start"].isoformat(),
+        "monthly_payment": loan_params(ln)["payment"],
+        "columns": {
+            "month": list(range(1, len(sched["dates"]) + 1)),
+            "date": [d.isoformat() for d in sched["dates"]],
+            **{k: round_list(cols[k]) for k in SCHEDULE_COLUMNS},
+        },
+        "summary": schedule_summary(sched),
+    }
+
+@app.route("/api/loans/<int:loan_id>/schedule", methods=["GET"])
+@jwt_required()
+def loan_schedule(loan_id):
+    """
+    Tableau d'amortissement d'un ImmoLoan, en colonnes (month, date, payment,
+    interest, principal, prepayment, remaining) + résumé (fin, intérêts, économies).
+    Query params :
+      - mode = duration (défaut, mensualité inchangée) | payment (durée inchangée)
+      - planned = 1 (défaut) | 0 -> inclure les remboursements anticipés planifiés
+    Tous les prêts du bien sont calculés ensemble puis mis en cache.
+    """
+    uid = int(get_jwt_identity())
+    mode, planned = _loan_schedule_args()
+    if mode not in PREPAYMENT_MODES:
+        return jsonify({"ok": False, "error": f"mode must be one of {', '.join(PREPAYMENT_MODES)}"}), 400
+
+    s = Session()
     try:
-        return (1.0 + float(apy)) ** (1.0 / 12.0) - 1.0
-    except Exception:
-        return 0.0
+        row = (s.query(ImmoLoan, AssetImmo)
+                 .join(AssetImmo, ImmoLoan.immo_id == AssetImmo.id)
+                 .join(Asset, AssetImmo.asset_id == Asset.id)
+                 .filter(ImmoLoan.id == loan_id, Asset.user_id == uid)
+                 .first())
+        if not row:
+            return jsonify({"ok": False, "error": "loan not found"}), 404
+        ln, im = row
+        sched = _property_loan_schedules(s, uid, im, mode, planned).get(ln.id)
+        if not sched:
+            return jsonify({"ok": False, "error": "loan needs loan_duration_months and loan_start_date"}), 400
+        return jsonify({"ok": True, "asset_id": im.asset_id, **_serialize_schedule(ln, sched, mode)}), 200
 
-def _safe_float(x, default=0.0):
-    v = parse_float(x)
-    return v if (v is not None and isfinite(v)) else default
+    except Exception as e:
+        app.logger.exception("❌ /api/loans/<id>/schedule failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        s.close()
+
+@app.route("/api/assets/<int:asset_id>/loans/schedule", methods=["GET"])
+@jwt_required()
+def asset_loans_schedule(asset_id):
+    """Échéanciers de tous les prêts d'un bien immobilier (mêmes paramètres que /api/loans/<id>/schedule)."""
+    uid = int(get_jwt_identity())
+    mode, planned = _loan_schedule_args()
+    if mode not in PREPAYMENT_MODES:
+        return jsonify({"ok": False, "error": f"mode must be one of {', '.join(PREPAYMENT_MODES)}"}), 400
 
-def _loan_monthly_payment(P: float, r_apy: float, n_months: int) -> float:
-    """Renvoie mensualité (hors assurance). Utilise utils.amortization_monthly_payment si possible."""
-    if P is None or n_months is None or n_months <= 0:
-        return 0.0
+    s = Session()
     try:
-        if r_apy is None:
-            return amortization_monthly_payment(P, 0.0, n_months)
-        return amortization_monthly_payment(P, r_apy, n_months)
-    except Exception:
-        r = (r_apy or 0.0) / 12.0
-        if abs(r) < 1e-9:
-            return P / max(n_months, 1)
-        return P * (r * (1 + r) ** n_months) / ((1 + r) ** n_months - 1)
+        asset = ensure_user_asset(s, uid, asset_id)
+        if not asset or asset.type != "immo" or not asset.immo:
+            return jsonify({"ok": False, "error": "immo asset not found"}), 404
+        schedules = _property_loan_schedules(s, uid, asset.immo, mode, planned)
+        return jsonify({
+            "ok": True,
+            "asset_id": asset_id,
+            "loans": [_serialize_schedule(ln, schedules[ln.id], mode)
+                      for ln in asset.immo.loans or [] if ln.id in schedules],
+        }), 200
+
+    except Exception as e:
+        app.logger.exception("❌ /api/assets/<id>/loans/schedule failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        s.close()
+
+# ---------------------------------------------------------
+# Projection patrimoniale (moteur : projection_engine.py)
+# ---------------------------------------------------------
+PROJECTION_SWEEP_MAX_POINTS = int(os.getenv("PROJECTION_SWEEP_MAX_POINTS", "400"))
+
+def _projection_params() -> dict:
+    """Paramètres communs des routes de projection (query string prioritaire sur le body JSON)."""
+    if request.method == "GET":
+        q = request.args
+        body = {}
+    else:
+        body = request.get_json(silent=True) or {}
+        q = request.args
+
+    start = parse_date(q.get("start") or body.get("start")) or first_of_month(datetime.utcnow().date())
+    months = int(q.get("months") or body.get("months") or DEFAULT_MONTHS)
+    scenario = (q.get("scenario") or body.get("scenario") or "base").strip().lower()
+    base_rates = SCENARIOS.get(scenario, SCENARIOS["base"])
+
+    # overrides
+    rates = {k: safe_float(q.get(k) or body.get(k) or v, v) for k, v in base_rates.items()}
+    rates["dca_mult"] = safe_float(q.get("dca_mult") or body.get("dca_mult") or 1.0, 1.0)
+
+    return {
+        "start": start,
+        "months": months,
+        "scenario": scenario,
+        "rates": rates,
+        "snapshot_at": parse_date(q.get("snapshot_at") or body.get("snapshot_at")),
+        "breakdown": str(q.get("breakdown") or body.get("breakdown") or "").lower() in ("1", "true", "yes"),
+        "resolution": (q.get("resolution") or body.get("resolution") or "monthly").strip().lower(),
+        "encoding": (q.get("encoding") or body.get("encoding") or "json").strip().lower(),
+        "returns": (q.get("returns") or body.get("returns") or "scenario").strip().lower(),
+        "net_ter": str(q.get("net_ter") or body.get("net_ter") or "").lower() in ("1", "true", "yes"),
+        "body": body,
+    }
+
+def _apply_returns(s, state: dict, p: dict):
+    """returns=products : taux des lignes de portefeuille estimé sur l'historique de leur ISIN."""
+    if p["returns"] != "products":
+        return None
+    isins = [ln.get("isin") for st in state["portfolios"] for ln in st.get("lines") or []]
+    stats = product_stats_for(s, isins)
+    return apply_product_returns(state, stats, float(p["rates"]["portfolio_apy"]), net_ter=p["net_ter"])
 
 @app.route("/api/projection", methods=["GET", "POST"])
 @jwt_required()
@@ -2588,443 +2880,510 @@ def projection():
       - portfolio_apy, livret_apy, immo_app_apy, inflation_apy (floats, ex: 0.06)
       - vacancy (float, ex: 0.06)
       - snapshot_at (YYYY-MM-DD) -> date pour le donut (défaut = dernier mois projeté)
+      - breakdown (bool) -> séries complètes par actif dans "by_asset"
+      - resolution = monthly | quarterly | yearly (patrimoine fin de période, cashflows sommés)
+      - encoding = json | compact (times = {start, period_start, step_months, count}, séries base64 float32 LE)
+      - returns = scenario | products -> products : rendement de chaque ligne de portefeuille
+        estimé sur l'historique de cours de son ISIN (product_returns.py), détail dans
+        "returns_by_portfolio" ; net_ter (bool) déduit le TER de produits_meta
+    Les séries par actif sont mises en cache : seul un actif modifié est recalculé.
+    Avec les paramètres par défaut, la réponse précalculée la nuit (projection_nightly.py)
+    est servie telle quelle si les données n'ont pas changé depuis.
     """
     uid = int(get_jwt_identity())
+    p = _projection_params()
+    if p["resolution"] not in RESOLUTIONS:
+        return jsonify({"ok": False, "error": f"resolution must be one of {', '.join(RESOLUTIONS)}"}), 400
+    if p["encoding"] not in ENCODINGS:
+        return jsonify({"ok": False, "error": f"encoding must be one of {', '.join(ENCODINGS)}"}), 400
+    if p["returns"] not in RETURN_MODES:
+        return jsonify({"ok": False, "error": f"returns must be one of {', '.join(RETURN_MODES)}"}), 400
 
-    # --- lecture params (GET ou JSON) ---
-    if request.method == "GET":
-        q = request.args
-        body = {}
-    else:
-        body = request.get_json(silent=True) or {}
-        q = request.args
-
-    start = parse_date(q.get("start") or body.get("start")) or _first_of_month(datetime.utcnow().date())
-    months = int(q.get("months") or body.get("months") or 120)
-    scenario = (q.get("scenario") or body.get("scenario") or "base").strip().lower()
-    dca_mult = _safe_float(q.get("dca_mult") or body.get("dca_mult") or 1.0, 1.0)
-
-    # presets
-    SCEN = {
-        "base": {"portfolio_apy": 0.06, "livret_apy": 0.03, "immo_app_apy": 0.015, "inflation_apy": 0.02, "vacancy": 0.06},
-        "doux": {"portfolio_apy": 0.04, "livret_apy": 0.025, "immo_app_apy": 0.01,  "inflation_apy": 0.02, "vacancy": 0.08},
-        "soft": {"portfolio_apy": 0.04, "livret_apy": 0.025, "immo_app_apy": 0.01,  "inflation_apy": 0.02, "vacancy": 0.08},
-        "choc": {"portfolio_apy": -0.02, "livret_apy": 0.02, "immo_app_apy": -0.005,"inflation_apy": 0.03, "vacancy": 0.12},
-        "shock":{"portfolio_apy": -0.02, "livret_apy": 0.02, "immo_app_apy": -0.005,"inflation_apy": 0.03, "vacancy": 0.12},
-    }
-    base_rates = SCEN.get(scenario, SCEN["base"])
+    s = Session()
+    try:
+        state = load_state(s, uid, p["start"])
+        if is_default_params(p):
+            snap = s.query(ProjectionSnapshot).filter_by(user_id=uid).first()
+            if (snap and snap.start == p["start"] and snap.months == p["months"]
+                    and snap.state_version == state_version(state)):
+                app.logger.debug("[projection] snapshot hit user=%s (%s)", uid, snap.computed_at)
+                return Response(gzip.decompress(snap.payload), status=200, mimetype="application/json")
+
+        returns_by_portfolio = _apply_returns(s, state, p)
+        sim = simulate_incremental(state, p["start"], p["months"], p["rates"])
+        app.logger.debug("[projection] series cache %s", sim["cache"])
+        payload = projection_payload(state, sim, p, snapshot_at=p["snapshot_at"], breakdown=p["breakdown"])
+        if returns_by_portfolio is not None:
+            payload["returns_by_portfolio"] = returns_by_portfolio
+        return jsonify(payload), 200
 
-    # overrides
-    portfolio_apy = _safe_float(q.get("portfolio_apy") or body.get("portfolio_apy") or base_rates["portfolio_apy"], base_rates["portfolio_apy"])
-    livret_apy    = _safe_float(q.get("livret_apy")    or body.get("livret_apy")    or base_rates["livret_apy"],    base_rates["livret_apy"])
-    immo_app_apy  = _safe_float(q.get("immo_app_apy")  or body.get("immo_app_apy")  or base_rates["immo_app_apy"],  base_rates["immo_app_apy"])
-    inflation_apy = _safe_float(q.get("inflation_apy") or body.get("inflation_apy") or base_rates["inflation_apy"], base_rates["inflation_apy"])
-    vacancy       = _safe_float(q.get("vacancy")       or body.get("vacancy")       or base_rates["vacancy"],       base_rates["vacancy"])
+    except Exception as e:
+        app.logger.exception("❌ /api/projection failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        s.close()
 
-    snapshot_at   = parse_date(q.get("snapshot_at") or body.get("snapshot_at"))
+def _sweep_axis_values(spec) -> list[float]:
+    """Liste explicite [..] ou plage {"min","max","steps"} -> valeurs de l'axe."""
+    if isinstance(spec, dict):
+        lo, hi = parse_float(spec.get("min")), parse_float(spec.get("max"))
+        steps = parse_int(spec.get("steps")) or 2
+        if lo is None or hi is None or steps < 1:
+            raise ValueError("axis range needs min, max and steps >= 1")
+        if steps > PROJECTION_SWEEP_MAX_POINTS:
+            raise ValueError(f"too many steps (max {PROJECTION_SWEEP_MAX_POINTS})")
+        return np.linspace(lo, hi, steps).tolist()
+    vals = [parse_float(v) for v in (spec or [])]
+    if not vals or any(v is None for v in vals):
+        raise ValueError("axis values must be a non-empty list of numbers")
+    return vals
+
+def _first_dates(mask: np.ndarray, times: list) -> list:
+    """Pour chaque ligne de `mask` (G, M): date du premier mois vrai, sinon None."""
+    idx = mask.argmax(axis=1)
+    hit = mask.any(axis=1)
+    return [times[i].isoformat() if h else None for i, h in zip(idx.tolist(), hit.tolist())]
+
+@app.route("/api/projection/sweep", methods=["POST"])
+@jwt_required()
+def projection_sweep():
+    """
+    Grille de sensibilité : toutes les combinaisons de paramètres en UNE passe vectorisée
+    sur l'état utilisateur chargé une seule fois.
+    Body JSON (mêmes params que /api/projection, plus):
+      - axes: {"portfolio_apy": [0.02, 0.04, 0.06], "vacancy": {"min": 0, "max": 0.2, "steps": 5}}
+              (1 à 3 axes parmi portfolio_apy, livret_apy, immo_app_apy, inflation_apy, vacancy, dca_mult)
+      - targets: [100000, 500000] -> date de franchissement du patrimoine net, par point de grille
+    La grille est plafonnée à PROJECTION_SWEEP_MAX_POINTS points.
+    """
+    uid = int(get_jwt_identity())
+    p = _projection_params()
+    body = p["body"]
+
+    axes_in = body.get("axes") or {}
+    if not isinstance(axes_in, dict) or not (1 <= len(axes_in) <= 3):
+        return jsonify({"ok": False, "error": "axes must map 1 to 3 parameters to values"}), 400
+    unknown = [k for k in axes_in if k not in RATE_KEYS]
+    if unknown:
+        return jsonify({"ok": False, "error": f"unknown sweep parameter(s): {', '.join(unknown)}"}), 400
+    if p["months"] <= 0:
+        return jsonify({"ok": False, "error": "months must be > 0"}), 400
 
-    # monthly rates
-    r_pf_m   = _apy_to_monthly(portfolio_apy)
-    r_lv_m   = _apy_to_monthly(livret_apy)
-    r_immo_m = _apy_to_monthly(immo_app_apy)
-    r_cpi_m  = _apy_to_monthly(inflation_apy)
+    try:
+        axes = [{"param": k, "values": _sweep_axis_values(v)} for k, v in axes_in.items()]
+        targets = [float(t) for t in (body.get("targets") or [])]
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    shape = tuple(len(ax["values"]) for ax in axes)
+    n_points = int(np.prod(shape))
+    if n_points > PROJECTION_SWEEP_MAX_POINTS:
+        return jsonify({"ok": False, "error": f"grid too large ({n_points} > {PROJECTION_SWEEP_MAX_POINTS} points)"}), 400
+
+    # grille aplatie : chaque paramètre balayé devient un tableau de n_points valeurs
+    rates = dict(p["rates"])
+    mesh = np.meshgrid(*[np.asarray(ax["values"], dtype=float) for ax in axes], indexing="ij")
+    for ax, m in zip(axes, mesh):
+        rates[ax["param"]] = m.ravel()
 
     s = Session()
     try:
-        # charge data
-        assets = (s.query(Asset)
-                    .filter(Asset.user_id == uid)
-                    .options(
-                        joinedload(Asset.livret),
-                        joinedload(Asset.other),
-                        joinedload(Asset.portfolio).joinedload(AssetPortfolio.lines),
-                        joinedload(Asset.portfolio).joinedload(AssetPortfolio.products),
-                        joinedload(Asset.immo).joinedload(AssetImmo.loans),
-                        joinedload(Asset.immo).joinedload(AssetImmo.expenses),
-                    ).all())
-
-        incomes = s.query(UserIncome).filter(UserIncome.user_id == uid).all()
-        try:
-            expenses = s.query(UserExpense).filter(UserExpense.user_id == uid).all()
-        except Exception:
-            expenses = []  # si le modèle n'existe pas encore
-
-        # ---------- init états par type ----------
-        # Livrets
-        livret_states = []  # [{label, value, bene_id, contrib_m}]
-        # Portfolios
-        pf_states = []      # [{label, value, bene_id, contrib_m, envelopes:[str]}]
-        # Immo
-        immo_states = []    # [{label, bene_id, prop_value, loans:[{remain, r_m, pay_no_ins, months_left, end_date}], insurance_m, rent_m, expenses_m, ownership_pct}]
-        # Others
-        other_states = []   # [{label, value, bene_id}]
-
-        for a in assets:
-            bene_id = a.beneficiary_id
-            if a.type == "livret" and a.livret:
-                lv = a.livret
-                value0 = _safe_float(getattr(lv, "balance_effective", None), None)
-                if value0 is None:
-                    value0 = _safe_float(lv.balance, _safe_float(a.current_value))
-                contrib_m = _safe_float(lv.recurring_amount) * _freq_to_monthly(lv.recurring_frequency)
-                livret_states.append({
-                    "label": a.label, "value": max(value0, 0.0), "bene_id": bene_id,
-                    "contrib_m": max(contrib_m, 0.0)
-                })
+        state = load_state(s, uid, p["start"])
+        _apply_returns(s, state, p)
+        sim = simulate(state, p["start"], p["months"], rates)
+        times = sim["times"]
 
-            elif a.type == "portfolio" and a.portfolio:
-                pf = a.portfolio
-                value0 = _safe_float(a.current_value, 0.0)
-                # DCA par lignes si dispo, sinon fallback au recurring du portefeuille
-                dca_total = 0.0
-                for ln in pf.lines or []:
-                    dca_total += _safe_float(ln.amount_allocated) * _freq_to_monthly(ln.allocation_frequency)
-                if dca_total <= 0 and pf.recurring_frequency:
-                    dca_total = _safe_float(pf.recurring_amount) * _freq_to_monthly(pf.recurring_frequency)
-
-                envelopes = [p.product_type for p in (pf.products or []) if p.product_type]
-                pf_states.append({
-                    "label": a.label, "value": max(value0, 0.0), "bene_id": bene_id,
-                    "contrib_m": max(dca_total * dca_mult, 0.0),
-                    "envelopes": envelopes or []
-                })
+        def _matrix(vec):
+            return np.round(np.asarray(vec, dtype=float), 2).reshape(shape).tolist()
 
-            elif a.type == "immo" and a.immo:
-                im = a.immo
-                prop0 = _safe_float(im.last_estimation_value, _safe_float(im.purchase_price))
-                insurance_m = _safe_float(im.insurance_monthly, 0.0)
-
-                # loyer: direct si renseigné, sinon 0 (l’association UserIncome éventuelle est ignorée ici)
-                rent_m = _safe_float(im.rental_income, 0.0)
-
-                # dépenses immo récurrentes (mensualisées)
-                expenses_m = 0.0
-                for ex in im.expenses or []:
-                    expenses_m += _safe_float(ex.amount) * _freq_to_monthly(ex.frequency)
-
-                # prêts
-                loans = []
-                for ln in im.loans or []:
-                    P = _safe_float(ln.loan_amount, 0.0)
-                    r_apy = _safe_float(ln.loan_rate, 0.0) / 100.0 if ln.loan_rate and ln.loan_rate > 1 else _safe_float(ln.loan_rate, 0.0)
-                    r_m = (r_apy) / 12.0
-                    n = ln.loan_duration_months or 0
-                    pay = _safe_float(ln.monthly_payment, None)
-                    if not pay:
-                        pay = _loan_monthly_payment(P, r_apy, n)
-
-                    # capital restant dû à la date 'start'
-                    k_elapsed = 0
-                    if ln.loan_start_date:
-                        try:
-                            k_elapsed = max(0, _months_between(ln.loan_start_date, start))
-                        except Exception:
-                            k_elapsed = 0
-                    remain = float(P)
-                    # avance jusqu'à 'start'
-                    for _ in range(min(k_elapsed, max(n, 0))):
-                        if remain <= 1e-8:
-                            remain = 0.0
-                            break
-                        interest = remain * r_m
-                        principal = max(0.0, pay - interest)
-                        principal = min(principal, remain)
-                        remain -= principal
-
-                    months_left = max(0, n - k_elapsed)
-                    end_date = _add_months(ln.loan_start_date or start, months_left)
-                    loans.append({
-                        "remain": max(remain, 0.0), "r_m": r_m, "pay_no_ins": pay,
-                        "months_left": months_left, "end_date": end_date
-                    })
+        def _date_matrix(dates):
+            return np.array(dates, dtype=object).reshape(shape).tolist()
 
-                immo_states.append({
-                    "label": a.label, "bene_id": bene_id,
-                    "prop_value": max(prop0, 0.0),
-                    "loans": loans,
-                    "insurance_m": insurance_m,
-                    "rent_m": max(rent_m, 0.0),
-                    "expenses_m": max(expenses_m, 0.0),
-                    "ownership_pct": _safe_float(im.ownership_percentage, 100.0)
-                })
+        terminal = {"total": _matrix(sim["total"][:, -1])}
+        for k in STACK_KEYS:
+            terminal[k] = _matrix(sim[k][:, -1])
+        terminal["cumulative_net_cashflow"] = _matrix(sim["net"].sum(axis=1))
 
-            elif a.type == "other" and a.other:
-                oth = a.other
-                value0 = _safe_float(oth.estimated_value, _safe_float(a.current_value))
-                other_states.append({"label": a.label, "value": max(value0, 0.0), "bene_id": bene_id})
+        return jsonify({
+            "ok": True,
+            "params": {
+                "start": p["start"].isoformat(),
+                "months": p["months"],
+                "scenario": p["scenario"],
+                "rates_used": {k: p["rates"][k] for k in RATE_KEYS},
+            },
+            "at": times[-1].isoformat(),
+            "axes": axes,
+            "shape": list(shape),
+            "terminal": terminal,
+            "milestones": {
+                "targets": [{
+                    "amount": t,
+                    "reached_at": _date_matrix(_first_dates(sim["total"] >= t, times)),
+                } for t in targets],
+                "first_negative_cashflow": _date_matrix(_first_dates(sim["net"] < 0, times)),
+                "loan_end": loan_milestones(state, sim),
+            },
+        }), 200
 
-            else:
-                # si 'current_value' existe quand même
-                v0 = _safe_float(a.current_value, 0.0)
-                if v0 > 0:
-                    other_states.append({"label": a.label, "value": v0, "bene_id": bene_id})
-
-        # revenus (mensualisés), avec end_date
-        income_defs = []
-        for inc in incomes or []:
-            m = _safe_float(inc.amount) * _freq_to_monthly(inc.frequency)
-            income_defs.append({"amount_m": max(m, 0.0), "end": inc.end_date})
-
-        # dépenses utilisateur (mensualisées)
-        expense_defs = []
-        for ex in expenses or []:
-            m = _safe_float(ex.amount) * _freq_to_monthly(ex.frequency)
-            expense_defs.append({"amount_m": max(m, 0.0)})
-
-        # ---------- boucle mensuelle ----------
-        times = []
-        stack_livrets = []
-        stack_portfolios = []
-        stack_immo = []
-        stack_other = []
-        total_series = []
-
-        inflow_series = []
-        outflow_series = []
-        net_series = []
-        capacity_series = []
-
-        milestones = []
-
-        # pré-déclare les jalons fin de prêt
-        for im in immo_states:
-            for ln in im["loans"]:
-                if ln["months_left"] > 0:
-                    milestones.append({
-                        "date": ln["end_date"].isoformat(),
-                        "kind": "loan_end",
-                        "label": f"Fin prêt · {im['label']}",
-                        "amount": ln["pay_no_ins"]
-                    })
+    except Exception as e:
+        app.logger.exception("❌ /api/projection/sweep failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        s.close()
+
+PROJECTION_GOAL_PARAMS = ("dca", "portfolio_apy")
+
+@app.route("/api/projection/goal", methods=["POST"])
+@jwt_required()
+def projection_goal():
+    """
+    Goal-seek : quel DCA mensuel (ou quel portfolio_apy) atteint un patrimoine net X à la date Y ?
+    Body JSON (mêmes params que /api/projection, plus):
+      - target (float, requis) : patrimoine net visé
+      - by (YYYY-MM-DD, requis) : date d'atteinte (mois inclus)
+      - solve_for = dca | portfolio_apy (défaut dca)
+    DCA : modèle linéaire en contributions, pente mesurée par simulation (dca_mult 0 et 1).
+    portfolio_apy : encadrement vectorisé puis bisection sur la simulation.
+    """
+    uid = int(get_jwt_identity())
+    p = _projection_params()
+    body = p["body"]
+
+    target = parse_float(body.get("target"))
+    by = parse_date(body.get("by"))
+    solve_for = (body.get("solve_for") or "dca").strip().lower()
+    if target is None or not by:
+        return jsonify({"ok": False, "error": "target and by (YYYY-MM-DD) required"}), 400
+    if solve_for not in PROJECTION_GOAL_PARAMS:
+        return jsonify({"ok": False, "error": f"solve_for must be one of {', '.join(PROJECTION_GOAL_PARAMS)}"}), 400
+    months = months_between(p["start"], by) + 1
+    if months <= 0:
+        return jsonify({"ok": False, "error": "by must be on or after start"}), 400
+
+    s = Session()
+    try:
+        t0 = time.perf_counter()
+        state = load_state(s, uid, p["start"])
+        _apply_returns(s, state, p)
+        t_load = time.perf_counter()
+        if solve_for == "dca":
+            sol = goal_seek_dca(state, p["start"], months, p["rates"], target)
+        else:
+            sol = goal_seek_rate(state, p["start"], months, p["rates"], solve_for, target)
+        t_end = time.perf_counter()
 
-        # états dynamiques (valeurs)
-        lv_vals = [st["value"] for st in livret_states]
-        pf_vals = [st["value"] for st in pf_states]
-        im_prop_vals = [st["prop_value"] for st in immo_states]
-        # loans remain sont déjà portés dans immo_states.loans
-
-        exp_cpi_factor = 1.0  # indexation dépenses
-        for i in range(months):
-            t = _add_months(start, i)
-            times.append(t.isoformat())
-
-            # --- inflows ---
-            inflows = 0.0
-            # revenus utilisateur actifs ce mois
-            for inc in income_defs:
-                if inc["end"] and t > inc["end"]:
-                    continue
-                inflows += inc["amount_m"]
-            # loyers (affectés par vacance)
-            rents = 0.0
-            for idx, im in enumerate(immo_states):
-                r = im["rent_m"] * max(0.0, 1.0 - vacancy)
-                rents += r
-            inflows += rents
-
-            # --- outflows (charges hors épargne) ---
-            # prêts immo + assurance + dépenses immo indexées CPI + dépenses user indexées CPI
-            charges_hors_epargne = 0.0
-            # prêts
-            for im_idx, im in enumerate(immo_states):
-                # dépense fixe: assurance
-                charges_hors_epargne += im["insurance_m"] if im["insurance_m"] else 0.0
-
-                # dépenses immo (CPI)
-                charges_hors_epargne += (im["expenses_m"] * exp_cpi_factor) if im["expenses_m"] else 0.0
-
-                # prêts: somme des mensualités (hors assurance) si reste du capital
-                for ln in im["loans"]:
-                    if ln["remain"] > 1e-8 and ln["months_left"] > 0:
-                        charges_hors_epargne += ln["pay_no_ins"]
-
-            # dépenses user (CPI)
-            for ex in expense_defs:
-                charges_hors_epargne += ex["amount_m"] * exp_cpi_factor
-
-            # --- contributions épargne (outflows d’épargne) ---
-            contrib_livrets = sum(st["contrib_m"] for st in livret_states)
-            contrib_pfs     = sum(st["contrib_m"] for st in pf_states)
-            outflows_epargne = contrib_livrets + contrib_pfs
-
-            outflows_total = charges_hors_epargne + outflows_epargne
-            net_cf = inflows - outflows_total
-            capacity = inflows - charges_hors_epargne  # capacité d’épargne
-
-            # --- mise à jour valeurs (capitalisation + DCA) ---
-            # Livrets
-            for j, st in enumerate(livret_states):
-                val = lv_vals[j]
-                val = val * (1.0 + r_lv_m) + st["contrib_m"]  # simple: intérêts mensuels + versement
-                lv_vals[j] = max(val, 0.0)
-
-            # Portfolios
-            for j, st in enumerate(pf_states):
-                val = pf_vals[j]
-                val = val * (1.0 + r_pf_m) + st["contrib_m"]
-                pf_vals[j] = max(val, 0.0)
-
-            # Immobilier: valeur + amortissement du capital
-            for j, im in enumerate(immo_states):
-                # valeur du bien
-                pv = im_prop_vals[j] * (1.0 + r_immo_m)
-                im_prop_vals[j] = max(pv, 0.0)
-                # prêts -> mise à jour capital restant dû
-                for ln in im["loans"]:
-                    if ln["remain"] > 1e-8 and ln["months_left"] > 0:
-                        interest = ln["remain"] * ln["r_m"]
-                        principal = max(0.0, ln["pay_no_ins"] - interest)
-                        principal = min(principal, ln["remain"])
-                        ln["remain"] -= principal
-                        ln["months_left"] -= 1
-
-            # Other: inchangés (pas de capitalisation par défaut)
-
-            # --- séries empilées ---
-            tot_livret = sum(lv_vals) if lv_vals else 0.0
-            tot_pf     = sum(pf_vals) if pf_vals else 0.0
-            # immo equity = prop_value - somme capital restant dû
-            tot_immo_equity = 0.0
-            for j, im in enumerate(immo_states):
-                remain = sum(ln["remain"] for ln in im["loans"])
-                eq = max(im_prop_vals[j] - remain, 0.0)
-                tot_immo_equity += eq
-
-            tot_other = sum(st["value"] for st in other_states) if other_states else 0.0
-            total = tot_livret + tot_pf + tot_immo_equity + tot_other
-
-            stack_livrets.append(tot_livret)
-            stack_portfolios.append(tot_pf)
-            stack_immo.append(tot_immo_equity)
-            stack_other.append(tot_other)
-            total_series.append(total)
-
-            inflow_series.append(inflows)
-            outflow_series.append(outflows_total)
-            net_series.append(net_cf)
-            capacity_series.append(capacity)
-
-            # indexation dépenses (CPI) pour le mois suivant
-            exp_cpi_factor *= (1.0 + r_cpi_m)
-
-        # ---------- snapshot donut ----------
-        snap_date = snapshot_at or (times[-1] if times else _first_of_month(datetime.utcnow().date()).isoformat())
-        # on prend le dernier état calculé pour répartitions
-        last_lv = stack_livrets[-1] if stack_livrets else 0.0
-        last_pf = stack_portfolios[-1] if stack_portfolios else 0.0
-        last_im = stack_immo[-1] if stack_immo else 0.0
-        last_ot = stack_other[-1] if stack_other else 0.0
-
-        # by type
-        donut_by_type = [
-            {"label": "Immobilier (equity)", "value": round(last_im, 2)},
-            {"label": "Portefeuilles",       "value": round(last_pf, 2)},
-            {"label": "Livrets",             "value": round(last_lv, 2)},
-            {"label": "Autres",              "value": round(last_ot, 2)},
-        ]
-
-        # by beneficiary (approx: on répartit chaque catégorie par somme des parts initiales)
-        bene_totals = {}
-        # livret
-        lv_sum_init = sum(st["value"] for st in livret_states) or 1.0
-        if lv_sum_init > 0:
-            for st in livret_states:
-                part = (st["value"] / lv_sum_init) * last_lv
-                bene_totals[st["bene_id"]] = bene_totals.get(st["bene_id"], 0.0) + part
-        # pf
-        pf_sum_init = sum(st["value"] for st in pf_states) or 1.0
-        if pf_sum_init > 0:
-            for st in pf_states:
-                part = (st["value"] / pf_sum_init) * last_pf
-                bene_totals[st["bene_id"]] = bene_totals.get(st["bene_id"], 0.0) + part
-        # immo (au pro rata equity courant : on approx par ownership_pct initial)
-        if immo_states and last_im > 0:
-            # calc equity courant par immeuble
-            im_equities = []
-            for j, im in enumerate(immo_states):
-                remain = sum(ln["remain"] for ln in im["loans"])
-                eq = max(im_prop_vals[j] - remain, 0.0)
-                im_equities.append(eq)
-            im_sum_eq = sum(im_equities) or 1.0
-            for j, im in enumerate(immo_states):
-                bene = im["bene_id"]
-                # ownership_pct si présent, sinon 100% sur le bénéficiaire actuel
-                fr = (im["ownership_pct"] or 100.0) / 100.0
-                part = (im_equities[j] / im_sum_eq) * last_im * fr
-                bene_totals[bene] = bene_totals.get(bene, 0.0) + part
-        # other
-        ot_sum_init = sum(st["value"] for st in other_states) or 1.0
-        if ot_sum_init > 0:
-            for st in other_states:
-                part = (st["value"] / ot_sum_init) * last_ot
-                bene_totals[st["bene_id"]] = bene_totals.get(st["bene_id"], 0.0) + part
-
-        donut_by_beneficiary = [
-            {"beneficiary_id": k, "value": round(v, 2)} for k, v in bene_totals.items()
-        ]
-
-        # ---------- enveloppes (approx égale par produit déclaré au niveau du portefeuille) ----------
-        envelope_totals = {}
-        if last_pf > 0 and pf_states:
-            # pondération égale par portefeuille, puis par enveloppe de ce portefeuille
-            pf_total_now = last_pf or 1.0
-            # approximons par part initiale du portefeuille dans l'ensemble des portefeuilles
-            init_pf_sum = sum(st["value"] for st in pf_states) or 1.0
-            for st in pf_states:
-                st_share_now = (st["value"] / init_pf_sum) * last_pf
-                envs = st["envelopes"] or ["CTO"]
-                if envs:
-                    per_env = st_share_now / len(envs)
-                    for e in envs:
-                        envelope_totals[e] = envelope_totals.get(e, 0.0) + per_env
-
-        donut_by_envelope = [{"label": k, "value": round(v, 2)} for k, v in envelope_totals.items()]
-
-        # ---------- sortie ----------
         return jsonify({
             "ok": True,
             "params": {
-                "start": start.isoformat(),
-                "months": months,
-                "scenario": scenario,
-                "rates_used": {
-                    "portfolio_apy": portfolio_apy,
-                    "livret_apy": livret_apy,
-                    "immo_app_apy": immo_app_apy,
-                    "inflation_apy": inflation_apy,
-                    "vacancy": vacancy,
-                    "dca_mult": dca_mult
-                }
+                "start": p["start"].isoformat(),
+                "scenario": p["scenario"],
+                "rates_used": {k: p["rates"][k] for k in RATE_KEYS},
             },
-            "times": times,
-            "net_worth": {
-                "total": [round(x, 2) for x in total_series],
-                "stack": {
-                    "livrets": [round(x, 2) for x in stack_livrets],
-                    "portfolios": [round(x, 2) for x in stack_portfolios],
-                    "immo_equity": [round(x, 2) for x in stack_immo],
-                    "other": [round(x, 2) for x in stack_other],
-                }
+            "target": target,
+            "by": first_of_month(by).isoformat(),
+            "solve_for": solve_for,
+            "solution": {**sol, "value": round(sol["value"], 6 if solve_for != "dca" else 2),
+                         "net_worth_at_date": round(sol["net_worth_at_date"], 2)},
+            "evaluations": sol["evaluations"],
+            "timing_ms": {
+                "load": round((t_load - t0) * 1000, 2),
+                "solve": round((t_end - t_load) * 1000, 2),
             },
+        }), 200
+
+    except Exception as e:
+        app.logger.exception("❌ /api/projection/goal failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        s.close()
+
+PROJECTION_RISK_MAX_PATHS = int(os.getenv("PROJECTION_RISK_MAX_PATHS", "5000"))
+
+@app.route("/api/projection/risk", methods=["GET", "POST"])
+@jwt_required()
+def projection_risk():
+    """
+    Cashflow-at-risk immobilier : vacance en mois entiers (Markov occupé / vacant par bien)
+    et prêts à taux variable révisés périodiquement, sur `paths` chemins aléatoires.
+    Query/body params (mêmes que /api/projection, plus):
+      - paths (int, défaut 500), seed (int, défaut 0 -> résultat stable d'un appel à l'autre)
+      - percentiles (liste ou "5,50,95", défaut 5,50,95)
+      - mean_vacant_months (float, défaut 3) : durée moyenne d'une vacance
+      - variable_loans ("all" ou ids d'ImmoLoan, défaut aucun)
+      - reset_months (int, défaut 12), rate_vol (écart-type annuel, défaut 0.005), rate_floor (défaut 0)
+    `vacancy` (scénario) reste la part moyenne de mois vacants.
+    Retourne les percentiles de cashflow.net (par période) et du net cumulé.
+    """
+    uid = int(get_jwt_identity())
+    p = _projection_params()
+    body, q = p["body"], request.args
+    arg = lambda k, default=None: q.get(k) if q.get(k) is not None else body.get(k, default)
+
+    try:
+        paths = int(arg("paths", 500))
+        seed = parse_int(arg("seed", 0))
+        pct = arg("percentiles", [5, 50, 95])
+        percentiles = sorted({float(x) for x in (pct.split(",") if isinstance(pct, str) else pct)})
+        variable = arg("variable_loans", [])
+        if isinstance(variable, str) and variable.strip().lower() != "all":
+            variable = [x for x in variable.split(",") if x.strip()]
+        elif isinstance(variable, str):
+            variable = "all"
+        opts = {
+            "mean_vacant_months": safe_float(arg("mean_vacant_months"), 3.0),
+            "reset_months": int(arg("reset_months", 12)),
+            "rate_vol": safe_float(arg("rate_vol"), 0.005),
+            "rate_floor": safe_float(arg("rate_floor"), 0.0),
+        }
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "error": f"invalid parameter: {e}"}), 400
+    if not 1 <= paths <= PROJECTION_RISK_MAX_PATHS:
+        return jsonify({"ok": False, "error": f"paths must be between 1 and {PROJECTION_RISK_MAX_PATHS}"}), 400
+    if not percentiles or any(not 0 <= x <= 100 for x in percentiles):
+        return jsonify({"ok": False, "error": "percentiles must be within [0, 100]"}), 400
+    if p["resolution"] not in RESOLUTIONS:
+        return jsonify({"ok": False, "error": f"resolution must be one of {', '.join(RESOLUTIONS)}"}), 400
+
+    s = Session()
+    try:
+        t0 = time.perf_counter()
+        state = load_state(s, uid, p["start"])
+        t_load = time.perf_counter()
+        sim = simulate_immo_risk(state, p["start"], p["months"], p["rates"], paths=paths, seed=seed,
+                                 variable_loans=variable, **opts)
+        t_sim = time.perf_counter()
+
+        starts, ends, labels = period_bounds(sim["times"], p["resolution"])
+        net = resample_flow(sim["net"], starts, ends)                 # (paths, périodes)
+        cum = np.cumsum(net, axis=1)
+        bands = lambda a: {k: round_list(v) for k, v in percentile_bands(a, percentiles).items()}
+        total = cum[:, -1] if cum.shape[1] else np.zeros(paths)
+        low = float(np.percentile(total, percentiles[0]))
+
+        return jsonify({
+            "ok": True,
+            "params": {
+                "start": p["start"].isoformat(),
+                "months": p["months"],
+                "scenario": p["scenario"],
+                "rates_used": {k: p["rates"][k] for k in RATE_KEYS},
+                "resolution": p["resolution"],
+                "paths": paths, "seed": seed, "percentiles": percentiles,
+                "variable_loans": sim["variable_loans"], **opts,
+            },
+            "times": [t.isoformat() for t in labels],
             "cashflow": {
-                "inflows": [round(x, 2) for x in inflow_series],
-                "outflows": [round(x, 2) for x in outflow_series],
-                "net": [round(x, 2) for x in net_series],
-                "capacity": [round(x, 2) for x in capacity_series],
+                "net": bands(net),
+                "cumulative_net": bands(cum),
+                "prob_negative": round_list((net < 0).mean(axis=0)),
+            },
+            "cash_at_risk": {
+                "percentile": percentiles[0],
+                "horizon_net_mean": round(float(total.mean()), 2),
+                "horizon_net_at_percentile": round(low, 2),
+                "value": round(float(total.mean()) - low, 2),
             },
-            "snapshot": {
-                "at": (snapshot_at or parse_date(times[-1]) or start).isoformat(),
-                "donut": {
-                    "by_type": donut_by_type,
-                    "by_beneficiary": donut_by_beneficiary,
-                    "by_envelope": donut_by_envelope,
-                }
+            "vacant_share": round(sim["vacant_share"], 4),
+            "timing_ms": {
+                "load": round((t_load - t0) * 1000, 2),
+                "simulate": round((t_sim - t_load) * 1000, 2),
             },
-            "milestones": milestones
         }), 200
 
     except Exception as e:
-        app.logger.exception("❌ /api/projection failed")
+        app.logger.exception("❌ /api/projection/risk failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        s.close()
+
+# ---------------------------------------------------------
+# Patrimoine historique (moteur : networth_history.py)
+# ---------------------------------------------------------
+@app.route("/api/networth/history", methods=["GET"])
+@jwt_required()
+def networth_history():
+    """
+    Patrimoine net passé, reconstruit depuis asset_events + cours ProduitHisto.
+    Query params (optionnels):
+      - from, to (YYYY-MM-DD ; défaut : début de l'historique -> aujourd'hui)
+      - resolution = daily | monthly (dernier jour disponible de chaque mois)
+      - breakdown (bool) -> séries par actif dans "by_asset" (tout est alors recalculé)
+    Les jours déjà calculés par networth_nightly.py sont lus en base (si le journal
+    n'a pas changé depuis) ; les jours suivants sont calculés à la volée avec les
+    mêmes espèces à l'ancrage, breakdown compris : mêmes totaux dans tous les cas.
+    """
+    uid = int(get_jwt_identity())
+    dfrom = parse_date(request.args.get("from"))
+    dto = parse_date(request.args.get("to")) or datetime.utcnow().date()
+    resolution = (request.args.get("resolution") or "daily").strip().lower()
+    breakdown = (request.args.get("breakdown") or "").lower() in ("1", "true", "yes")
+    if resolution not in HISTORY_RESOLUTIONS:
+        return jsonify({"ok": False, "error": f"resolution must be one of {', '.join(HISTORY_RESOLUTIONS)}"}), 400
+    if dfrom and dfrom > dto:
+        return jsonify({"ok": False, "error": "from must be on or before to"}), 400
+    if dfrom and (dto - dfrom).days > HISTORY_MAX_YEARS * 366:
+        return jsonify({"ok": False, "error": f"range too large (max {HISTORY_MAX_YEARS} years)"}), 400
+
+    s = Session()
+    try:
+        dates, cols = [], {k: [] for k in ("total",) + STACK_KEYS}
+        st = s.get(NetWorthHistoryState, uid)
+        live_from = dfrom
+        valid = st is not None and st.cash_anchor is not None and st.ledger_version == ledger_version(s, uid)
+        if valid:
+            dfrom = max(dfrom, st.first_date) if dfrom else st.first_date
+            live_from = dfrom
+        if not breakdown and valid:
+            rows = (s.query(NetWorthHistory)
+                    .filter(NetWorthHistory.user_id == uid,
+                            NetWorthHistory.date >= dfrom,
+                            NetWorthHistory.date <= min(dto, st.last_date))
+                    .order_by(NetWorthHistory.date.asc()).all())
+            for r in rows:
+                dates.append(r.date)
+                for k in cols:
+                    cols[k].append(float(getattr(r, k)))
+            live_from = max(st.last_date + timedelta(days=1), dfrom)
+        stored = len(dates)
+
+        by_asset = []
+        if live_from is None or live_from <= dto:
+            ledger = load_ledger(s, uid, live_from - timedelta(days=1) if live_from else None, dto)
+            if valid:
+                ledger["cash"] = stored_cash(st)
+            live_from = live_from or ledger["since"] + timedelta(days=1)
+            res = reconstruct(ledger, live_from, dto)
+            dates += res["dates"]
+            for k in cols:
+                cols[k] += res[k].tolist()
+            by_asset = res["assets"]
+
+        idx = month_ends(dates) if resolution == "monthly" else np.arange(len(dates))
+        pick = lambda vals: round_list(np.asarray(vals, dtype=float)[idx]) if len(dates) else []
+        payload = {
+            "ok": True,
+            "params": {"from": dates[0].isoformat() if dates else None, "to": dto.isoformat(),
+                       "resolution": resolution},
+            "dates": [dates[i].isoformat() for i in idx],
+            "total": pick(cols["total"]),
+            "stack": {k: pick(cols[k]) for k in STACK_KEYS},
+            "source": {"stored_days": stored, "computed_days": len(dates) - stored},
+        }
+        if breakdown:
+            payload["by_asset"] = [{"asset_id": a["asset_id"], "type": a["type"], "label": a["label"],
+                                    "values": pick(a["values"])} for a in by_asset]
+        return jsonify(payload), 200
+
+    except Exception as e:
+        app.logger.exception("❌ /api/networth/history failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        s.close()
+
+# ---------------------------------------------------------
+# Performance des portefeuilles (moteur : performance_engine.py)
+# ---------------------------------------------------------
+def _performance_for(s, uid: int, asset_ids: list[int]) -> dict:
+    """Performance des portefeuilles `asset_ids` de `uid` (résultat du batch nuit si encore valable)."""
+    dfrom = parse_date(request.args.get("from"))
+    dto = parse_date(request.args.get("to"))
+    out = {}
+    if dfrom is None:
+        # sans "to" : le calcul de la nuit (arrêté à la veille) est servi tel quel
+        oldest = dto or datetime.utcnow().date() - timedelta(days=1)
+        versions = asset_versions(s, asset_ids)
+        for row in (s.query(PortfolioPerformance)
+                    .filter(PortfolioPerformance.asset_id.in_(asset_ids),
+                            PortfolioPerformance.as_of >= oldest,
+                            PortfolioPerformance.as_of <= (dto or datetime.utcnow().date())).all()):
+            if row.version == versions.get(row.asset_id):
+                out[row.asset_id] = row.metrics
+    todo = [aid for aid in asset_ids if aid not in out]
+    if todo:
+        out.update(portfolio_performance(s, todo, dto or datetime.utcnow().date(), dfrom))
+    return out
+
+@app.route("/api/portfolios/performance", methods=["GET"])
+@jwt_required()
+def portfolios_performance():
+    """
+    TWR et MWR (TRI annualisé) de tous les portefeuilles de l'utilisateur et de leurs lignes.
+    Query params (optionnels): from (défaut : premier trade), to (défaut : aujourd'hui).
+    Sans from / to, le calcul du batch nuit (networth_nightly.py) est servi s'il est à jour.
+    """
+    uid = int(get_jwt_identity())
+    s = Session()
+    try:
+        ids = [aid for (aid,) in (s.query(Asset.id)
+                                  .filter(Asset.user_id == uid, Asset.type == "portfolio")
+                                  .order_by(Asset.id).all())]
+        perf = _performance_for(s, uid, ids)
+        return jsonify({"ok": True, "portfolios": [perf[aid] for aid in ids if aid in perf]}), 200
+    except Exception as e:
+        app.logger.exception("❌ /api/portfolios/performance failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        s.close()
+
+@app.route("/api/portfolios/<int:asset_id>/performance", methods=["GET"])
+@jwt_required()
+def portfolio_performance_one(asset_id):
+    """TWR / MWR d'un portefeuille et de ses lignes (mêmes params que /api/portfolios/performance)."""
+    uid = int(get_jwt_identity())
+    s = Session()
+    try:
+        asset = ensure_user_asset(s, uid, asset_id)
+        if not asset or asset.type != "portfolio":
+            return jsonify({"ok": False, "error": "portfolio not found"}), 404
+        perf = _performance_for(s, uid, [asset_id])
+        return jsonify({"ok": True, **perf[asset_id]}), 200
+    except Exception as e:
+        app.logger.exception("❌ /api/portfolios/<id>/performance failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        s.close()
+
+@app.route("/api/portfolios/<int:asset_id>/lots", methods=["GET"])
+@jwt_required()
+def portfolio_lots(asset_id):
+    """
+    Lots et plus / moins-values d'un portefeuille, dérivés des trades (moteur : lot_engine.py).
+    Query params (optionnels): method=fifo|average (défaut fifo), lots=1 (détail des lots FIFO ouverts).
+    Réalisé par année civile, latent à la dernière clôture connue ; broker_avg_price = PRU importé.
+    """
+    uid = int(get_jwt_identity())
+    method = (request.args.get("method") or "fifo").strip().lower()
+    if method not in LOT_METHODS:
+        return jsonify({"ok": False, "error": f"method must be one of {', '.join(LOT_METHODS)}"}), 400
+    s = Session()
+    try:
+        asset = ensure_user_asset(s, uid, asset_id)
+        if not asset or asset.type != "portfolio":
+            return jsonify({"ok": False, "error": "portfolio not found"}), 404
+        rows = update_lots(s, asset_id)
+        lines = lots_summary(rows, latest_closes(s, rows.keys()), method,
+                             with_lots=request.args.get("lots") in ("1", "true"))
+        broker = {(ln.isin or "").strip().upper(): ln for ln in (asset.portfolio.lines if asset.portfolio else [])}
+        realized_by_year = {}
+        for ln in lines:
+            pl = broker.get(ln["isin"])
+            ln["line_id"] = pl.id if pl else None
+            ln["broker_avg_price"] = float(pl.avg_price) if pl is not None and pl.avg_price is not None else None
+            for y, v in ln["realized_by_year"].items():
+                realized_by_year[y] = round(realized_by_year.get(y, 0.0) + v, 2)
+        return jsonify({
+            "ok": True,
+            "asset_id": asset_id,
+            "method": method,
+            "realized_by_year": dict(sorted(realized_by_year.items())),
+            "realized_total": round(sum(ln["realized_total"] for ln in lines), 2),
+            "unrealized": round(sum(ln["unrealized"] or 0.0 for ln in lines), 2),
+            "lines": lines,
+        }), 200
+    except Exception as e:
+        s.rollback()
+        app.logger.exception("❌ /api/portfolios/<id>/lots failed")
         return jsonify({"ok": False, "error": str(e)}), 500
     finally:
         s.close()
@@ -0,0 +1,291 @@
+# bench_projection.py
+"""
+Benchmark du moteur de projection sur des patrimoines synthétiques.
+
+Génère un utilisateur par taille (livrets, portefeuilles avec lignes, biens immo
+avec plusieurs ImmoLoan / ImmoExpense, autres actifs, revenus, dépenses), puis
+chronomètre pour chaque (nb d'actifs, mois) :
+  - load_state() (lecture base)
+  - simulate() à un point et sur une grille de G points (sweep)
+  - simulate_incremental() à froid (cache vidé) et à chaud
+  - projection_payload() + sérialisation JSON
+et mesure le pic mémoire (tracemalloc) d'une projection complète.
+
+Usage :
+  python bench_projection.py                                   # SQLite en mémoire
+  python bench_projection.py --db postgresql://localhost/patrimoine_bench
+  python bench_projection.py --scales 1,10,50 --months 120,360 --json bench.jsonl
+  python bench_projection.py --amortization 10000                # 10k prêts × 300 mois
+
+--json ajoute une ligne par exécution (suivi dans le temps). Les utilisateurs
+générés (email *@bench.invalid) sont supprimés en fin d'exécution sauf --keep.
+"""
+import os, sys, time, random, argparse, tracemalloc, json
+from datetime import date, datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.dialects.postgresql import JSONB
+from models import (
+    Base, User, Beneficiary, Asset, AssetLivret, AssetImmo, ImmoLoan, ImmoExpense,
+    AssetPortfolio, PortfolioProduct, PortfolioLine, AssetOther, UserIncome, UserExpense,
+)
+import numpy as np
+import projection_engine as pe
+import rrule_engine
+import utils
+
+
+@compiles(JSONB, "sqlite")
+def _jsonb_sqlite(type_, compiler, **kw):
+    # SQLite n'a pas JSONB : le benchmark n'utilise que la colonne, pas les opérateurs
+    return "JSON"
+
+# composition d'un utilisateur à l'échelle 1 (multipliée par --scales)
+PROFILE = {
+    "livrets": 3, "portfolios": 2, "lines": 5, "immo": 1, "loans": 2, "immo_expenses": 3,
+    "others": 1, "incomes": 2, "expenses": 4,
+}
+BENCH_DOMAIN = "bench.invalid"
+
+
+# ---------------------------------------------------------
+# Générateur
+# ---------------------------------------------------------
+def generate_user(s, rnd: random.Random, profile: dict, scale: int = 1) -> int:
+    """Insère un utilisateur synthétique ; renvoie son id. Les compteurs d'actifs sont multipliés par `scale`."""
+    user = User(email=f"{rnd.getrandbits(64):x}@{BENCH_DOMAIN}", password_hash="x", fullname="Bench")
+    s.add(user); s.flush()
+    benes = [Beneficiary(user_id=user.id, fullname=f"Bénéficiaire {i}") for i in range(2)]
+    s.add_all(benes); s.flush()
+    bene_ids = [None] + [b.id for b in benes]
+
+    def asset(type_, label, **kw):
+        a = Asset(user_id=user.id, type=type_, label=label, beneficiary_id=rnd.choice(bene_ids), **kw)
+        s.add(a); s.flush()
+        return a
+
+    for i in range(profile["livrets"] * scale):
+        a = asset("livret", f"Livret {i}")
+        s.add(AssetLivret(asset_id=a.id, balance=rnd.randint(0, 22950),
+                          recurring_amount=rnd.choice([0, 50, 100, 300]),
+                          recurring_frequency=rnd.choice(["mensuel", "trimestriel", "annuel"]), recurring_day=1))
+
+    for i in range(profile["portfolios"] * scale):
+        a = asset("portfolio", f"Portefeuille {i}", current_value=rnd.randint(1000, 150000))
+        pf = AssetPortfolio(asset_id=a.id, broker="Bench", recurring_amount=rnd.choice([0, 100, 500]),
+                            recurring_frequency="mensuel")
+        s.add(pf); s.flush()
+        prods = [PortfolioProduct(portfolio_id=pf.id, product_type=t)
+                 for t in rnd.sample(["PEA", "CTO", "AV", "PER"], rnd.randint(1, 2))]
+        s.add_all(prods); s.flush()
+        for k in range(profile["lines"]):
+            s.add(PortfolioLine(portfolio_id=pf.id, isin=f"FR{rnd.randint(0, 10**10 - 1):010d}", label=f"Ligne {k}",
+                                units=rnd.randint(1, 200), avg_price=rnd.uniform(10, 400),
+                                amount_allocated=rnd.choice([0, 50, 150]), allocation_frequency="mensuel",
+                                product_id=rnd.choice(prods).id, beneficiary_id=rnd.choice(bene_ids)))
+
+    for i in range(profile["immo"] * scale):
+        a = asset("immo", f"Bien {i}")
+        im = AssetImmo(asset_id=a.id, purchase_price=rnd.randint(120000, 600000), insurance_monthly=rnd.randint(10, 60),
+                       rental_income=rnd.choice([0, 650, 1100]), ownership_percentage=rnd.choice([50, 100]))
+        s.add(im); s.flush()
+        for k in range(profile["loans"]):
+            s.add(ImmoLoan(immo_id=im.id, loan_amount=rnd.randint(30000, 300000), loan_rate=rnd.choice([1.1, 2.4, 3.9]),
+                           loan_duration_months=rnd.choice([180, 240, 300]),
+                           loan_start_date=date(rnd.randint(2015, 2025), rnd.randint(1, 12), rnd.randint(1, 28))))
+        for k in range(profile["immo_expenses"]):
+            s.add(ImmoExpense(immo_id=im.id, expense_type=rnd.choice(["taxe_fonciere", "copro", "entretien"]),
+                              amount=rnd.randint(20, 1800), frequency=rnd.choice(["mensuel", "annuel"])))
+
+    for i in range(profile["others"] * scale):
+        a = asset("other", f"Autre {i}", current_value=rnd.randint(500, 20000))
+        s.add(AssetOther(asset_id=a.id, category="or", estimated_value=rnd.randint(500, 20000)))
+
+    for i in range(profile["incomes"]):
+        s.add(UserIncome(user_id=user.id, label=f"Revenu {i}", amount=rnd.randint(500, 4000),
+                         frequency=rnd.choice(["mensuel", "annuel"]),
+                         end_date=rnd.choice([None, date(rnd.randint(2030, 2050), 1, 1)])))
+    for i in range(profile["expenses"]):
+        s.add(UserExpense(user_id=user.id, label=f"Dépense {i}", amount=rnd.randint(20, 1200), frequency="mensuel"))
+
+    s.commit()
+    return user.id
+
+def cleanup(s):
+    """Supprime les utilisateurs générés (revenus / dépenses n'ont pas de FK vers users)."""
+    ids = [uid for (uid,) in s.query(User.id).filter(User.email.like(f"%@{BENCH_DOMAIN}")).all()]
+    if ids:
+        s.query(UserIncome).filter(UserIncome.user_id.in_(ids)).delete(synchronize_session=False)
+        s.query(UserExpense).filter(UserExpense.user_id.in_(ids)).delete(synchronize_session=False)
+        s.query(User).filter(User.id.in_(ids)).delete(synchronize_session=False)
+        s.commit()
+    return len(ids)
+
+
+# ---------------------------------------------------------
+# Mesures
+# ---------------------------------------------------------
+def timeit(fn, min_time: float = 0.5, max_runs: int = 10000) -> dict:
+    """Répète `fn` pendant au moins `min_time` secondes -> {runs, mean_ms, ops_s}."""
+    runs, t0 = 0, time.perf_counter()
+    while True:
+        fn()
+        runs += 1
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time or runs >= max_runs:
+            break
+    return {"runs": runs, "mean_ms": round(elapsed / runs * 1000, 3), "ops_s": round(runs / elapsed, 1)}
+
+def peak_kib(fn) -> float:
+    """Pic d'allocation Python + NumPy (tracemalloc) pendant `fn`."""
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+def clear_caches():
+    pe._series_cache.clear()
+    rrule_engine._expansion_cache.clear()
+
+def bench_user(Session, uid: int, start, months: int, grid: int, min_time: float) -> dict:
+    params = pe.default_params(start)
+    params["months"] = months
+    rates = params["rates"]
+    grid_rates = {**rates, "portfolio_apy": [rates["portfolio_apy"] + 0.001 * i for i in range(grid)]}
+
+    s = Session()
+    try:
+        load = timeit(lambda: pe.load_state(s, uid, start), min_time)
+        state = pe.load_state(s, uid, start)
+    finally:
+        s.close()
+
+    def cold():
+        clear_caches()
+        pe.simulate_incremental(state, start, months, rates)
+
+    def full():
+        clear_caches()
+        sim = pe.simulate_incremental(state, start, months, rates)
+        json.dumps(pe.projection_payload(state, sim, params))
+
+    sim = pe.simulate_incremental(state, start, months, rates)
+    n_assets = sum(len(state[k]) for k in ("livrets", "portfolios", "immo", "others"))
+    return {
+        "assets": n_assets,
+        "loans": sum(len(im["loans"]) for im in state["immo"]),
+        "months": months,
+        "load_state": load,
+        "simulate": timeit(lambda: pe.simulate(state, start, months, rates), min_time),
+        "sweep": {**timeit(lambda: pe.simulate(state, start, months, grid_rates), min_time), "points": grid},
+        "incremental_cold": timeit(cold, min_time),
+        "incremental_warm": timeit(lambda: pe.simulate_incremental(state, start, months, rates), min_time),
+        "payload": timeit(lambda: json.dumps(pe.projection_payload(state, sim, params)), min_time),
+        "peak_kib": peak_kib(full),
+    }
+
+def bench_amortization(n_loans: int, months: int, min_time: float, sample: int = 200) -> dict:
+    """
+    utils.amortization_batch sur n_loans × months vs amortization_schedule prêt par prêt
+    (mesuré sur `sample` prêts puis extrapolé à n_loans).
+    """
+    rng = np.random.default_rng(1)
+    principal = rng.uniform(30000, 400000, n_loans)
+    rate = rng.choice([0.0, 1.1, 2.4, 3.9], n_loans)
+    duration = np.full(n_loans, months)
+    batch = timeit(lambda: utils.amortization_batch(principal, rate, duration), min_time)
+    loop = timeit(lambda: [utils.amortization_schedule(p, r, months) for p, r in zip(principal[:sample], rate[:sample])],
+                  min_time)
+    loop_ms = loop["mean_ms"] * n_loans / sample
+    return {
+        "loans": n_loans, "months": months,
+        "batch": batch,
+        "batch_peak_kib": peak_kib(lambda: utils.amortization_batch(principal, rate, duration)),
+        "per_loan_ms_extrapolated": round(loop_ms, 1),
+        "speedup": round(loop_ms / batch["mean_ms"], 1),
+    }
+
+def print_table(rows: list[dict]):
+    cols = [("assets", lambda r: r["assets"]), ("months", lambda r: r["months"]),
+            ("load ms", lambda r: r["load_state"]["mean_ms"]),
+            ("sim ops/s", lambda r: r["simulate"]["ops_s"]),
+            ("sweep pts/s", lambda r: round(r["sweep"]["ops_s"] * r["sweep"]["points"])),
+            ("cold ms", lambda r: r["incremental_cold"]["mean_ms"]),
+            ("warm ops/s", lambda r: r["incremental_warm"]["ops_s"]),
+            ("payload ms", lambda r: r["payload"]["mean_ms"]),
+            ("peak KiB", lambda r: r["peak_kib"])]
+    print("  ".join(f"{name:>11}" for name, _ in cols))
+    for r in rows:
+        print("  ".join(f"{get(r):>11}" for _, get in cols))
+
+def parse_ints(v: str) -> list[int]:
+    return [int(x) for x in v.split(",") if x.strip()]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=os.getenv("BENCH_DATABASE_URL", "sqlite://"),
+                        help="URL SQLAlchemy (défaut: SQLite en mémoire)")
+    parser.add_argument("--scales", default="1,4,16", help="multiplicateurs du nombre d'actifs")
+    parser.add_argument("--months", default="120,360,600")
+    parser.add_argument("--grid", type=int, default=64, help="points de la grille du sweep")
+    parser.add_argument("--min-time", type=float, default=0.5, help="durée minimale par mesure (s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="fichier JSONL où ajouter les résultats")
+    parser.add_argument("--keep", action="store_true", help="conserve les utilisateurs générés")
+    parser.add_argument("--amortization", type=int, metavar="N",
+                        help="benchmark utils.amortization_batch seul sur N prêts (ex: 10000)")
+    parser.add_argument("--amortization-months", type=int, default=300)
+    for k, v in PROFILE.items():
+        parser.add_argument(f"--{k.replace('_', '-')}", type=int, default=v, dest=k)
+    args = parser.parse_args()
+
+    if args.amortization:
+        res = bench_amortization(args.amortization, args.amortization_months, args.min_time)
+        print(f"amortization_batch {res['loans']} prêts × {res['months']} mois : {res['batch']['mean_ms']} ms "
+              f"(pic {res['batch_peak_kib']} KiB) ; amortization_schedule prêt par prêt ≈ "
+              f"{res['per_loan_ms_extrapolated']} ms ; x{res['speedup']}")
+        if args.json:
+            with open(args.json, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"at": datetime.utcnow().isoformat(timespec="seconds"),
+                                    "python": sys.version.split()[0], "amortization": res}) + "\n")
+        return
+
+    profile = {k: getattr(args, k) for k in PROFILE}
+    engine = create_engine(args.db, future=True)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+    rnd = random.Random(args.seed)
+    start = pe.first_of_month(datetime.utcnow().date())
+
+    rows = []
+    s = Session()
+    try:
+        users = {scale: generate_user(s, rnd, profile, scale) for scale in parse_ints(args.scales)}
+    finally:
+        s.close()
+    try:
+        for scale, uid in users.items():
+            for months in parse_ints(args.months):
+                rows.append({"scale": scale, **bench_user(Session, uid, start, months, args.grid, args.min_time)})
+    finally:
+        if not args.keep:
+            s = Session()
+            try:
+                cleanup(s)
+            finally:
+                s.close()
+
+    print(f"db={engine.url.get_backend_name()} profile={profile}")
+    print_table(rows)
+    if args.json:
+        with open(args.json, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"at": datetime.utcnow().isoformat(timespec="seconds"),
+                                "db": engine.url.get_backend_name(), "profile": profile,
+                                "python": sys.version.split()[0], "results": rows}) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 # db_init.py
 from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 from models import Base
+from sqlalchemy import text as sqltext
+from partitions import PARTITIONED, ensure_default_partitions, is_partitioned, migrate
 import os
 from dotenv import load_dotenv
 
@@ -13,4 +16,23 @@ if not DATABASE_URL:
 engine = create_engine(DATABASE_URL, echo=True, future=True)
 print("Creating all tables...")
 Base.metadata.create_all(bind=engine)
+# produits_histo / produits_intraday : create_all crée des tables simples (schéma portable,
+# SQLite compris) ; sous Postgres, bascule en tables partitionnées si elles sont vides,
+# sinon `python partitions.py migrate` (copie) ; puis partitions courantes et à venir
+s = sessionmaker(bind=engine)()
+try:
+    if engine.dialect.name == "postgresql":
+        for table in PARTITIONED:
+            if is_partitioned(s, table):
+                continue
+            if s.execute(sqltext(f"SELECT 1 FROM {table} LIMIT 1")).first() is None:
+                print(migrate(s, table, drop_legacy=True))
+            else:
+                print(f"{table}: non partitionnée, lancer `python partitions.py migrate --table {table}`")
+        print(ensure_default_partitions(s))
+        # colonnes ajoutées après la création de la table (create_all ne modifie pas l'existant)
+        s.execute(sqltext("ALTER TABLE net_worth_history_state ADD COLUMN IF NOT EXISTS cash_anchor JSONB"))
+        s.commit()
+finally:
+    s.close()
 print("Done.")
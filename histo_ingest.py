@@ -0,0 +1,361 @@
+# histo_ingest.py
+"""
+Batch nuit : historique OHLCV journalier des produits (produits_histo) pour
+tous les ProduitInvest ayant un ticker_yahoo.
+
+- filigrane par produit (produits_histo_state.last_date) : seules les séances
+  postérieures sont demandées ; sans filigrane, reprise sur HISTO_BACKFILL_YEARS ans
+- produit sans filigrane dont le dernier passage (checked_at) n'a rien rapporté
+  ou a échoué (error) : ignoré pendant HISTO_RETRY_DAYS jours (ticker radié ou
+  erroné), au lieu d'un rattrapage complet chaque nuit
+- produits groupés par date de reprise, puis par paquets de --batch-size tickers :
+  une requête multi-tickers par paquet, paquets téléchargés dans un pool de
+  threads avec limite de débit (--rate requêtes / seconde)
+- écriture par paquet : COPY dans une table temporaire puis INSERT ... ON CONFLICT
+  (produit_id, date) -> rejouer un jour est idempotent ; les lignes identiques ne
+  sont pas réécrites
+- puis indicateurs techniques des nouvelles séances (indicators_engine.refresh_indicators,
+  incrémental, pool de processus)
+- enfin reconstruction du magasin de clôtures mappé en mémoire (price_store.build)
+- source interchangeable : "yahoo" (yfinance) ou un fichier CSV / Parquet au
+  format long (ticker, date, open, high, low, close, volume) pour les tests
+
+Usage : python histo_ingest.py [--date YYYY-MM-DD] [--source yahoo|FICHIER] [--batch-size 50]
+                               [--workers 4] [--rate 1] [--skip-indicators]
+                               [--skip-price-store] [--verbose]
+"""
+import os, sys, time, argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+import pandas as pd
+from sqlalchemy import create_engine, func
+from sqlalchemy import text as sqltext
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import sessionmaker
+from models import ProduitInvest, ProduitHisto, ProduitHistoState
+from indicators_engine import refresh_indicators
+from partitions import ensure_partitions
+import price_store
+from utils import RateLimiter, copy_dataframe
+import json
+
+DB_URL = os.environ["DATABASE_URL"]
+engine = create_engine(DB_URL, future=True, poolclass=NullPool)
+Session = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+JOB_NAME = "histo-ohlcv"
+
+BACKFILL_YEARS = int(os.getenv("HISTO_BACKFILL_YEARS", "10"))
+RETRY_DAYS = float(os.getenv("HISTO_RETRY_DAYS", "7"))
+BATCH_START_SLACK_DAYS = 7   # filigranes proches regroupés (quelques séances re-téléchargées, filtrées)
+OHLCV_COLUMNS = ["ticker", "date", "open", "high", "low", "close", "volume"]
+
+# contrainte déclarée dans models.py ; créée ici pour les bases antérieures
+# (doublons éventuels supprimés d'abord, la ligne la plus récente est gardée)
+UNIQUE_INDEX_SQL = """
+    DELETE FROM produits_histo a USING produits_histo b
+    WHERE a.produit_id = b.produit_id AND a.date = b.date AND a.id < b.id;
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_produits_histo_produit_date ON produits_histo (produit_id, date);
+"""
+
+STAGING_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS stg_histo (
+        produit_id integer, date date, open double precision, high double precision,
+        low double precision, close double precision, volume bigint
+    ) ON COMMIT DELETE ROWS
+"""
+
+UPSERT_SQL = sqltext("""
+    INSERT INTO produits_histo (produit_id, date, open, high, low, close, volume)
+    SELECT produit_id, date, open, high, low, close, volume FROM stg_histo
+    ON CONFLICT (produit_id, date) DO UPDATE SET
+        open = EXCLUDED.open,
+        high = EXCLUDED.high,
+        low = EXCLUDED.low,
+        close = EXCLUDED.close,
+        volume = EXCLUDED.volume
+    WHERE (produits_histo.open, produits_histo.high, produits_histo.low, produits_histo.close, produits_histo.volume)
+          IS DISTINCT FROM (EXCLUDED.open, EXCLUDED.high, EXCLUDED.low, EXCLUDED.close, EXCLUDED.volume)
+""")
+
+STATE_SQL = sqltext("""
+    INSERT INTO produits_histo_state (produit_id, last_date, checked_at, error)
+    VALUES (:produit_id, :last_date, :checked_at, :error)
+    ON CONFLICT (produit_id) DO UPDATE SET
+        last_date = GREATEST(produits_histo_state.last_date, EXCLUDED.last_date),
+        checked_at = EXCLUDED.checked_at,
+        error = EXCLUDED.error
+""")
+
+
+# ---------------------------------------------------------
+# Sources : fetch(tickers, start, end) -> DataFrame long OHLCV_COLUMNS (end inclus)
+# ---------------------------------------------------------
+def yahoo_source(tickers: list[str], start: date, end: date) -> pd.DataFrame:
+    """Une requête yfinance multi-tickers (cours non ajustés, comme TR)."""
+    import yfinance as yf
+    wide = yf.download(tickers, start=start.isoformat(), end=(end + timedelta(days=1)).isoformat(),
+                       interval="1d", group_by="ticker", auto_adjust=False, actions=False,
+                       threads=False, progress=False)
+    if wide is None or wide.empty:
+        return pd.DataFrame(columns=OHLCV_COLUMNS)
+    if not isinstance(wide.columns, pd.MultiIndex):
+        wide.columns = pd.MultiIndex.from_product([tickers[:1], wide.columns])
+    long = wide.stack(level=0, future_stack=True).reset_index()
+    long.columns = ["date", "ticker", *[str(c).lower() for c in long.columns[2:]]]
+    long["date"] = pd.to_datetime(long["date"]).dt.date
+    return long.reindex(columns=OHLCV_COLUMNS)
+
+def file_source(path: str):
+    """Source locale (tests, rejeu) : fichier CSV / Parquet au format long, lu une fois."""
+    df = pd.read_csv(path) if path.endswith(".csv") else pd.read_parquet(path)
+    df = df.rename(columns=str.lower).reindex(columns=OHLCV_COLUMNS)
+    df["date"] = pd.to_datetime(df["date"]).dt.date
+
+    def fetch(tickers: list[str], start: date, end: date) -> pd.DataFrame:
+        return df[df["ticker"].isin(tickers) & (df["date"] >= start) & (df["date"] <= end)]
+    return fetch
+
+def make_source(spec: str):
+    return yahoo_source if spec == "yahoo" else file_source(spec)
+
+
+# ---------------------------------------------------------
+# Planification
+# ---------------------------------------------------------
+def load_targets(session, until: date) -> tuple[list[dict], list[dict]]:
+    """
+    (produits avec ticker et leur filigrane (état, sinon dernière séance en base),
+    produits sans filigrane mis en attente après un passage vide ou en erreur).
+    """
+    last_histo = (session.query(func.max(ProduitHisto.date))
+                  .filter(ProduitHisto.produit_id == ProduitInvest.id)
+                  .correlate(ProduitInvest).scalar_subquery())
+    rows = (session.query(ProduitInvest.id, ProduitInvest.ticker_yahoo,
+                          func.coalesce(ProduitHistoState.last_date, last_histo),
+                          ProduitHistoState.checked_at, ProduitHistoState.error)
+            .outerjoin(ProduitHistoState, ProduitHistoState.produit_id == ProduitInvest.id)
+            .filter(ProduitInvest.ticker_yahoo.isnot(None), ProduitInvest.ticker_yahoo != "")
+            .order_by(ProduitInvest.id).all())
+    backfill = until - timedelta(days=int(BACKFILL_YEARS * 365.25))
+    retry_after = datetime.utcnow() - timedelta(days=RETRY_DAYS)
+    out, waiting = [], []
+    for pid, ticker, last, checked_at, error in rows:
+        if last is None and checked_at is not None and checked_at > retry_after:
+            waiting.append({"produit_id": pid, "ticker": ticker.strip(), "checked_at": checked_at, "error": error})
+            continue
+        start = last + timedelta(days=1) if last else backfill
+        if start <= until:
+            out.append({"produit_id": pid, "ticker": ticker.strip(), "last_date": last, "start": start})
+    return out, waiting
+
+def plan_batches(targets: list[dict], batch_size: int) -> list[list[dict]]:
+    """
+    Paquets de tickers de dates de reprise proches (le cas courant : tous à J-1) ;
+    un paquet est téléchargé depuis sa plus ancienne date de reprise.
+    """
+    targets = sorted(targets, key=lambda t: (t["start"], t["produit_id"]))
+    slack = timedelta(days=BATCH_START_SLACK_DAYS)
+    batches = []
+    for t in targets:
+        if batches and len(batches[-1]) < batch_size and t["start"] - batches[-1][0]["start"] <= slack:
+            batches[-1].append(t)
+        else:
+            batches.append([t])
+    return batches
+
+def fetch_batch(source, limiter: RateLimiter, batch: list[dict], until: date) -> pd.DataFrame:
+    """Télécharge un paquet ; retourne les barres (produit_id, date, OHLCV) après filigrane."""
+    limiter.wait()
+    tickers = sorted({t["ticker"] for t in batch})
+    raw = source(tickers, batch[0]["start"], until)
+    targets = pd.DataFrame([{"ticker": t["ticker"], "produit_id": t["produit_id"], "start": t["start"]}
+                            for t in batch])
+    df = raw.merge(targets, on="ticker")
+    df = df[(df["date"] >= df["start"]) & (df["date"] <= until) & df["close"].notna()]
+    df = df.drop_duplicates(["produit_id", "date"], keep="last")
+    df = df.assign(volume=pd.to_numeric(df["volume"], errors="coerce").round().astype("Int64"))
+    return df[["produit_id", "date", "open", "high", "low", "close", "volume"]]
+
+
+# ---------------------------------------------------------
+# Écriture
+# ---------------------------------------------------------
+def ensure_unique_index(session):
+    exists = session.execute(sqltext(
+        "SELECT 1 FROM pg_indexes WHERE indexname = 'uq_produits_histo_produit_date'")).first()
+    if not exists:
+        session.connection().exec_driver_sql(UNIQUE_INDEX_SQL)
+        session.commit()
+
+def write_batch(session, batch: list[dict], bars: pd.DataFrame, error: str | None = None) -> int:
+    """COPY + upsert des barres d'un paquet et mise à jour des filigranes, une transaction."""
+    conn = session.connection()
+    written = 0
+    if len(bars):
+        conn.exec_driver_sql(STAGING_SQL)
+        copy_dataframe(conn, "stg_histo", bars)
+        written = conn.execute(UPSERT_SQL).rowcount
+    last = bars.groupby("produit_id")["date"].max().to_dict() if len(bars) else {}
+    now = datetime.utcnow()
+    session.execute(STATE_SQL, [{"produit_id": t["produit_id"], "last_date": last.get(t["produit_id"]),
+                                 "checked_at": now, "error": error} for t in batch])
+    session.commit()
+    return written
+
+def run_ingest(until: date, source, batch_size: int = 50, workers: int = 4, rate: float = 1.0,
+               verbose: bool = False):
+    stats = {"inserted": 0, "skipped": 0, "failed": 0, "produits": 0, "batches": 0, "waiting": 0, "details": []}
+    s = Session()
+    try:
+        ensure_unique_index(s)
+        targets, waiting = load_targets(s, until)
+        stats["waiting"] = len(waiting)
+        if verbose and waiting:
+            print(f"{len(waiting)} produits sans historique en attente ({RETRY_DAYS:g} j) : "
+                  + ", ".join(f"{w['ticker']} ({w['error'] or 'vide'})" for w in waiting[:10]))
+        batches = plan_batches(targets, batch_size)
+        # partitions annuelles couvrant les séances à charger (rattrapage compris)
+        if targets:
+            ensure_partitions(s, "produits_histo", min(t["start"] for t in targets), until)
+        stats["produits"], stats["batches"] = len(targets), len(batches)
+        limiter = RateLimiter(rate)
+        # téléchargements concurrents, écritures séquentielles sur la session du thread principal
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            futures = {pool.submit(fetch_batch, source, limiter, b, until): b for b in batches}
+            for fut in as_completed(futures):
+                batch = futures[fut]
+                try:
+                    bars = fut.result()
+                except Exception as e:
+                    s.rollback()
+                    write_batch(s, batch, pd.DataFrame(), error=str(e)[:500])
+                    stats["failed"] += len(batch)
+                    stats["details"].append({"tickers": [t["ticker"] for t in batch][:5], "error": str(e)[:200]})
+                    continue
+                written = write_batch(s, batch, bars)
+                updated = bars["produit_id"].nunique() if len(bars) else 0
+                stats["inserted"] += written
+                stats["skipped"] += len(batch) - updated
+                if verbose:
+                    print(f"{batch[0]['start']} : {len(batch)} tickers, {len(bars)} barres, {written} écrites")
+        return True, stats
+    except Exception as e:
+        s.rollback()
+        return False, {"error": str(e), **stats}
+    finally:
+        s.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--date", help="dernière séance chargée, YYYY-MM-DD (par défaut: hier UTC)")
+    parser.add_argument("--source", default=os.getenv("HISTO_SOURCE", "yahoo"),
+                        help="yahoo, ou fichier CSV / Parquet (ticker, date, open, high, low, close, volume)")
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("HISTO_BATCH_SIZE", "50")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("HISTO_WORKERS", "4")))
+    parser.add_argument("--rate", type=float, default=float(os.getenv("HISTO_RATE", "1")),
+                        help="requêtes par seconde vers la source")
+    parser.add_argument("--skip-indicators", action="store_true", help="ne met pas à jour produits_indicateurs")
+    parser.add_argument("--full-indicators", action="store_true", help="recalcule tous les indicateurs")
+    parser.add_argument("--skip-price-store", action="store_true", help="ne reconstruit pas le magasin de prix mappé")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    until = (datetime.utcnow().date() - timedelta(days=1)) if not args.date else date.fromisoformat(args.date)
+
+    # 1) job_runs: running
+    s = Session()
+    try:
+        run_id = s.execute(
+            sqltext("""
+                INSERT INTO job_runs (job_name, run_date, started_at, state)
+                VALUES (:name, :run_date, now(), 'running')
+                RETURNING id
+            """),
+            {"name": JOB_NAME, "run_date": until}
+        ).scalar_one()
+        s.commit()
+    except:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+    # 2) run
+    t0 = time.perf_counter()
+    ok, stats = run_ingest(until, make_source(args.source), batch_size=args.batch_size,
+                           workers=args.workers, rate=args.rate, verbose=args.verbose)
+    indicators = None
+    if not args.skip_indicators:
+        s = Session()
+        try:
+            indicators = refresh_indicators(s, full=args.full_indicators, verbose=args.verbose)
+        except Exception as e:
+            s.rollback()
+            indicators = {"error": str(e)[:200]}
+        finally:
+            s.close()
+    store = None
+    if ok and not args.skip_price_store and price_store.ENABLED:
+        s = Session()
+        try:
+            os.makedirs(price_store.STORE_DIR, exist_ok=True)
+            store = price_store.build(s, verbose=args.verbose)
+        except Exception as e:
+            s.rollback()
+            store = {"error": str(e)[:200]}
+        finally:
+            s.close()
+    elapsed = round(time.perf_counter() - t0, 1)
+
+    # 3) job_runs: finalize
+    s = Session()
+    try:
+        msg_obj = {"stats": {"bars_written": stats.get("inserted", 0),
+                             "produits": stats.get("produits", 0),
+                             "produits_up_to_date": stats.get("skipped", 0),
+                             "batches": stats.get("batches", 0),
+                             "failed": stats.get("failed", 0),
+                             "waiting_retry": stats.get("waiting", 0),
+                             "seconds": elapsed},
+                   "source": args.source,
+                   "indicators": indicators,
+                   "price_store": store and {k: store.get(k) for k in ("version", "rows", "last_date", "error") if k in store},
+                   "details": stats.get("details", [])[:20]}
+        if "error" in stats:
+            msg_obj["error"] = stats["error"]
+        msg = json.dumps(msg_obj, ensure_ascii=False)[:1000]
+
+        s.execute(
+            sqltext("""
+                UPDATE job_runs
+                SET finished_at = now(),
+                    state        = :state,
+                    ok           = :ok,
+                    items_inserted = :ins,
+                    items_skipped  = :skp,
+                    items_failed   = :fld,
+                    message        = :msg
+                WHERE id = :id
+            """),
+            {
+                "state": "done" if ok else "error",
+                "ok": bool(ok),
+                "ins": int(stats.get("inserted", 0)),
+                "skp": int(stats.get("skipped", 0)),
+                "fld": int(stats.get("failed", 0)),
+                "msg": msg,
+                "id": run_id
+            }
+        )
+        s.commit()
+    except:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+    print(("OK" if ok else "ERROR"), {k: v for k, v in stats.items() if k != "details"}, f"{elapsed}s")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
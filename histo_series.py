@@ -0,0 +1,185 @@
+# histo_series.py
+"""
+Séries de cours journaliers (produits_histo) pour les graphiques.
+
+- aggregate_sql() : agrégation calendaire OHLCV en SQL (semaine ISO / mois ;
+  ouverture = 1re séance, clôture = dernière, plus haut / bas, volume cumulé)
+- lttb() : sous-échantillonnage Largest-Triangle-Three-Buckets des clôtures
+  (conserve la forme de la courbe : premier / dernier point, pics et creux)
+- columnar() : réponse en colonnes parallèles (t en secondes epoch UTC, un
+  tableau par champ, None pour les valeurs absentes) au lieu d'une liste d'objets
+- load_many() / align() : plusieurs produits en une requête triée (produit, date),
+  puis alignement optionnel sur un index de dates commun (report de la dernière valeur)
+- from_store() : mêmes séries lues dans le magasin mappé (price_store) quand seuls
+  close / volume sont demandés ; les produits absents du magasin passent par Postgres
+"""
+from datetime import date
+
+import numpy as np
+from sqlalchemy import text as sqltext
+
+from models import ProduitHisto
+
+INTERVALS = ("day", "week", "month")
+OHLCV = ("open", "high", "low", "close", "volume")
+STORE_FIELDS = ("close", "volume")      # colonnes du magasin de prix
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+AGGREGATE_SQL = """
+    SELECT date_trunc(:unit, date::timestamp)::date AS bucket,
+           (array_agg(open ORDER BY date) FILTER (WHERE open IS NOT NULL))[1],
+           max(high), min(low),
+           (array_agg(close ORDER BY date DESC) FILTER (WHERE close IS NOT NULL))[1],
+           sum(volume)
+    FROM produits_histo
+    WHERE produit_id = :pid {where}
+    GROUP BY bucket
+    ORDER BY bucket
+"""
+
+
+def load_daily(session, pid: int, dfrom: date | None = None, dto: date | None = None) -> dict:
+    """Séances [dfrom, dto] d'un produit -> {"day": jours ordinaux int64, champ: float64 (NaN si nul)}."""
+    q = (session.query(ProduitHisto.date, ProduitHisto.open, ProduitHisto.high, ProduitHisto.low,
+                       ProduitHisto.close, ProduitHisto.volume)
+         .filter(ProduitHisto.produit_id == pid))
+    if dfrom:
+        q = q.filter(ProduitHisto.date >= dfrom)
+    if dto:
+        q = q.filter(ProduitHisto.date <= dto)
+    return _frame(q.order_by(ProduitHisto.date).all())
+
+def load_many(session, ids: list[int], dfrom: date | None = None, dto: date | None = None,
+              fields: tuple = OHLCV) -> dict:
+    """Séances de plusieurs produits en une requête, découpées par produit -> {produit_id: série}."""
+    q = (session.query(ProduitHisto.produit_id, ProduitHisto.date,
+                       *[getattr(ProduitHisto, f) for f in fields])
+         .filter(ProduitHisto.produit_id.in_(ids)))
+    if dfrom:
+        q = q.filter(ProduitHisto.date >= dfrom)
+    if dto:
+        q = q.filter(ProduitHisto.date <= dto)
+    rows = q.order_by(ProduitHisto.produit_id, ProduitHisto.date).all()
+    n = len(rows)
+    pids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+    days = np.fromiter((r[1].toordinal() for r in rows), dtype=np.int64, count=n)
+    cols = {f: np.fromiter((np.nan if r[k] is None else float(r[k]) for r in rows), dtype=float, count=n)
+            for k, f in enumerate(fields, start=2)}
+    starts = np.flatnonzero(np.r_[True, pids[1:] != pids[:-1]]) if n else np.zeros(0, dtype=np.int64)
+    ends = np.r_[starts[1:], n]
+    return {int(pids[a]): {"day": days[a:b], **{f: c[a:b] for f, c in cols.items()}}
+            for a, b in zip(starts.tolist(), ends.tolist())}
+
+def from_store(store, ids: list[int], dfrom: date | None = None, dto: date | None = None) -> tuple[dict, list]:
+    """({produit_id: vues day / close / volume} des produits du magasin ayant des séances, ids absents du magasin)."""
+    found, rest = {}, []
+    for pid in ids:
+        k = store.position(pid)
+        if k is None:
+            rest.append(pid)
+            continue
+        s = store.series_at(k, dfrom, dto)
+        if len(s["day"]):
+            found[pid] = s
+    return found, rest
+
+def align(by_pid: dict, fields: tuple = OHLCV) -> tuple[np.ndarray, dict]:
+    """
+    Index commun (union des séances) et séries réindexées : les prix reportent la
+    dernière valeur connue (None avant la 1re), le volume n'est renseigné que les jours cotés.
+    """
+    if not by_pid:
+        return np.zeros(0, dtype=np.int64), {}
+    index = np.unique(np.concatenate([s["day"] for s in by_pid.values()]))
+    out = {}
+    for pid, s in by_pid.items():
+        aligned = {}
+        for f in fields:
+            v = s[f]
+            if f == "volume":
+                pos = np.searchsorted(s["day"], index)
+                hit = (pos < len(v)) & (s["day"][np.minimum(pos, len(v) - 1)] == index)
+                aligned[f] = np.where(hit, v[np.minimum(pos, len(v) - 1)], np.nan)
+                continue
+            ok = ~np.isnan(v)
+            days, vals = s["day"][ok], v[ok]
+            pos = np.searchsorted(days, index, side="right") - 1
+            aligned[f] = np.where(pos >= 0, vals[np.maximum(pos, 0)] if len(vals) else np.nan, np.nan)
+        out[pid] = aligned
+    return index, out
+
+def aggregate_sql(session, pid: int, interval: str, dfrom: date | None = None, dto: date | None = None) -> dict:
+    """Barres hebdomadaires / mensuelles calculées en SQL, datées du début de période."""
+    where, params = _range(dfrom, dto)
+    rows = session.execute(sqltext(AGGREGATE_SQL.format(where=where)),
+                           {"pid": pid, "unit": interval, **params}).all()
+    return _frame(rows)
+
+def _range(dfrom, dto) -> tuple[str, dict]:
+    # bornes sur la colonne brute : élagage des partitions annuelles
+    where, params = "", {}
+    if dfrom:
+        where += " AND date >= :dfrom"
+        params["dfrom"] = dfrom
+    if dto:
+        where += " AND date <= :dto"
+        params["dto"] = dto
+    return where, params
+
+def _frame(rows) -> dict:
+    n = len(rows)
+    out = {"day": np.fromiter((r[0].toordinal() for r in rows), dtype=np.int64, count=n)}
+    for k, name in enumerate(OHLCV, start=1):
+        out[name] = np.fromiter((np.nan if r[k] is None else float(r[k]) for r in rows), dtype=float, count=n)
+    return out
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Indices (croissants) des `n_out` points retenus par Largest-Triangle-Three-Buckets.
+    Premier et dernier points conservés ; dans chaque seau intermédiaire, le point
+    formant le plus grand triangle avec le point retenu précédent et la moyenne du seau suivant.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # bornes des n_out - 2 seaux intermédiaires sur les points 1 .. n-2
+    edges = (np.arange(n_out - 1) * ((n - 2) / (n_out - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for k in range(n_out - 2):
+        lo, hi = edges[k], edges[k + 1]
+        nlo, nhi = hi, (edges[k + 2] if k + 2 < len(edges) else n)
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        ax, ay = x[a], y[a]
+        area = np.abs((ax - cx) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (cy - ay))
+        a = lo + int(np.argmax(area))
+        out[k + 1] = a
+    return out
+
+def downsample(series: dict, max_points: int) -> dict:
+    """Sous-échantillonne toutes les colonnes aux indices LTTB des clôtures (séances sans clôture ignorées)."""
+    keep = np.flatnonzero(~np.isnan(series["close"]))
+    if len(keep) <= max_points:
+        return series if len(keep) == len(series["day"]) else {k: v[keep] for k, v in series.items()}
+    idx = keep[lttb(series["day"][keep], series["close"][keep], max_points)]
+    return {k: v[idx] for k, v in series.items()}
+
+def _values(a: np.ndarray, integer: bool = False) -> list:
+    vals = a.tolist()
+    if integer:
+        return [None if v != v else int(v) for v in vals]
+    return [None if v != v else v for v in vals]
+
+def epoch_seconds(days: np.ndarray) -> list:
+    return ((days - EPOCH_ORDINAL) * 86400).tolist()
+
+def columnar(series: dict, fields: tuple = OHLCV, with_time: bool = True) -> dict:
+    """Colonnes parallèles JSON : t (secondes epoch, minuit UTC) + un tableau par champ."""
+    out = {"t": epoch_seconds(series["day"])} if with_time else {}
+    for name in fields:
+        out[name] = _values(series[name], integer=(name == "volume"))
+    return out
@@ -0,0 +1,135 @@
+# immo_risk.py
+"""
+Projection immobilière stochastique : cashflow-at-risk.
+
+Au lieu d'un loyer moyen rent_m × (1 - vacancy) et de taux fixes :
+- vacance locative en mois entiers : chaîne de Markov occupé / vacant par bien,
+  calibrée pour que la part de mois vacants vaille `vacancy` en moyenne et
+  qu'une vacance dure `mean_vacant_months` en moyenne (plus longtemps si
+  `vacancy` l'impose : au moins vacancy / (1 - vacancy) mois)
+- prêts à taux variable : le taux est révisé tous les `reset_months` mois
+  (depuis le début de la projection) en suivant un indice aléatoire commun
+  à tous les prêts d'un même chemin ; la mensualité est recalculée sur la
+  durée restante
+
+Tout est vectorisé sur (chemins × biens) et (chemins × prêts) ; seule la
+boucle sur les mois reste en Python. Le reste du cashflow (revenus, charges,
+épargne…) est celui de projection_engine.simulate(), identique sur chaque chemin.
+"""
+import numpy as np
+
+from projection_engine import loan_prepayments, simulate, step_series
+
+
+def occupancy_paths(rng, n_props: int, paths: int, months: int, vacancy: float,
+                    mean_vacant_months: float = 3.0) -> np.ndarray:
+    """Booléens (paths, n_props, months) : True = bien loué ce mois-là."""
+    vacancy = min(max(float(vacancy), 0.0), 1.0)
+    if vacancy <= 0.0:
+        return np.ones((paths, n_props, months), dtype=bool)
+    if vacancy >= 1.0:
+        return np.zeros((paths, n_props, months), dtype=bool)
+    # vacant -> occupé ; au-delà de vacancy = 1 / (1 + p_refill), p_leave dépasserait 1 :
+    # les vacances s'allongent (vacancy / (1 - vacancy) mois en moyenne) pour garder la part stationnaire
+    p_refill = min(1.0 / max(float(mean_vacant_months), 1.0), (1.0 - vacancy) / vacancy)
+    p_leave = vacancy * p_refill / (1.0 - vacancy)             # occupé -> vacant (stationnaire = vacancy)
+
+    u = rng.random((months, paths, n_props))
+    occupied = np.empty((paths, n_props, months), dtype=bool)
+    state = rng.random((paths, n_props)) >= vacancy            # état initial tiré dans la loi stationnaire
+    for t in range(months):
+        state = np.where(state, u[t] >= p_leave, u[t] < p_refill)
+        occupied[:, :, t] = state
+    return occupied
+
+def rate_shift_paths(rng, paths: int, months: int, reset_months: int = 12, rate_vol: float = 0.005) -> np.ndarray:
+    """
+    Décalage de taux annuel (paths, months) par rapport au taux initial : marche
+    aléatoire gaussienne, écart-type annuel `rate_vol`, constante entre deux révisions.
+    """
+    reset_months = max(int(reset_months), 1)
+    n_resets = months // reset_months
+    steps = rng.normal(0.0, rate_vol * np.sqrt(reset_months / 12.0), (paths, n_resets))
+    levels = np.concatenate([np.zeros((paths, 1)), np.cumsum(steps, axis=1)], axis=1)
+    return levels[:, np.arange(months) // reset_months]
+
+def loan_payment_paths(loans: list, months: int, rate_shift: np.ndarray, variable: np.ndarray,
+                       reset_months: int = 12, rate_floor: float = 0.0, prepay: np.ndarray | None = None) -> np.ndarray:
+    """
+    Mensualités payées (paths, months), tous prêts confondus.
+    `variable` (nL,) : prêts dont le taux suit `rate_shift` aux dates de révision.
+    """
+    P = rate_shift.shape[0]
+    nL = len(loans)
+    paid = np.zeros((P, months))
+    if not nL:
+        return paid
+    remain = np.tile(np.array([ln["remain"] for ln in loans], dtype=float), (P, 1))
+    r0 = np.array([ln["r_m"] for ln in loans], dtype=float)
+    r_m = np.tile(r0, (P, 1))
+    pay = np.tile(np.array([ln["pay_no_ins"] for ln in loans], dtype=float), (P, 1))
+    left = np.tile(np.array([ln["months_left"] for ln in loans], dtype=float), (P, 1))
+    reset_months = max(int(reset_months), 1)
+    floor_m = rate_floor / 12.0
+
+    for t in range(months):
+        if t and t % reset_months == 0 and variable.any():
+            new_r = np.maximum(r0[None, :] + rate_shift[:, t:t + 1] / 12.0, floor_m)
+            r_m = np.where(variable[None, :], new_r, r_m)
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                annuity = np.where(np.abs(r_m) < 1e-12, remain / np.maximum(left, 1),
+                                   remain * r_m / (1.0 - np.power(1.0 + r_m, -np.maximum(left, 1))))
+            pay = np.where(variable[None, :] & (left > 0), annuity, pay)
+        active = (remain > 1e-8) & (left > 0)
+        paid[:, t] = np.where(active, pay, 0.0).sum(axis=1)
+        principal = np.minimum(np.maximum(pay - remain * r_m, 0.0), remain)
+        remain = np.where(active, remain - principal, remain)
+        left = np.where(active, left - 1, left)
+        if prepay is not None:
+            remain = remain - np.where(left > 0, np.minimum(prepay[None, :, t], remain), 0.0)
+    return paid
+
+def simulate_immo_risk(state: dict, start, months: int, rates: dict, paths: int = 500, seed: int | None = 0,
+                       mean_vacant_months: float = 3.0, variable_loans=(), reset_months: int = 12,
+                       rate_vol: float = 0.005, rate_floor: float = 0.0) -> dict:
+    """
+    Cashflow net par chemin (paths, months). `variable_loans` : ids d'ImmoLoan à
+    taux variable, ou "all". `rates` : taux scalaires (cf. RATE_KEYS).
+    """
+    M = max(int(months), 0)
+    rng = np.random.default_rng(seed)
+    ims = state["immo"]
+    loans = [ln for im in ims for ln in im["loans"]]
+
+    # partie déterministe, hors loyers (vacancy=1) et hors mensualités de prêts
+    base = simulate(state, start, M, {**rates, "vacancy": 1.0})
+    net_ex = base["net"][0] + base["loans_paid"].sum(axis=0)
+
+    rent = step_series([im["rent_m"] for im in ims], ims, start, M, "rent_change")          # (nI, M)
+    occupied = occupancy_paths(rng, len(ims), paths, M, rates["vacancy"], mean_vacant_months)
+    rent_paths = (occupied * rent[None, :, :]).sum(axis=1)                                  # (P, M)
+
+    if variable_loans == "all":
+        variable = np.ones(len(loans), dtype=bool)
+    else:
+        ids = {str(x) for x in variable_loans or ()}
+        variable = np.array([str(ln["loan_id"]) in ids for ln in loans], dtype=bool)
+    shift = rate_shift_paths(rng, paths, M, reset_months, rate_vol)
+    paid_paths = loan_payment_paths(loans, M, shift, variable, reset_months, rate_floor,
+                                    loan_prepayments(ims, start, M))
+
+    return {
+        "times": base["times"],
+        "net": net_ex[None, :] + rent_paths - paid_paths,
+        "rent": rent_paths,
+        "loan_payments": paid_paths,
+        "vacant_share": float(1.0 - occupied.mean()) if occupied.size else 0.0,
+        "variable_loans": int(variable.sum()),
+    }
+
+def percentile_bands(paths: np.ndarray, percentiles) -> dict:
+    """{"p5": (M,), ..., "mean": (M,)} sur l'axe des chemins."""
+    qs = np.percentile(paths, percentiles, axis=0)
+    out = {f"p{q:g}": row for q, row in zip(percentiles, qs)}
+    out["mean"] = paths.mean(axis=0)
+    return out
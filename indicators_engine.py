@@ -0,0 +1,232 @@
+# indicators_engine.py
+"""
+Indicateurs techniques journaliers (produits_indicateurs) calculés sur
+produits_histo : ma20, ma50 (moyennes simples), rsi14 (Wilder), macd
+(EMA12 - EMA26) et signal (EMA9 du macd).
+
+Incrémental : l'état glissant de chaque produit est conservé dans
+produits_indicateurs_state (50 dernières clôtures, EMA 12 / 26 / 9, moyennes
+de hausse / baisse du RSI, nombre de séances vues). Chaque nuit, seules les
+séances postérieures à last_date sont lues et calculées ; reprendre une série
+depuis son état donne exactement le même résultat que la recalculer en entier
+(les EMA sont des récurrences y_t = y_t-1 + α (x_t - y_t-1), amorcées par
+l'état ; les moyennes mobiles par sommes cumulées sur « queue + nouvelles clôtures »).
+
+Valeurs nulles pendant le démarrage : ma20 avant 20 séances, ma50 avant 50,
+rsi14 avant 14 variations, macd avant 26 séances, signal avant 34.
+
+Calcul réparti par paquets de produits sur un pool de processus, écriture en
+masse (COPY + INSERT ... ON CONFLICT (produit_id, date)).
+"""
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text as sqltext
+
+from models import ProduitHisto, ProduitIndicateursState, ProduitInvest
+from utils import copy_dataframe
+
+MA_WINDOWS = (20, 50)
+RSI_PERIOD = 14
+MACD_FAST, MACD_SLOW, MACD_SIGNAL = 12, 26, 9
+TAIL = max(MA_WINDOWS)          # clôtures conservées dans l'état
+
+CHUNK_SIZE = int(os.getenv("INDICATORS_CHUNK", "200"))
+WORKERS = int(os.getenv("INDICATORS_WORKERS", "2"))
+
+UNIQUE_INDEX_SQL = """
+    DELETE FROM produits_indicateurs a USING produits_indicateurs b
+    WHERE a.produit_id = b.produit_id AND a.date = b.date AND a.id < b.id;
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_produits_indicateurs_produit_date ON produits_indicateurs (produit_id, date);
+"""
+
+STAGING_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS stg_indicateurs (
+        produit_id integer, date date, ma20 double precision, ma50 double precision,
+        rsi14 double precision, macd double precision, signal double precision
+    ) ON COMMIT DELETE ROWS
+"""
+
+UPSERT_SQL = sqltext("""
+    INSERT INTO produits_indicateurs (produit_id, date, ma20, ma50, rsi14, macd, signal)
+    SELECT produit_id, date, ma20, ma50, rsi14, macd, signal FROM stg_indicateurs
+    ON CONFLICT (produit_id, date) DO UPDATE SET
+        ma20 = EXCLUDED.ma20,
+        ma50 = EXCLUDED.ma50,
+        rsi14 = EXCLUDED.rsi14,
+        macd = EXCLUDED.macd,
+        signal = EXCLUDED.signal
+""")
+
+STATE_SQL = sqltext("""
+    INSERT INTO produits_indicateurs_state (produit_id, last_date, n_bars, state, computed_at)
+    VALUES (:produit_id, :last_date, :n_bars, CAST(:state AS JSONB), :computed_at)
+    ON CONFLICT (produit_id) DO UPDATE SET
+        last_date = EXCLUDED.last_date,
+        n_bars = EXCLUDED.n_bars,
+        state = EXCLUDED.state,
+        computed_at = EXCLUDED.computed_at
+""")
+
+
+def _ema(values: np.ndarray, alpha: float, prev: float | None) -> np.ndarray:
+    """EMA (récurrence, adjust=False) reprise depuis `prev` (None : amorcée sur la 1re valeur)."""
+    if prev is not None and len(values) <= 8:
+        # cas nominal de la nuit (1 séance) : la boucle évite le coût fixe de pandas
+        out = np.empty(len(values))
+        for k, v in enumerate(values.tolist()):
+            prev = prev + alpha * (v - prev)
+            out[k] = prev
+        return out
+    if prev is None:
+        return pd.Series(values).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+    return pd.Series(np.r_[prev, values]).ewm(alpha=alpha, adjust=False).mean().to_numpy()[1:]
+
+def _sma(x: np.ndarray, start: int, window: int) -> np.ndarray:
+    """Moyennes mobiles de `window` valeurs finissant aux positions start..len(x)-1 de x."""
+    c = np.r_[0.0, np.cumsum(x)]
+    end = np.arange(start, len(x)) + 1
+    return (c[end] - c[np.maximum(end - window, 0)]) / window
+
+def compute_indicators(closes: np.ndarray, state: dict | None = None) -> tuple[dict, dict]:
+    """
+    Indicateurs des nouvelles clôtures `closes` (chronologiques) d'un produit,
+    en reprenant `state` (None : début de série). Retourne ({colonne: (n,)}, nouvel état).
+    """
+    st = state or {"n": 0, "tail": [], "ema_fast": None, "ema_slow": None, "ema_signal": None,
+                   "avg_gain": None, "avg_loss": None}
+    closes = np.asarray(closes, dtype=float)
+    n_new = len(closes)
+    tail = np.asarray(st["tail"], dtype=float)
+    x = np.r_[tail, closes]
+    seen = st["n"] + np.arange(1, n_new + 1)      # séances vues, séance courante incluse
+
+    out = {}
+    for w in MA_WINDOWS:
+        out[f"ma{w}"] = np.where(seen >= w, _sma(x, len(tail), w), np.nan)
+
+    # RSI de Wilder : variations depuis la dernière clôture connue
+    prev_close = tail[-1:] if len(tail) else closes[:1]
+    delta = np.diff(np.r_[prev_close, closes])
+    if not len(tail):
+        delta = delta[1:]                         # 1re séance de la série : pas de variation
+    gain, loss = np.maximum(delta, 0.0), np.maximum(-delta, 0.0)
+    alpha = 1.0 / RSI_PERIOD
+    avg_gain = _ema(gain, alpha, st["avg_gain"]) if len(delta) else np.zeros(0)
+    avg_loss = _ema(loss, alpha, st["avg_loss"]) if len(delta) else np.zeros(0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rsi = np.where(avg_loss > 0, 100.0 - 100.0 / (1.0 + avg_gain / avg_loss),
+                       np.where(avg_gain > 0, 100.0, 50.0))
+    if not len(tail):
+        rsi = np.r_[np.nan, rsi]
+        avg_gain_last = avg_gain[-1] if len(avg_gain) else None
+        avg_loss_last = avg_loss[-1] if len(avg_loss) else None
+    else:
+        avg_gain_last, avg_loss_last = avg_gain[-1], avg_loss[-1]
+    out["rsi14"] = np.where(seen - 1 >= RSI_PERIOD, rsi, np.nan)
+
+    ema_fast = _ema(closes, 2.0 / (MACD_FAST + 1), st["ema_fast"])
+    ema_slow = _ema(closes, 2.0 / (MACD_SLOW + 1), st["ema_slow"])
+    macd = ema_fast - ema_slow
+    signal = _ema(macd, 2.0 / (MACD_SIGNAL + 1), st["ema_signal"])
+    out["macd"] = np.where(seen >= MACD_SLOW, macd, np.nan)
+    out["signal"] = np.where(seen >= MACD_SLOW + MACD_SIGNAL - 1, signal, np.nan)
+
+    new_state = {
+        "n": int(st["n"] + n_new),
+        "tail": x[-TAIL:].tolist(),
+        "ema_fast": float(ema_fast[-1]), "ema_slow": float(ema_slow[-1]), "ema_signal": float(signal[-1]),
+        "avg_gain": None if avg_gain_last is None else float(avg_gain_last),
+        "avg_loss": None if avg_loss_last is None else float(avg_loss_last),
+    }
+    return out, new_state
+
+def _compute_one(payload: tuple):
+    """Tâche du pool : (produit_id, jours ordinaux, clôtures, état) -> (produit_id, DataFrame, état)."""
+    pid, days, closes, state = payload
+    cols, new_state = compute_indicators(closes, state)
+    df = pd.DataFrame({"produit_id": pid,
+                       "date": [date.fromordinal(int(d)) for d in days],
+                       "ma20": cols["ma20"], "ma50": cols["ma50"], "rsi14": cols["rsi14"].round(2),
+                       "macd": cols["macd"], "signal": cols["signal"]})
+    return pid, df, new_state
+
+def _load_new_bars(session, ids: list[int], full: bool = False) -> list[tuple]:
+    """
+    Clôtures postérieures à l'état de chaque produit (toutes si `full`), une
+    requête triée (produit, date). Retourne les tâches (produit_id, jours, clôtures, état).
+    """
+    q = (session.query(ProduitHisto.produit_id, ProduitHisto.date, ProduitHisto.close, ProduitIndicateursState.state)
+         .outerjoin(ProduitIndicateursState, ProduitIndicateursState.produit_id == ProduitHisto.produit_id)
+         .filter(ProduitHisto.produit_id.in_(ids), ProduitHisto.close.isnot(None)))
+    if not full:
+        q = q.filter((ProduitIndicateursState.last_date.is_(None)) | (ProduitHisto.date > ProduitIndicateursState.last_date))
+    rows = q.order_by(ProduitHisto.produit_id, ProduitHisto.date).all()
+    if not rows:
+        return []
+    pids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    days = np.fromiter((r[1].toordinal() for r in rows), dtype=np.int64, count=len(rows))
+    close = np.array([float(r[2]) for r in rows])
+    starts = np.flatnonzero(np.r_[True, pids[1:] != pids[:-1]])
+    ends = np.r_[starts[1:], len(pids)]
+    return [(int(pids[a]), days[a:b], close[a:b], None if full else rows[a][3])
+            for a, b in zip(starts.tolist(), ends.tolist())]
+
+def ensure_unique_index(session):
+    exists = session.execute(sqltext(
+        "SELECT 1 FROM pg_indexes WHERE indexname = 'uq_produits_indicateurs_produit_date'")).first()
+    if not exists:
+        session.connection().exec_driver_sql(UNIQUE_INDEX_SQL)
+        session.commit()
+
+def write_results(session, results: list) -> int:
+    """COPY + upsert des indicateurs et des états d'un paquet, une transaction."""
+    if not results:
+        return 0
+    df = pd.concat([r[1] for r in results], ignore_index=True)
+    conn = session.connection()
+    conn.exec_driver_sql(STAGING_SQL)
+    copy_dataframe(conn, "stg_indicateurs", df)
+    conn.execute(UPSERT_SQL)
+    now = datetime.utcnow()
+    session.execute(STATE_SQL, [{"produit_id": pid, "last_date": part["date"].iloc[-1], "n_bars": st["n"],
+                                 "state": json.dumps(st), "computed_at": now} for pid, part, st in results])
+    session.commit()
+    return len(df)
+
+def refresh_indicators(session, chunk_size: int = CHUNK_SIZE, workers: int = WORKERS,
+                       full: bool = False, verbose: bool = False) -> dict:
+    """
+    Batch nuit : indicateurs des nouvelles séances de tous les produits ayant un
+    historique, par paquets de `chunk_size` produits (pagination par clé).
+    full=True ignore les états et recalcule toutes les séances.
+    """
+    ensure_unique_index(session)
+    stats = {"computed": 0, "bars": 0, "up_to_date": 0}
+    last_id = 0
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        while True:
+            ids = [pid for (pid,) in (session.query(ProduitInvest.id)
+                                      .filter(ProduitInvest.id > last_id)
+                                      .order_by(ProduitInvest.id)
+                                      .limit(chunk_size).all())]
+            if not ids:
+                break
+            last_id = ids[-1]
+            payloads = _load_new_bars(session, ids, full)
+            results = list(pool.map(_compute_one, payloads, chunksize=16)) if pool else [_compute_one(p) for p in payloads]
+            written = write_results(session, results)
+            stats["computed"] += len(results)
+            stats["bars"] += written
+            stats["up_to_date"] += len(ids) - len(results)
+            if verbose:
+                print(f"produits_indicateurs: {written} séances / {len(results)} produits")
+    finally:
+        if pool:
+            pool.shutdown()
+    return stats
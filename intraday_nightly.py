@@ -0,0 +1,107 @@
+# intraday_nightly.py
+"""
+Batch (toutes les heures, ou chaque nuit) : agrégats intraday 1m / 1h / 1d et
+rétention des ticks bruts (cf. intraday_rollup.py).
+
+Usage : python intraday_nightly.py [--skip-prune] [--verbose]
+"""
+import os, sys, time, argparse
+from datetime import datetime, timezone
+from sqlalchemy import create_engine
+from sqlalchemy import text as sqltext
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import sessionmaker
+from intraday_rollup import rollup, prune
+from partitions import ensure_default_partitions
+import json
+
+DB_URL = os.environ["DATABASE_URL"]
+engine = create_engine(DB_URL, future=True, poolclass=NullPool)
+Session = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+JOB_NAME = "intraday-rollup"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--skip-prune", action="store_true", help="n'applique pas la rétention")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    now = datetime.now(timezone.utc)
+
+    # 1) job_runs: running
+    s = Session()
+    try:
+        run_id = s.execute(
+            sqltext("""
+                INSERT INTO job_runs (job_name, run_date, started_at, state)
+                VALUES (:name, :run_date, now(), 'running')
+                RETURNING id
+            """),
+            {"name": JOB_NAME, "run_date": now.date()}
+        ).scalar_one()
+        s.commit()
+    except:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+    # 2) run
+    t0 = time.perf_counter()
+    ok, rolled, pruned, created, error = True, {}, {}, {}, None
+    s = Session()
+    try:
+        created = ensure_default_partitions(s, now.date())
+        rolled = rollup(s, now, verbose=args.verbose)
+        if not args.skip_prune:
+            pruned = prune(s, now)
+    except Exception as e:
+        s.rollback()
+        ok, error = False, str(e)[:300]
+    finally:
+        s.close()
+    elapsed = round(time.perf_counter() - t0, 1)
+
+    # 3) job_runs: finalize
+    s = Session()
+    try:
+        msg_obj = {"stats": {"bars": rolled, "pruned": pruned, "partitions": created, "seconds": elapsed}}
+        if error:
+            msg_obj["error"] = error
+        msg = json.dumps(msg_obj, ensure_ascii=False)[:1000]
+
+        s.execute(
+            sqltext("""
+                UPDATE job_runs
+                SET finished_at = now(),
+                    state        = :state,
+                    ok           = :ok,
+                    items_inserted = :ins,
+                    items_skipped  = :skp,
+                    items_failed   = :fld,
+                    message        = :msg
+                WHERE id = :id
+            """),
+            {
+                "state": "done" if ok else "error",
+                "ok": bool(ok),
+                "ins": int(sum(rolled.values())),
+                "skp": 0,
+                "fld": 0 if ok else 1,
+                "msg": msg,
+                "id": run_id
+            }
+        )
+        s.commit()
+    except:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+    print(("OK" if ok else "ERROR"), {"bars": rolled, "pruned": pruned}, f"{elapsed}s")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
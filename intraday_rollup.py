@@ -0,0 +1,196 @@
+# intraday_rollup.py
+"""
+Paliers d'agrégation des cotations intraday (produits_intraday) et rétention.
+
+- 1m : OHLCV par minute depuis les ticks bruts
+- 1h : depuis le palier 1m ; 1d : depuis le palier 1h
+Chaque palier est calculé en SQL ensembliste (date_trunc ... GROUP BY, upsert
+ON CONFLICT), uniquement sur la fenêtre non encore agrégée : depuis le début de
+l'intervalle contenant intraday_rollup_state.rolled_until - INTRADAY_ROLLUP_GRACE_MINUTES
+(l'intervalle partiel du passage précédent est recalculé en entier, ainsi que
+les minutes récentes où des ticks arrivent en retard).
+
+Rétention : les ticks bruts plus vieux que INTRADAY_RAW_RETENTION_DAYS (et déjà
+agrégés en 1m) sont supprimés par mois entiers (DROP de partition, cf.
+partitions.py) puis, pour le reste, par lots ; idem pour les paliers 1m / 1h selon
+INTRADAY_1M_RETENTION_DAYS / INTRADAY_1H_RETENTION_DAYS (0 = conservés). 1d est gardé.
+
+pick_tier() choisit la source de /api/produits/<pid>/intraday selon la fenêtre
+demandée : brut sur quelques heures, puis 1m, 1h, 1d. Le palier ne couvre que
+jusqu'à son rolled_until (batch nuit) : live_bars() agrège à la volée, depuis les
+ticks bruts, la fin de fenêtre pas encore agrégée (à partir de live_from()).
+"""
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text as sqltext
+
+from models import IntradayRollupState
+from partitions import drop_partitions_before
+
+# (palier, unité date_trunc, palier source ; None = ticks bruts)
+TIERS = (("1m", "minute", None), ("1h", "hour", "1m"), ("1d", "day", "1h"))
+TIER_NAMES = ("raw",) + tuple(t[0] for t in TIERS)
+TIER_UNITS = {t[0]: t[1] for t in TIERS}
+
+RAW_RETENTION_DAYS = float(os.getenv("INTRADAY_RAW_RETENTION_DAYS", "7"))
+RETENTION_DAYS = {"1m": float(os.getenv("INTRADAY_1M_RETENTION_DAYS", "90")),
+                  "1h": float(os.getenv("INTRADAY_1H_RETENTION_DAYS", "730"))}
+# fenêtre maximale servie par palier (au-delà : palier suivant)
+MAX_SPAN = {"raw": timedelta(hours=6), "1m": timedelta(days=3), "1h": timedelta(days=120)}
+PRUNE_BATCH = int(os.getenv("INTRADAY_PRUNE_BATCH", "50000"))
+# ticks tardifs : fenêtre déjà agrégée recalculée à chaque passage (et jamais purgée)
+GRACE = timedelta(minutes=float(os.getenv("INTRADAY_ROLLUP_GRACE_MINUTES", "15")))
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+ROLLUP_RAW_SQL = sqltext("""
+    INSERT INTO produits_intraday_bars (produit_id, tier, ts, open, high, low, close, volume, n_ticks)
+    SELECT produit_id, :tier, date_trunc(:unit, ts, 'UTC') AS bucket,
+           (array_agg(price ORDER BY ts))[1], max(price), min(price),
+           (array_agg(price ORDER BY ts DESC))[1], sum(volume), count(*)
+    FROM produits_intraday
+    WHERE ts >= :since AND ts < :until AND price IS NOT NULL
+    GROUP BY produit_id, bucket
+    ON CONFLICT (produit_id, tier, ts) DO UPDATE SET
+        open = EXCLUDED.open,
+        high = EXCLUDED.high,
+        low = EXCLUDED.low,
+        close = EXCLUDED.close,
+        volume = EXCLUDED.volume,
+        n_ticks = EXCLUDED.n_ticks
+""")
+
+ROLLUP_BARS_SQL = sqltext("""
+    INSERT INTO produits_intraday_bars (produit_id, tier, ts, open, high, low, close, volume, n_ticks)
+    SELECT produit_id, :tier, date_trunc(:unit, ts, 'UTC') AS bucket,
+           (array_agg(open ORDER BY ts))[1], max(high), min(low),
+           (array_agg(close ORDER BY ts DESC))[1], sum(volume), sum(n_ticks)
+    FROM produits_intraday_bars
+    WHERE tier = :source AND ts >= :since AND ts < :until
+    GROUP BY produit_id, bucket
+    ON CONFLICT (produit_id, tier, ts) DO UPDATE SET
+        open = EXCLUDED.open,
+        high = EXCLUDED.high,
+        low = EXCLUDED.low,
+        close = EXCLUDED.close,
+        volume = EXCLUDED.volume,
+        n_ticks = EXCLUDED.n_ticks
+""")
+
+STATE_SQL = sqltext("""
+    INSERT INTO intraday_rollup_state (tier, rolled_until, computed_at)
+    VALUES (:tier, :rolled_until, now())
+    ON CONFLICT (tier) DO UPDATE SET
+        rolled_until = EXCLUDED.rolled_until,
+        computed_at = EXCLUDED.computed_at
+""")
+
+LIVE_BARS_SQL = sqltext("""
+    SELECT ts, open, high, low, close, volume FROM (
+        SELECT date_trunc(:unit, ts, 'UTC') AS ts,
+               (array_agg(price ORDER BY ts))[1] AS open, max(price) AS high, min(price) AS low,
+               (array_agg(price ORDER BY ts DESC))[1] AS close, sum(volume) AS volume
+        FROM produits_intraday
+        WHERE produit_id = :pid AND ts >= :since AND ts < :until AND price IS NOT NULL
+        GROUP BY 1
+    ) b
+    WHERE ts >= :since
+    ORDER BY ts
+    LIMIT :n
+""")
+
+PRUNE_RAW_SQL = sqltext("""
+    DELETE FROM produits_intraday
+    WHERE id IN (SELECT id FROM produits_intraday WHERE ts < :cutoff LIMIT :n)
+""")
+
+PRUNE_BARS_SQL = sqltext("""
+    DELETE FROM produits_intraday_bars
+    WHERE ctid = ANY(ARRAY(SELECT ctid FROM produits_intraday_bars
+                           WHERE tier = :tier AND ts < :cutoff LIMIT :n))
+""")
+
+
+def truncate(ts: datetime, unit: str) -> datetime:
+    """date_trunc en Python (UTC)."""
+    ts = ts.astimezone(timezone.utc)
+    if unit == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if unit == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def rolled_until(session) -> dict:
+    return {st.tier: st.rolled_until for st in session.query(IntradayRollupState).all()}
+
+def rollup(session, now: datetime | None = None, verbose: bool = False) -> dict:
+    """Agrège chaque palier sur sa fenêtre non encore traitée ; une transaction par palier."""
+    now = now or datetime.now(timezone.utc)
+    marks = rolled_until(session)
+    stats = {}
+    for tier, unit, source in TIERS:
+        until = now if source is None else marks.get(source, EPOCH)
+        since = truncate(max(marks.get(tier, EPOCH) - GRACE, EPOCH), unit)
+        if until <= since:
+            stats[tier] = 0
+            continue
+        params = {"tier": tier, "unit": unit, "source": source, "since": since, "until": until}
+        n = session.execute(ROLLUP_RAW_SQL if source is None else ROLLUP_BARS_SQL, params).rowcount
+        session.execute(STATE_SQL, {"tier": tier, "rolled_until": until})
+        session.commit()
+        marks[tier] = until
+        stats[tier] = n
+        if verbose:
+            print(f"{tier}: {n} barres ({since.isoformat()} -> {until.isoformat()})")
+    return stats
+
+def _prune(session, sql, params: dict) -> int:
+    """Suppression par lots de PRUNE_BATCH lignes, un commit par lot."""
+    total = 0
+    while True:
+        n = session.execute(sql, {**params, "n": PRUNE_BATCH}).rowcount
+        session.commit()
+        total += n
+        if n < PRUNE_BATCH:
+            return total
+
+def prune(session, now: datetime | None = None) -> dict:
+    """Rétention des ticks bruts et des paliers fins ; jamais au-delà de ce qui est agrégé."""
+    now = now or datetime.now(timezone.utc)
+    marks = rolled_until(session)
+    stats = {}
+    if RAW_RETENTION_DAYS > 0 and "1m" in marks:
+        cutoff = min(now - timedelta(days=RAW_RETENTION_DAYS), truncate(marks["1m"] - GRACE, "minute"))
+        dropped = drop_partitions_before(session, "produits_intraday", cutoff.date())
+        stats["raw"] = _prune(session, PRUNE_RAW_SQL, {"cutoff": cutoff})
+        if dropped:
+            stats["raw_partitions_dropped"] = dropped
+    for tier, parent in (("1m", "1h"), ("1h", "1d")):
+        days = RETENTION_DAYS.get(tier) or 0
+        if days > 0 and parent in marks:
+            cutoff = min(now - timedelta(days=days), truncate(marks[parent], TIER_UNITS[parent]))
+            stats[tier] = _prune(session, PRUNE_BARS_SQL, {"tier": tier, "cutoff": cutoff})
+    return stats
+
+def pick_tier(start: datetime, end: datetime, now: datetime | None = None) -> str:
+    """Palier le plus fin dont la fenêtre maximale et la rétention couvrent [start, end]."""
+    now = now or datetime.now(timezone.utc)
+    span = end - start
+    retention = {"raw": RAW_RETENTION_DAYS, **RETENTION_DAYS}
+    for tier in TIER_NAMES[:-1]:
+        days = retention.get(tier) or 0
+        if span <= MAX_SPAN[tier] and (days <= 0 or start >= now - timedelta(days=days)):
+            return tier
+    return TIER_NAMES[-1]
+
+def live_from(session, tier: str, start: datetime) -> datetime:
+    """Début de la partie de la fenêtre que `tier` ne couvre pas encore (intervalle partiel compris)."""
+    mark = session.get(IntradayRollupState, tier)
+    if mark is None:
+        return start
+    return max(truncate(mark.rolled_until, TIER_UNITS[tier]), start)
+
+def live_bars(session, pid: int, tier: str, since: datetime, until: datetime, limit: int) -> list:
+    """Barres de `tier` sur [since, until) agrégées depuis les ticks bruts, comme rollup()."""
+    return session.execute(LIVE_BARS_SQL, {"pid": pid, "unit": TIER_UNITS[tier], "since": since,
+                                           "until": until, "n": limit}).all()
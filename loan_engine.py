@@ -0,0 +1,182 @@
+# loan_engine.py
+"""
+Échéanciers de prêts immobiliers (ImmoLoan) avec remboursements anticipés.
+
+Tous les prêts d'un bien sont amortis ensemble (une ligne NumPy par prêt) :
+en forme close sans remboursement anticipé (utils.amortization_batch, sert
+aussi de référence pour chiffrer l'économie), mois par mois sinon.
+
+Remboursement anticipé (AssetEvent kind="loan_prepayment", posted ou planned,
+prêt visé par data.loan_id, sinon le premier prêt du bien) : imputé sur le
+capital après l'échéance du mois, puis
+  - mode "duration" : mensualité inchangée, durée raccourcie
+  - mode "payment"  : durée inchangée, mensualité recalculée
+"""
+import os
+
+import numpy as np
+
+from projection_engine import add_months, first_of_month, safe_float
+from rrule_engine import monthly_occurrences
+from utils import LRUCache, amortization_batch, amortization_monthly_payment
+
+PREPAYMENT_MODES = ("duration", "payment")
+SCHEDULE_COLUMNS = ("payment", "interest", "principal", "prepayment", "remaining")
+
+_schedule_cache = LRUCache(int(os.getenv("LOAN_SCHEDULE_CACHE_SIZE", "512")))
+
+
+def loan_params(ln) -> dict:
+    """ImmoLoan -> paramètres figés (taux en %, comme utils.amortization_schedule)."""
+    principal = safe_float(ln.loan_amount, 0.0)
+    rate = safe_float(ln.loan_rate, 0.0)
+    months = int(ln.loan_duration_months or 0)
+    pay = safe_float(ln.monthly_payment, None) or amortization_monthly_payment(principal, rate, months)
+    return {
+        "loan_id": ln.id,
+        "principal": principal,
+        "rate": rate,
+        "months": months,
+        "payment": round(pay, 2),
+        "start": first_of_month(ln.loan_start_date) if ln.loan_start_date else None,
+    }
+
+def prepayment_params(ev) -> dict:
+    """AssetEvent loan_prepayment -> paramètres figés (clé de cache)."""
+    return {
+        "id": ev.id, "status": ev.status, "value_date": ev.value_date, "rrule": ev.rrule,
+        "end_date": ev.end_date, "amount": abs(safe_float(ev.amount, 0.0)),
+        "loan_id": (ev.data or {}).get("loan_id"),
+    }
+
+def _annuity(remain, r_m, left):
+    """Mensualité constante qui solde `remain` en `left` mois (vectorisé)."""
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        pay = np.where(np.abs(r_m) < 1e-12, remain / np.maximum(left, 1),
+                       remain * r_m / (1.0 - np.power(1.0 + r_m, -np.maximum(left, 1))))
+    return np.where(left > 0, pay, 0.0)
+
+def _remaining_term(remain, r_m, pay, left):
+    """Nombre de mensualités `pay` nécessaires pour solder `remain` (borné à `left`)."""
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        n = np.where(np.abs(r_m) < 1e-12, remain / pay,
+                     -np.log1p(-r_m * remain / pay) / np.log1p(r_m))
+    n = np.where(np.isfinite(n) & (n > 0), np.ceil(n - 1e-9), left)
+    return np.minimum(n, left)
+
+def amortize(principal, r_m, payment, months, prepay, mode: str = "duration") -> dict:
+    """
+    Amortit L prêts en parallèle sur N = prepay.shape[1] mois.
+    principal, r_m (taux mensuel), payment, months : (L,) ; prepay : (L, N).
+    Retourne {colonne: (L, N)} pour SCHEDULE_COLUMNS.
+    """
+    remain = np.asarray(principal, dtype=float).copy()
+    r_m = np.asarray(r_m, dtype=float)
+    pay = np.asarray(payment, dtype=float).copy()
+    left = np.asarray(months, dtype=float).copy()
+    L, N = prepay.shape
+    out = {k: np.zeros((L, N)) for k in SCHEDULE_COLUMNS}
+    for i in range(N):
+        active = (remain > 1e-8) & (left > 0)
+        interest = np.where(active, remain * r_m, 0.0)
+        principal_i = np.where(active, np.minimum(np.maximum(pay - interest, 0.0), remain), 0.0)
+        remain = remain - principal_i
+        left = np.where(active, left - 1, left)
+        pp = np.where(active & (left > 0), np.minimum(prepay[:, i], remain), 0.0)
+        if mode == "payment" and pp.any():
+            # même date de fin qu'avant le versement : nouvelle mensualité sur le terme restant
+            term = _remaining_term(remain, r_m, pay, left)
+            pay = np.where(pp > 0, _annuity(remain - pp, r_m, term), pay)
+            left = np.where(pp > 0, term, left)
+        remain = remain - pp
+        out["payment"][:, i] = interest + principal_i
+        out["interest"][:, i] = interest
+        out["principal"][:, i] = principal_i
+        out["prepayment"][:, i] = pp
+        out["remaining"][:, i] = remain
+    return out
+
+def _prepayment_matrix(loans: list, events: list, start, n: int) -> np.ndarray:
+    """Montants anticipés par prêt et par mois (L, n), mois comptés depuis `start`."""
+    mat = np.zeros((len(loans), n))
+    for ev in events:
+        if not ev["amount"] or not loans:
+            continue
+        j = next((k for k, ln in enumerate(loans) if str(ln["loan_id"]) == str(ev["loan_id"])), 0)
+        mat[j] += ev["amount"] * monthly_occurrences(ev["value_date"], ev["rrule"], ev["end_date"], start, n)
+    return mat
+
+def property_schedules(loans: list, events: list, mode: str = "duration") -> dict:
+    """
+    Échéanciers de tous les prêts d'un bien (cf. loan_params / prepayment_params).
+    Les prêts sans durée ou sans date de début sont ignorés.
+    Retourne {loan_id: {"start", "dates", "with": {colonnes}, "baseline": {colonnes}}},
+    mis en cache par paramètres des prêts + événements + mode.
+    """
+    loans = [ln for ln in loans if ln["months"] > 0 and ln["start"]]
+    key = (mode, tuple(tuple(sorted(ln.items())) for ln in loans),
+           tuple(tuple(sorted(ev.items())) for ev in events))
+    cached = _schedule_cache.get(key)
+    if cached is not None:
+        return cached
+    if not loans:
+        return _schedule_cache.put(key, {})
+
+    # axe commun : du premier début de prêt à la dernière échéance contractuelle
+    start = min(ln["start"] for ln in loans)
+    offsets = np.array([(ln["start"].year - start.year) * 12 + ln["start"].month - start.month for ln in loans])
+    n = int(max(off + ln["months"] for off, ln in zip(offsets, loans)))
+    prepay = _prepayment_matrix(loans, events, start, n)
+
+    # un prêt commençant plus tard est décalé : ses mois avant début sont inactifs
+    L = len(loans)
+    aligned = np.zeros((L, n))
+    for j, off in enumerate(offsets):
+        aligned[j, :n - off] = prepay[j, off:]
+    principal = np.array([ln["principal"] for ln in loans])
+    rate = np.array([ln["rate"] for ln in loans])
+    payment = np.array([ln["payment"] for ln in loans])
+    months = np.array([ln["months"] for ln in loans], dtype=float)
+
+    # sans remboursement anticipé : forme close (utils.amortization_batch)
+    batch = amortization_batch(principal, rate, months, horizon=n, payments=payment)
+    baseline = {"payment": batch["payment"], "interest": batch["interest"], "principal": batch["principal"],
+                "prepayment": np.zeros((L, n)), "remaining": batch["balance"]}
+    with_prepay = (amortize(principal, rate / 100.0 / 12.0, payment, months, aligned, mode)
+                   if aligned.any() else baseline)
+
+    out = {}
+    for j, ln in enumerate(loans):
+        k = ln["months"]
+        cols = lambda res: {c: res[c][j, :k] for c in SCHEDULE_COLUMNS}
+        out[ln["loan_id"]] = {
+            "start": ln["start"],
+            "dates": [add_months(ln["start"], i) for i in range(k)],
+            "with": cols(with_prepay),
+            "baseline": cols(baseline),
+        }
+    for sched in out.values():
+        for cols in (sched["with"], sched["baseline"]):
+            for a in cols.values():
+                a.flags.writeable = False
+    return _schedule_cache.put(key, out)
+
+def schedule_summary(sched: dict) -> dict:
+    """Totaux, fin effective et économies vs sans remboursement anticipé."""
+    def stats(cols):
+        paid = np.flatnonzero(cols["payment"] > 0)
+        return {
+            "months": int(paid[-1] + 1) if len(paid) else 0,
+            "total_interest": round(float(cols["interest"].sum()), 2),
+            "total_paid": round(float(cols["payment"].sum() + cols["prepayment"].sum()), 2),
+        }
+    w, b = stats(sched["with"]), stats(sched["baseline"])
+    return {
+        **w,
+        "total_prepaid": round(float(sched["with"]["prepayment"].sum()), 2),
+        "end_date": sched["dates"][w["months"] - 1].isoformat() if w["months"] else None,
+        "baseline_months": b["months"],
+        "baseline_total_interest": b["total_interest"],
+        "months_saved": b["months"] - w["months"],
+        "interest_saved": round(b["total_interest"] - w["total_interest"], 2),
+    }
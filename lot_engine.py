@@ -0,0 +1,259 @@
+# lot_engine.py
+"""
+Lots de titres et plus / moins-values dérivés des portfolio_trade postés, par
+(portefeuille, ISIN) ; le PRU de PortfolioLine (copié de TR) n'est pas modifié,
+il sert seulement de coût de repli. Deux méthodes :
+- "fifo"    : une vente consomme les lots les plus anciens
+- "average" : prix de revient moyen pondéré (PRU)
+
+FIFO en une passe vectorisée : sur l'axe « quantité achetée cumulée », le coût
+cumulé C(x) est linéaire par morceaux (un morceau par lot). La j-ème vente
+consomme l'intervalle [S_j-1, S_j] de cet axe (S = ventes cumulées), son coût
+est C(S_j) - C(S_j-1) : np.interp donne toutes les ventes d'un coup, quel que
+soit le nombre d'achats de plan d'épargne. Une vente supérieure aux unités
+détenues (historique incomplet) est bornée, S_j = Q_j + min(0, min_k<=j (A_k - Q_k))
+(A = unités disponibles, Q = ventes cumulées) ; le reliquat est valorisé au PRU
+de la ligne (sinon 0) et compté dans "unmatched_qty".
+
+État persistant (portfolio_lots) : lots ouverts, PRU moyen, réalisé par année et
+dernier trade appliqué (value_date, id). Seuls les trades postérieurs sont
+appliqués ; si un trade antérieur a été ajouté, modifié ou supprimé (nombre ou
+updated_at max différents), la ligne est rejouée depuis le début.
+"""
+import json
+from datetime import date, datetime
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy import text as sqltext
+
+from models import AssetEvent, AssetPortfolio, PortfolioLine, PortfolioLots, ProduitHisto, ProduitInvest
+from networth_history import signed_quantity, trade_cash
+from price_store import get_store
+from projection_engine import safe_float
+
+LOT_METHODS = ("fifo", "average")
+EPS = 1e-9
+
+# upsert : deux premières requêtes concurrentes sur un même portefeuille écrivent le même état
+STATE_SQL = sqltext("""
+    INSERT INTO portfolio_lots (asset_id, isin, last_date, last_event_id, n_events, events_updated_at, state, computed_at)
+    VALUES (:asset_id, :isin, :last_date, :last_event_id, :n_events, :events_updated_at, CAST(:state AS JSONB), :computed_at)
+    ON CONFLICT (asset_id, isin) DO UPDATE SET
+        last_date = EXCLUDED.last_date,
+        last_event_id = EXCLUDED.last_event_id,
+        n_events = EXCLUDED.n_events,
+        events_updated_at = EXCLUDED.events_updated_at,
+        state = EXCLUDED.state,
+        computed_at = EXCLUDED.computed_at
+""")
+
+
+def empty_state() -> dict:
+    return {"fifo": [], "avg": [0.0, 0.0], "realized": {"fifo": {}, "average": {}}, "unmatched_qty": 0.0}
+
+def _add_by_year(acc: dict, years: np.ndarray, values: np.ndarray):
+    for y, v in zip(years.tolist(), values.tolist()):
+        acc[str(y)] = round(acc.get(str(y), 0.0) + v, 6)
+
+def fifo_pass(lots: np.ndarray, days: np.ndarray, qty: np.ndarray, amount: np.ndarray,
+              fallback_cost: float = 0.0):
+    """
+    lots (L, 3) [jour, quantité, coût unitaire] ouverts dans l'ordre FIFO ;
+    trades chronologiques : jour ordinal, qty signée (+ achat), amount > 0
+    (coût d'un achat, produit d'une vente, frais inclus).
+    Retourne (lots ouverts (L', 3), réalisé par vente, quantité non appariée par vente).
+    """
+    buys = qty > 0
+    sells = ~buys
+    lot_day = np.r_[lots[:, 0], days[buys]]
+    lot_qty = np.r_[lots[:, 1], qty[buys]]
+    lot_unit = np.r_[lots[:, 2], amount[buys] / qty[buys]]
+    cum_b = np.r_[0.0, np.cumsum(lot_qty)]
+    cum_c = np.r_[0.0, np.cumsum(lot_qty * lot_unit)]
+
+    # unités disponibles au moment de chaque vente ; ventes cumulées bornées
+    q = -qty[sells]
+    avail = lots[:, 1].sum() + np.cumsum(np.where(buys, qty, 0.0))[sells]
+    Q = np.cumsum(q)
+    S = Q + np.minimum(0.0, np.minimum.accumulate(avail - Q)) if len(q) else Q
+    sold_total = S[-1] if len(S) else 0.0
+    cost = np.diff(np.interp(np.r_[0.0, S], cum_b, cum_c))
+    unmatched = np.maximum(q - np.diff(np.r_[0.0, S]), 0.0)
+    realized = amount[sells] - cost - unmatched * fallback_cost
+
+    remaining = np.clip(cum_b[1:] - sold_total, 0.0, lot_qty)
+    keep = remaining > EPS
+    return np.c_[lot_day, remaining, lot_unit][keep], realized, unmatched
+
+def average_pass(held: float, cost: float, qty: np.ndarray, amount: np.ndarray, fallback_cost: float = 0.0):
+    """PRU moyen pondéré : récurrence séquentielle (quantité, coût total). Retourne (held, cost, réalisé par vente)."""
+    realized = []
+    for qt, amt in zip(qty.tolist(), amount.tolist()):
+        if qt > 0:
+            held += qt
+            cost += amt
+            continue
+        sold = min(-qt, held)
+        unit = cost / held if held > EPS else 0.0
+        realized.append(amt - sold * unit - (-qt - sold) * fallback_cost)
+        cost -= sold * unit
+        held -= sold
+        if held <= EPS:
+            held, cost = 0.0, 0.0
+    return held, cost, np.array(realized, dtype=float)
+
+def replay(state: dict, trades: list, fallback_cost: float = 0.0) -> dict:
+    """
+    Applique des trades chronologiques [(jour ordinal, qty signée, montant > 0)]
+    à un état (cf. empty_state) ; retourne le nouvel état.
+    """
+    if not trades:
+        return state
+    days = np.array([t[0] for t in trades], dtype=np.int64)
+    qty = np.array([t[1] for t in trades], dtype=float)
+    amount = np.array([t[2] for t in trades], dtype=float)
+    sell_years = np.array([date.fromordinal(int(d)).year for d in days[qty < 0]], dtype=np.int64)
+    realized = {k: dict(v) for k, v in state["realized"].items()}
+
+    lots = np.array(state["fifo"], dtype=float).reshape(-1, 3)
+    lots, fifo_pnl, unmatched = fifo_pass(lots, days, qty, amount, fallback_cost)
+    _add_by_year(realized["fifo"], sell_years, fifo_pnl)
+
+    held, cost, avg_pnl = average_pass(*state["avg"], qty, amount, fallback_cost)
+    _add_by_year(realized["average"], sell_years, avg_pnl)
+
+    return {"fifo": [[int(d), round(q, 8), round(u, 8)] for d, q, u in lots.tolist()],
+            "avg": [round(held, 8), round(cost, 6)],
+            "realized": realized,
+            "unmatched_qty": round(state["unmatched_qty"] + float(unmatched.sum()), 8)}
+
+def _trade_row(amount, quantity, unit_price):
+    """(qty signée, montant > 0) d'un portfolio_trade, None s'il ne porte pas de titres."""
+    qty = signed_quantity(amount, quantity, unit_price)
+    if not qty:
+        return None
+    return qty, abs(trade_cash(amount, quantity, unit_price))
+
+def update_lots(session, asset_id: int, force: bool = False) -> dict:
+    """
+    Met à jour portfolio_lots pour un portefeuille (commit) et retourne
+    {isin: PortfolioLots}. Les trades sont lus en colonnes (pas d'objets ORM) ;
+    seuls ceux postérieurs au dernier trade appliqué sont rejoués.
+    """
+    rows = (session.query(AssetEvent.id, AssetEvent.isin, AssetEvent.value_date, AssetEvent.updated_at,
+                          AssetEvent.amount, AssetEvent.quantity, AssetEvent.unit_price)
+            .filter(AssetEvent.asset_id == asset_id,
+                    AssetEvent.status == "posted",
+                    AssetEvent.kind == "portfolio_trade",
+                    AssetEvent.isin.isnot(None))
+            .order_by(AssetEvent.value_date, AssetEvent.id).all())
+    by_isin = {}
+    for ev_id, isin, d, upd, amount, quantity, unit_price in rows:
+        isin = isin.strip().upper()
+        if isin:
+            by_isin.setdefault(isin, []).append((ev_id, d, upd, amount, quantity, unit_price))
+
+    fallback = {ln.isin.strip().upper(): safe_float(ln.avg_price, 0.0)
+                for ln in (session.query(PortfolioLine)
+                           .join(AssetPortfolio, AssetPortfolio.id == PortfolioLine.portfolio_id)
+                           .filter(AssetPortfolio.asset_id == asset_id,
+                                   PortfolioLine.isin.isnot(None)).all())}
+    stored = {r.isin: r for r in session.query(PortfolioLots).filter(PortfolioLots.asset_id == asset_id).all()}
+
+    now = datetime.utcnow()
+    updates = []
+    for isin, evs in by_isin.items():
+        row = stored.get(isin)
+        start = 0
+        if row is not None and not force and row.last_date is not None:
+            mark = (row.last_date, row.last_event_id)
+            start = next((k for k, ev in enumerate(evs) if (ev[1], ev[0]) > mark), len(evs))
+            prefix_upd = max((ev[2] for ev in evs[:start] if ev[2] is not None), default=None)
+            if start != row.n_events or prefix_upd != row.events_updated_at:
+                start = 0
+        if row is not None and start == row.n_events and start == len(evs) and not force:
+            continue
+        state = row.state if (row is not None and start) else empty_state()
+        trades = []
+        for ev_id, d, upd, amount, quantity, unit_price in evs[start:]:
+            tr = _trade_row(amount, quantity, unit_price)
+            if tr is not None:
+                trades.append((d.toordinal(), *tr))
+        state = replay(state, trades, fallback.get(isin, 0.0))
+        updates.append({"asset_id": asset_id, "isin": isin, "last_date": evs[-1][1], "last_event_id": evs[-1][0],
+                        "n_events": len(evs),
+                        "events_updated_at": max((ev[2] for ev in evs if ev[2] is not None), default=None),
+                        "state": json.dumps(state), "computed_at": now})
+
+    gone = [isin for isin in stored if isin not in by_isin]    # ISIN sans plus aucun trade posté
+    if not updates and not gone:
+        return stored
+    if updates:
+        session.execute(STATE_SQL, updates)
+    if gone:
+        (session.query(PortfolioLots)
+         .filter(PortfolioLots.asset_id == asset_id, PortfolioLots.isin.in_(gone))
+         .delete(synchronize_session=False))
+    session.commit()
+    return {r.isin: r for r in session.query(PortfolioLots).filter(PortfolioLots.asset_id == asset_id).all()}
+
+def latest_closes(session, isins) -> dict:
+    """{isin: (date, close)} de la dernière clôture connue."""
+    isins = sorted(isins)
+    if not isins:
+        return {}
+    out = {}
+    store = get_store()
+    if store is not None:
+        for isin in isins:
+            k = store.position_isin(isin)
+            if k is not None:
+                j = int(store.offset[k + 1]) - 1
+                out[isin] = (date.fromordinal(int(store.day[j])), float(store.close[j]))
+        isins = [isin for isin in isins if isin not in out]
+        if not isins:
+            return out
+    last = (session.query(ProduitHisto.produit_id, func.max(ProduitHisto.date).label("d"))
+            .join(ProduitInvest, ProduitInvest.id == ProduitHisto.produit_id)
+            .filter(ProduitInvest.isin.in_(isins), ProduitHisto.close.isnot(None))
+            .group_by(ProduitHisto.produit_id).subquery())
+    rows = (session.query(ProduitInvest.isin, ProduitHisto.date, ProduitHisto.close)
+            .join(ProduitHisto, ProduitHisto.produit_id == ProduitInvest.id)
+            .join(last, (last.c.produit_id == ProduitHisto.produit_id) & (last.c.d == ProduitHisto.date))
+            .all())
+    out.update({isin: (d, float(close)) for isin, d, close in rows})
+    return out
+
+def lots_summary(rows: dict, closes: dict, method: str = "fifo", with_lots: bool = False) -> list[dict]:
+    """Position, PRU dérivé, réalisé par année et latent à la dernière clôture, par ISIN."""
+    out = []
+    for isin in sorted(rows):
+        st = rows[isin].state
+        if method == "fifo":
+            lots = np.array(st["fifo"], dtype=float).reshape(-1, 3)
+            units, cost = float(lots[:, 1].sum()), float((lots[:, 1] * lots[:, 2]).sum())
+        else:
+            units, cost = st["avg"]
+        realized = st["realized"][method]
+        last = closes.get(isin)
+        value = units * last[1] if last else None
+        item = {
+            "isin": isin,
+            "units": round(units, 8),
+            "cost_basis": round(cost, 2),
+            "avg_price": round(cost / units, 6) if units > EPS else None,
+            "last_close": last[1] if last else None,
+            "last_close_date": last[0].isoformat() if last else None,
+            "market_value": round(value, 2) if value is not None else None,
+            "unrealized": round(value - cost, 2) if value is not None else None,
+            "realized_by_year": {y: round(v, 2) for y, v in sorted(realized.items())},
+            "realized_total": round(sum(realized.values()), 2),
+            "unmatched_qty": st.get("unmatched_qty", 0.0),
+            "last_trade_date": rows[isin].last_date.isoformat() if rows[isin].last_date else None,
+        }
+        if with_lots and method == "fifo":
+            item["lots"] = [{"date": date.fromordinal(int(d)).isoformat(), "units": q, "unit_cost": u}
+                            for d, q, u in st["fifo"]]
+        out.append(item)
+    return out
@@ -3,7 +3,7 @@ from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy import (
     Column, Integer, String, Numeric, DateTime, ForeignKey, Text, Date, Boolean, BigInteger,
-    UniqueConstraint, Enum, Index  # ✅ AJOUT
+    UniqueConstraint, Enum, Index, LargeBinary  # ✅ AJOUT
 )
 
 from datetime import datetime
@@ -235,13 +235,35 @@ class ProduitInvest(Base):
     market = Column(String(100))
     sector = Column(String(100))
     created_at = Column(DateTime, default=datetime.utcnow)
+    content_hash = Column(String(16))           # empreinte JustETF (update_market_data_pg.py)
 
     histo = relationship("ProduitHisto", back_populates="produit", cascade="all, delete-orphan")
     intraday = relationship("ProduitIntraday", back_populates="produit", cascade="all, delete-orphan")
     indicateurs = relationship("ProduitIndicateurs", back_populates="produit", cascade="all, delete-orphan")
 
 
+class ProduitMeta(Base):
+    """Caractéristiques JustETF d'un ETF (écrites par update_market_data_pg.py)."""
+    __tablename__ = "produits_meta"
+
+    produit_id = Column(Integer, ForeignKey("produits_invest.id", ondelete="CASCADE"), primary_key=True)
+    inception_date = Column(Date)
+    domicile = Column(String(100))
+    replication = Column(String(100))
+    ter = Column(Numeric(8, 4))                 # en %
+    size = Column(Numeric(20, 2))               # encours
+    number_of_holdings = Column(BigInteger)
+    is_sustainable = Column(Boolean)
+    hedged = Column(Boolean)
+    securities_lending = Column(Boolean)
+    distribution_policy = Column(String(50))
+    last_dividend_date = Column(Date)
+    content_hash = Column(String(16))           # empreinte JustETF
+
+
 class ProduitHisto(Base):
+    # Postgres : table partitionnée par année (partitions.migrate, clé primaire réelle (id, date)) ;
+    # l'ORM n'identifie les lignes que par id, unique via la séquence
     __tablename__ = "produits_histo"
     id = Column(BigInteger, primary_key=True)
     produit_id = Column(Integer, ForeignKey("produits_invest.id", ondelete="CASCADE"), nullable=False)
@@ -254,8 +276,21 @@ class ProduitHisto(Base):
 
     produit = relationship("ProduitInvest", back_populates="histo")
 
+    __table_args__ = (UniqueConstraint("produit_id", "date", name="uq_produits_histo_produit_date"),)
+
+
+class ProduitHistoState(Base):
+    """Filigrane de l'ingestion OHLCV journalière (histo_ingest.py) : dernier jour chargé par produit."""
+    __tablename__ = "produits_histo_state"
+
+    produit_id = Column(Integer, ForeignKey("produits_invest.id", ondelete="CASCADE"), primary_key=True)
+    last_date = Column(Date)                 # dernière séance en base
+    checked_at = Column(DateTime)            # dernier passage (avec ou sans nouvelle séance)
+    error = Column(Text)                     # dernière erreur de téléchargement
+
 
 class ProduitIntraday(Base):
+    # Postgres : partitionnée par mois (partitions.migrate, clé primaire réelle (id, ts))
     __tablename__ = "produits_intraday"
     id = Column(BigInteger, primary_key=True)
     produit_id = Column(Integer, ForeignKey("produits_invest.id", ondelete="CASCADE"), nullable=False)
@@ -265,6 +300,31 @@ class ProduitIntraday(Base):
 
     produit = relationship("ProduitInvest", back_populates="intraday")
 
+    __table_args__ = (Index("ix_produits_intraday_produit_ts", "produit_id", "ts"),)
+
+
+class ProduitIntradayBar(Base):
+    """Agrégats OHLCV des cotations intraday par palier 1m / 1h / 1d (intraday_rollup.py)."""
+    __tablename__ = "produits_intraday_bars"
+
+    produit_id = Column(Integer, ForeignKey("produits_invest.id", ondelete="CASCADE"), primary_key=True)
+    tier = Column(String(4), primary_key=True)                   # "1m" / "1h" / "1d"
+    ts = Column(DateTime(timezone=True), primary_key=True)       # début de l'intervalle (UTC)
+    open = Column(Numeric(14, 4))
+    high = Column(Numeric(14, 4))
+    low = Column(Numeric(14, 4))
+    close = Column(Numeric(14, 4))
+    volume = Column(BigInteger)
+    n_ticks = Column(Integer, nullable=False, default=0)
+
+
+class IntradayRollupState(Base):
+    __tablename__ = "intraday_rollup_state"
+
+    tier = Column(String(4), primary_key=True)
+    rolled_until = Column(DateTime(timezone=True), nullable=False)   # source agrégée jusqu'à (exclu)
+    computed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
 
 class ProduitIndicateurs(Base):
     __tablename__ = "produits_indicateurs"
@@ -279,6 +339,33 @@ class ProduitIndicateurs(Base):
 
     produit = relationship("ProduitInvest", back_populates="indicateurs")
 
+    __table_args__ = (UniqueConstraint("produit_id", "date", name="uq_produits_indicateurs_produit_date"),)
+
+
+class ProduitIndicateursState(Base):
+    """État glissant des indicateurs par produit (indicators_engine.py) : reprise sans relire l'historique."""
+    __tablename__ = "produits_indicateurs_state"
+
+    produit_id = Column(Integer, ForeignKey("produits_invest.id", ondelete="CASCADE"), primary_key=True)
+    last_date = Column(Date, nullable=False)     # dernière séance calculée
+    n_bars = Column(Integer, nullable=False)
+    state = Column(JSONB, nullable=False)        # 50 dernières clôtures, EMA, moyennes RSI
+    computed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class ProduitStats(Base):
+    """Rendement / volatilité annualisés estimés sur produits_histo (product_returns.py, batch nuit)."""
+    __tablename__ = "produits_stats"
+    produit_id = Column(Integer, ForeignKey("produits_invest.id", ondelete="CASCADE"), primary_key=True)
+    as_of = Column(Date, nullable=False)
+    n_obs = Column(Integer, nullable=False)
+    drift = Column(Numeric(12, 8), nullable=False)   # log-rendement annuel moyen
+    vol = Column(Numeric(12, 8), nullable=False)     # écart-type annualisé
+    apy = Column(Numeric(12, 8), nullable=False)     # exp(drift) - 1
+    first_date = Column(Date)
+    last_date = Column(Date)
+    computed_at = Column(DateTime, default=datetime.utcnow)
+
 class BrokerLink(Base):
     __tablename__ = "broker_links"
     id = Column(Integer, primary_key=True)
@@ -347,4 +434,73 @@ class AssetEvent(Base):
     __table_args__ = (
         Index("ix_asset_events_user_asset_date", "user_id", "asset_id", "value_date"),
         Index("ix_asset_events_status_kind", "status", "kind"),
-    )
\ No newline at end of file
+    )
+
+
+# ========================
+# Projections précalculées (batch nuit)
+# ========================
+class ProjectionSnapshot(Base):
+    __tablename__ = "projection_snapshots"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    start = Column(Date, nullable=False)          # 1er jour du mois projeté
+    months = Column(Integer, nullable=False)
+    scenario = Column(String(20), nullable=False, default="base")
+    state_version = Column(String(40), nullable=False)  # empreinte de load_state()
+    payload = Column(LargeBinary, nullable=False)  # réponse JSON /api/projection, gzip
+    duration_ms = Column(Integer)
+    computed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+# ========================
+# Patrimoine historique (networth_history.py, batch nuit)
+# ========================
+class NetWorthHistory(Base):
+    __tablename__ = "net_worth_history"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    date = Column(Date, primary_key=True)
+    total = Column(Numeric(14, 2), nullable=False)
+    livrets = Column(Numeric(14, 2), nullable=False)
+    portfolios = Column(Numeric(14, 2), nullable=False)
+    immo_equity = Column(Numeric(14, 2), nullable=False)
+    other = Column(Numeric(14, 2), nullable=False)
+    computed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class NetWorthHistoryState(Base):
+    __tablename__ = "net_worth_history_state"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    first_date = Column(Date)
+    last_date = Column(Date, nullable=False)            # dernier jour calculé
+    ledger_version = Column(String(40), nullable=False)  # empreinte du journal asset_events posté
+    cash_anchor = Column(JSONB)                          # {asset_id: espèces à l'ancrage} des portefeuilles
+    computed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class PortfolioPerformance(Base):
+    """TWR / MWR par portefeuille et par ligne (performance_engine.py, batch nuit)."""
+    __tablename__ = "portfolio_performance"
+
+    asset_id = Column(Integer, ForeignKey("assets.id", ondelete="CASCADE"), primary_key=True)
+    as_of = Column(Date, nullable=False)
+    from_date = Column(Date)
+    version = Column(String(40), nullable=False)  # empreinte écritures trade / dividende + lignes
+    metrics = Column(JSONB, nullable=False)
+    computed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class PortfolioLots(Base):
+    """Lots FIFO / PRU moyen par ligne de portefeuille (lot_engine.py, mis à jour incrémentalement)."""
+    __tablename__ = "portfolio_lots"
+
+    asset_id = Column(Integer, ForeignKey("assets.id", ondelete="CASCADE"), primary_key=True)
+    isin = Column(String(20), primary_key=True)
+    last_date = Column(Date)                 # dernier trade appliqué (value_date, id)
+    last_event_id = Column(Integer)
+    n_events = Column(Integer, nullable=False, default=0)   # trades appliqués
+    events_updated_at = Column(DateTime)     # updated_at max des trades appliqués
+    state = Column(JSONB, nullable=False)    # lots ouverts, PRU, réalisé par année
+    computed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -0,0 +1,425 @@
+# networth_history.py
+"""
+Patrimoine net historique, reconstruit depuis le journal asset_events.
+
+Asset.current_value ne donne que la valeur d'aujourd'hui : on remonte le temps
+à partir de cette ancre en annulant les écritures postées postérieures.
+Pour un jour t et un actif :
+- livret / autre : valeur(t) = valeur actuelle - Σ flux postés après t
+  (cash_op, transfer, valuation_adjustment, ...)
+- portefeuille   : espèces(t) + Σ unités(t) × clôture(t), avec
+      espèces(t) = espèces à l'ancrage - Σ flux postés après t (achats / ventes,
+      dividendes, frais, versements)
+      espèces à l'ancrage = valeur actuelle - Σ unités actuelles × clôture du
+      jour du recalcul complet, figées dans net_worth_history_state.cash_anchor
+  unités(t) = unités actuelles (PortfolioLine.units) - Σ quantités achetées
+  après t, clôture(t) = dernière clôture ProduitHisto <= t : la valeur d'un jour
+  ne dépend pas des cours postérieurs, les jours ajoutés chaque nuit suivent le marché
+- immobilier     : valeur du bien - capital restant dû (loan_engine, avec les
+  remboursements anticipés postés, plancher 0 comme la projection), à partir
+  du début du premier prêt
+
+Tout est vectorisé sur (actifs × jours) : flux placés par np.add.at, sommes
+« après t » par cumsum inversé, cours par jointure as-of (searchsorted sur une
+clé composite produit/jour).
+
+Persistance : net_worth_history (une ligne par utilisateur et par jour) et
+net_worth_history_state (dernier jour calculé, empreinte du journal, espèces
+à l'ancrage). Le batch nuit (networth_nightly.py) ne calcule que les jours
+manquants, sauf si le journal ou une ancre a changé : tout est alors recalculé.
+Jours stockés et jours calculés à la volée partagent les mêmes espèces à
+l'ancrage ; check_history() compare les premiers à un recalcul complet.
+"""
+import hashlib
+import json
+import os
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy import text as sqltext
+from sqlalchemy.orm import joinedload
+
+from loan_engine import loan_params, prepayment_params, property_schedules
+from models import (
+    Asset, AssetEvent, AssetImmo, AssetPortfolio, NetWorthHistory, NetWorthHistoryState,
+    ProduitHisto, ProduitInvest,
+)
+from price_store import get_store
+from projection_engine import STACK_KEYS, safe_float
+
+HISTORY_RESOLUTIONS = ("daily", "monthly")
+HISTORY_MAX_YEARS = int(os.getenv("NETWORTH_HISTORY_MAX_YEARS", "10"))
+PRICE_LOOKBACK_DAYS = 31   # cours antérieurs au début chargés pour la jointure as-of
+
+# écritures qui modifient la valeur de l'actif qui les porte
+LEDGER_FLOW_KINDS = ("cash_op", "transfer", "portfolio_trade", "dividend", "valuation_adjustment")
+ASSET_STACK = {"livret": "livrets", "portfolio": "portfolios", "immo": "immo_equity"}
+
+UPSERT_SQL = sqltext("""
+    INSERT INTO net_worth_history (user_id, date, total, livrets, portfolios, immo_equity, other, computed_at)
+    VALUES (:user_id, :date, :total, :livrets, :portfolios, :immo_equity, :other, :computed_at)
+    ON CONFLICT (user_id, date) DO UPDATE SET
+        total = EXCLUDED.total,
+        livrets = EXCLUDED.livrets,
+        portfolios = EXCLUDED.portfolios,
+        immo_equity = EXCLUDED.immo_equity,
+        other = EXCLUDED.other,
+        computed_at = EXCLUDED.computed_at
+""")
+
+
+def signed_quantity(amount, quantity, unit_price) -> float:
+    """
+    Quantité signée d'un portfolio_trade (+ achat, - vente).
+    Le sens vient du montant (espèces sorties = achat, cf. import TR), sinon
+    du signe de la quantité ; sans quantité : |montant| / prix unitaire.
+    """
+    amount, quantity, unit_price = safe_float(amount, None), safe_float(quantity, None), safe_float(unit_price, None)
+    if quantity is None:
+        if not amount or not unit_price:
+            return 0.0
+        quantity = abs(amount) / abs(unit_price)
+    if amount:
+        return abs(quantity) if amount < 0 else -abs(quantity)
+    return quantity
+
+def trade_cash(amount, quantity, unit_price) -> float:
+    """Effet espèces d'un portfolio_trade : le montant, sinon -quantité signée × prix."""
+    amount = safe_float(amount, None)
+    if amount is not None:
+        return amount
+    return -signed_quantity(None, quantity, unit_price) * safe_float(unit_price, 0.0)
+
+def _load_assets(session, uid: int) -> list:
+    return (session.query(Asset)
+            .filter(Asset.user_id == uid)
+            .options(joinedload(Asset.livret),
+                     joinedload(Asset.other),
+                     joinedload(Asset.portfolio).joinedload(AssetPortfolio.lines),
+                     joinedload(Asset.immo).joinedload(AssetImmo.loans))
+            .order_by(Asset.id).all())
+
+def _anchor(a) -> float:
+    """Valeur actuelle de l'actif, point d'ancrage de la reconstruction à rebours."""
+    if a.type == "livret" and a.livret:
+        return safe_float(a.livret.balance, safe_float(a.current_value))
+    if a.type == "other" and a.other:
+        return safe_float(a.other.estimated_value, safe_float(a.current_value))
+    if a.type == "immo" and a.immo:
+        return safe_float(a.immo.last_estimation_value, safe_float(a.immo.purchase_price))
+    return safe_float(a.current_value, 0.0)
+
+def ledger_version(session, uid: int) -> str:
+    """
+    Empreinte de tout ce dont dépend l'historique reconstruit de `uid` : journal posté
+    (ajout / modification / suppression) et ancres actuelles (valeur de chaque actif,
+    unités des lignes, prêts) ; modifier une ancre décale tous les jours passés.
+    """
+    n, max_id, max_upd = (session.query(func.count(AssetEvent.id), func.max(AssetEvent.id),
+                                        func.max(AssetEvent.updated_at))
+                          .filter(AssetEvent.user_id == uid, AssetEvent.status == "posted")
+                          .one())
+    anchors = []
+    for a in _load_assets(session, uid):
+        lines = sorted((ln.isin or "", safe_float(ln.units, None), safe_float(ln.avg_price, None))
+                       for ln in (a.portfolio.lines if a.type == "portfolio" and a.portfolio else []) or [])
+        loans = [loan_params(ln) for ln in (a.immo.loans if a.type == "immo" and a.immo else []) or []]
+        anchors.append((a.id, a.type, _anchor(a), lines, loans))
+    raw = f"{n}|{max_id}|{max_upd}|{json.dumps(anchors, sort_keys=True, default=str)}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def load_ledger(session, uid: int, since: date | None, as_of: date) -> dict:
+    """
+    Ancres (valeurs actuelles), écritures postées et cours nécessaires pour
+    reconstruire ]since, as_of]. Seules les écritures postérieures à `since`
+    comptent pour les flux ; tous les trades servent aux unités sans PortfolioLine.units.
+    since=None : tout le journal, "since" = veille de default_history_start().
+    """
+    assets = _load_assets(session, uid)
+    events = (session.query(AssetEvent)
+              .filter(AssetEvent.user_id == uid,
+                      AssetEvent.status == "posted",
+                      AssetEvent.kind.in_(LEDGER_FLOW_KINDS + ("loan_prepayment",)))
+              .order_by(AssetEvent.value_date, AssetEvent.id).all())
+
+    out = {"assets": [], "flows": [], "trades": [], "lines": [], "immo": []}
+    index = {}
+    for a in assets:
+        anchor = _anchor(a)
+        index[a.id] = len(out["assets"])
+        out["assets"].append({"asset_id": a.id, "type": a.type if a.type in ASSET_STACK else "other",
+                              "label": a.label, "anchor": anchor})
+        if a.type == "portfolio" and a.portfolio:
+            for ln in a.portfolio.lines or []:
+                if ln.isin:
+                    out["lines"].append({"asset": index[a.id], "isin": ln.isin.strip().upper(),
+                                         "units": safe_float(ln.units, None), "avg_price": safe_float(ln.avg_price, None)})
+        if a.type == "immo" and a.immo:
+            prepay = [prepayment_params(ev) for ev in events
+                      if ev.asset_id == a.id and ev.kind == "loan_prepayment"]
+            out["immo"].append({"asset": index[a.id], "loans": [loan_params(ln) for ln in a.immo.loans or []],
+                                "prepayments": prepay})
+
+    for ev in events:
+        j = index.get(ev.asset_id)
+        if j is None or ev.kind == "loan_prepayment":
+            continue
+        if ev.kind == "portfolio_trade" and ev.isin:
+            qty = signed_quantity(ev.amount, ev.quantity, ev.unit_price)
+            if qty:
+                out["trades"].append((j, ev.isin.strip().upper(), ev.value_date.toordinal(), qty))
+        if since is not None and ev.value_date <= since:
+            continue
+        amount = (trade_cash(ev.amount, ev.quantity, ev.unit_price) if ev.kind == "portfolio_trade"
+                  else safe_float(ev.amount, 0.0))
+        if amount:
+            out["flows"].append((j, ev.value_date.toordinal(), amount))
+
+    if since is None:
+        since = default_history_start(out, as_of) - timedelta(days=1)
+    out["since"] = since
+
+    isins = {ln["isin"] for ln in out["lines"]} | {t[1] for t in out["trades"]}
+    out["prices"] = load_prices(session, isins, since, max(as_of, datetime.utcnow().date()))
+    return out
+
+def load_prices(session, isins, since: date, until: date) -> dict:
+    """
+    {isin: ([jours ordinaux], [clôtures])} triés par date, de `since` (moins
+    PRICE_LOOKBACK_DAYS pour la jointure as-of) à `until`. Les produits présents
+    dans le magasin de prix (price_store) sont servis par des tranches sans copie.
+    """
+    isins = sorted(isins)
+    if not isins:
+        return {}
+    prices, rest = {}, isins
+    store = get_store()
+    if store is not None:
+        rest = []
+        for isin in isins:
+            k = store.position_isin(isin)
+            if k is None:
+                rest.append(isin)
+                continue
+            s = store.series_at(k, since - timedelta(days=PRICE_LOOKBACK_DAYS), until)
+            if len(s["day"]):
+                prices[isin] = (s["day"], s["close"])
+        if not rest:
+            return prices
+    rows = (session.query(ProduitInvest.isin, ProduitHisto.date, ProduitHisto.close)
+            .join(ProduitHisto, ProduitHisto.produit_id == ProduitInvest.id)
+            .filter(ProduitInvest.isin.in_(rest),
+                    ProduitHisto.date >= since - timedelta(days=PRICE_LOOKBACK_DAYS),
+                    ProduitHisto.date <= until,
+                    ProduitHisto.close.isnot(None))
+            .order_by(ProduitInvest.isin, ProduitHisto.date).all())
+    for isin, d, close in rows:
+        prices.setdefault(isin, ([], []))
+        prices[isin][0].append(d.toordinal())
+        prices[isin][1].append(float(close))
+    return prices
+
+def _after(rows: np.ndarray, days: np.ndarray, ords: np.ndarray, vals: np.ndarray, n: int) -> np.ndarray:
+    """Σ des montants strictement postérieurs à chaque jour, par ligne : (n, D)."""
+    D = len(days)
+    mat = np.zeros((n, D))
+    late = np.zeros(n)
+    if len(vals):
+        inside = ords <= days[-1]
+        pos = np.searchsorted(days, ords[inside])       # écritures antérieures au début : ignorées par l'appelant
+        np.add.at(mat, (rows[inside], pos), vals[inside])
+        late = np.bincount(rows[~inside], weights=vals[~inside], minlength=n)
+    return late[:, None] + mat.sum(axis=1, keepdims=True) - np.cumsum(mat, axis=1)
+
+def _asof_prices(isins: list, prices: dict, days: np.ndarray, fallback: np.ndarray) -> np.ndarray:
+    """
+    Clôture <= jour pour chaque (isin, jour) : (H, D). Jointure as-of vectorisée
+    sur la clé composite k × SPAN + jour ; avant la première clôture connue, on
+    prend cette première clôture, sans historique du tout : `fallback`.
+    """
+    out = np.tile(fallback[:, None], (1, len(days))).astype(float)
+    known = [k for k, isin in enumerate(isins) if isin in prices]
+    if not known:
+        return out
+    # jours triés : bornes = premier / dernier élément (listes ou tranches du magasin de prix)
+    lo = min(int(prices[isins[k]][0][0]) for k in known)
+    span = int(max(days[-1], max(int(prices[isins[k]][0][-1]) for k in known)) - lo + 1)
+    keys = np.concatenate([k * span + (np.asarray(prices[isins[k]][0]) - lo) for k in known])
+    closes = np.concatenate([np.asarray(prices[isins[k]][1], dtype=float) for k in known])
+    first = {k: prices[isins[k]][1][0] for k in known}
+
+    kk = np.array(known)
+    q = kk[:, None] * span + (days[None, :] - lo)                      # (K, D)
+    idx = np.searchsorted(keys, q, side="right") - 1
+    hit = (idx >= 0) & (np.take(keys, np.maximum(idx, 0)) // span == kk[:, None])
+    vals = np.where(hit, np.take(closes, np.maximum(idx, 0)), np.array([first[k] for k in known])[:, None])
+    out[kk] = vals
+    return out
+
+def reconstruct(ledger: dict, start: date, end: date) -> dict:
+    """
+    Séries quotidiennes [start, end] : {"dates": [date], "total": (D,),
+    STACK_KEYS: (D,), "assets": [{asset_id, type, label, values (D,)}],
+    "cash": {asset_id: espèces à l'ancrage}}.
+    ledger["cash"] (facultatif) : espèces à l'ancrage déjà figées par portefeuille ;
+    à défaut, valeur actuelle - titres aux dernières clôtures.
+    """
+    days = np.arange(start.toordinal(), end.toordinal() + 1, dtype=np.int64)
+    D, A = len(days), len(ledger["assets"])
+    today = max(end, datetime.utcnow().date()).toordinal()
+    values = np.zeros((A, D))
+    if not D:
+        return {"dates": [], "total": np.zeros(0), **{k: np.zeros(0) for k in STACK_KEYS}, "assets": [], "cash": {}}
+
+    # --- flux : valeur(t) = ancre - Σ flux après t ---
+    anchor = np.array([a["anchor"] for a in ledger["assets"]], dtype=float)
+    if ledger["flows"]:
+        fr, fo, fv = (np.array(x) for x in zip(*ledger["flows"]))
+        values = anchor[:, None] - _after(fr.astype(int), days, fo.astype(np.int64), fv.astype(float), A)
+    else:
+        values = np.tile(anchor[:, None], (1, D))
+
+    # --- titres : unités(t) × cours(t) - titres inclus dans l'ancre (ancre - espèces à l'ancrage) ---
+    cash = {}
+    pairs = sorted({(ln["asset"], ln["isin"]) for ln in ledger["lines"]} | {(t[0], t[1]) for t in ledger["trades"]})
+    if pairs:
+        pos = {p: h for h, p in enumerate(pairs)}
+        H = len(pairs)
+        line_units = {(ln["asset"], ln["isin"]): ln for ln in ledger["lines"]}
+        total_qty = np.zeros(H)
+        if ledger["trades"]:
+            tr, tisin, to, tq = zip(*ledger["trades"])
+            th = np.array([pos[(a, i)] for a, i in zip(tr, tisin)])
+            to, tq = np.array(to, dtype=np.int64), np.array(tq, dtype=float)
+            total_qty = np.bincount(th, weights=tq, minlength=H)
+        units_now = np.array([total_qty[h] if (line_units.get(p) or {}).get("units") is None
+                              else line_units[p]["units"] for h, p in enumerate(pairs)], dtype=float)
+        after_q = (_after(th, days, to, tq, H) if ledger["trades"] else np.zeros((H, D)))
+        units = np.maximum(units_now[:, None] - after_q, 0.0)
+
+        isins = [p[1] for p in pairs]
+        fallback = np.array([(line_units.get(p) or {}).get("avg_price") or 0.0 for p in pairs], dtype=float)
+        px = _asof_prices(isins, ledger["prices"], days, fallback)
+        px_now = _asof_prices(isins, ledger["prices"], np.array([today]), fallback)[:, 0]
+        owner = np.array([p[0] for p in pairs])
+        held = np.zeros(A)
+        np.add.at(held, owner, units_now * px_now)
+        frozen = ledger.get("cash") or {}
+        for j in np.unique(owner).tolist():
+            aid = ledger["assets"][j]["asset_id"]
+            if aid in frozen:
+                held[j] = anchor[j] - frozen[aid]
+            cash[aid] = float(anchor[j] - held[j])
+        mtm = np.zeros((A, D))
+        np.add.at(mtm, owner, units * px)
+        values = values + mtm - held[:, None]
+
+    # --- immobilier : bien - capital restant dû, à partir du premier prêt ---
+    for im in ledger["immo"]:
+        scheds = property_schedules(im["loans"], im["prepayments"])
+        remain = np.zeros(D)
+        owned = np.ones(D, dtype=bool)
+        if scheds:
+            owned = days >= min(sched["start"] for sched in scheds.values()).toordinal()
+        for sched in scheds.values():
+            d_ord = np.array([d.toordinal() for d in sched["dates"]], dtype=np.int64)
+            rem = sched["with"]["remaining"]
+            i = np.searchsorted(d_ord, days, side="right") - 1
+            principal = rem[0] + sched["with"]["principal"][0] + sched["with"]["prepayment"][0]
+            remain += np.where(i >= 0, np.take(rem, np.maximum(i, 0)), principal)
+        values[im["asset"]] = np.where(owned, np.maximum(anchor[im["asset"]] - remain, 0.0), 0.0)
+
+    out = {"dates": [date.fromordinal(int(d)) for d in days], "total": values.sum(axis=0)}
+    for k in STACK_KEYS:
+        rows = [j for j, a in enumerate(ledger["assets"]) if ASSET_STACK.get(a["type"], "other") == k]
+        out[k] = values[rows].sum(axis=0) if rows else np.zeros(D)
+    out["assets"] = [{**{k: a[k] for k in ("asset_id", "type", "label")}, "values": values[j]}
+                     for j, a in enumerate(ledger["assets"])]
+    out["cash"] = cash
+    return out
+
+def default_history_start(ledger: dict, as_of: date) -> date:
+    """Première écriture / premier prêt, borné à HISTORY_MAX_YEARS ans avant `as_of`."""
+    candidates = [date.fromordinal(t[2]) for t in ledger["trades"]]
+    candidates += [date.fromordinal(f[1]) for f in ledger["flows"]]
+    candidates += [ln["start"] for im in ledger["immo"] for ln in im["loans"] if ln["start"]]
+    floor = date(as_of.year - HISTORY_MAX_YEARS, as_of.month, 1)
+    return max(min(candidates, default=as_of), floor)
+
+def month_ends(dates: list) -> np.ndarray:
+    """Index du dernier jour disponible de chaque mois."""
+    if not dates:
+        return np.zeros(0, dtype=int)
+    ym = np.array([d.year * 12 + d.month for d in dates])
+    return np.flatnonzero(np.r_[ym[1:] != ym[:-1], True])
+
+def stored_cash(st) -> dict:
+    """Espèces à l'ancrage figées au dernier recalcul complet : {asset_id: montant}."""
+    return {int(k): float(v) for k, v in ((st.cash_anchor if st is not None else None) or {}).items()}
+
+def update_history(session, uid: int, as_of: date, force: bool = False) -> dict:
+    """
+    Met à jour net_worth_history de `uid` jusqu'à `as_of` inclus : jours
+    manquants seulement (mêmes espèces à l'ancrage), ou tout l'historique si
+    le journal ou une ancre a changé (espèces à l'ancrage réévaluées).
+    """
+    version = ledger_version(session, uid)
+    st = session.get(NetWorthHistoryState, uid)
+    full = force or st is None or st.ledger_version != version or st.cash_anchor is None
+    if full:
+        ledger = load_ledger(session, uid, None, as_of)
+        start = ledger["since"] + timedelta(days=1)
+        session.query(NetWorthHistory).filter(NetWorthHistory.user_id == uid).delete(synchronize_session=False)
+    else:
+        start = st.last_date + timedelta(days=1)
+        if start > as_of:
+            return {"days": 0, "full": False}
+        ledger = load_ledger(session, uid, start - timedelta(days=1), as_of)
+        ledger["cash"] = stored_cash(st)
+
+    res = reconstruct(ledger, start, as_of)
+    now = datetime.utcnow()
+    rows = [{"user_id": uid, "date": d, "total": round(float(res["total"][i]), 2), "computed_at": now,
+             **{k: round(float(res[k][i]), 2) for k in STACK_KEYS}}
+            for i, d in enumerate(res["dates"])]
+    if rows:
+        session.execute(UPSERT_SQL, rows)
+    if st is None:
+        st = NetWorthHistoryState(user_id=uid)
+        session.add(st)
+    if full or st.first_date is None:
+        st.first_date = start
+        st.cash_anchor = {str(k): round(v, 2) for k, v in res["cash"].items()}
+    st.last_date = as_of
+    st.ledger_version = version
+    st.computed_at = now
+    session.commit()
+    return {"days": len(rows), "full": full}
+
+def check_history(session, uid: int) -> dict:
+    """
+    Compare les jours stockés de `uid` à un recalcul complet avec les mêmes
+    espèces à l'ancrage : {"days", "missing", "max_diff", "ok"} (arrondi au centime près) ;
+    None si rien n'est stocké ou si l'empreinte est périmée.
+    """
+    st = session.get(NetWorthHistoryState, uid)
+    if st is None or st.first_date is None or st.ledger_version != ledger_version(session, uid):
+        return None
+    rows = (session.query(NetWorthHistory)
+            .filter(NetWorthHistory.user_id == uid,
+                    NetWorthHistory.date >= st.first_date,
+                    NetWorthHistory.date <= st.last_date)
+            .order_by(NetWorthHistory.date.asc()).all())
+    ledger = load_ledger(session, uid, st.first_date - timedelta(days=1), st.last_date)
+    ledger["cash"] = stored_cash(st)
+    res = reconstruct(ledger, st.first_date, st.last_date)
+    live = {d: i for i, d in enumerate(res["dates"])}
+    diff = 0.0
+    for r in rows:
+        i = live[r.date]
+        for k in ("total",) + STACK_KEYS:
+            diff = max(diff, abs(float(getattr(r, k)) - float(res[k][i])))
+    missing = len(res["dates"]) - len(rows)
+    return {"days": len(rows), "missing": missing, "max_diff": round(diff, 2),
+            "ok": missing == 0 and diff <= 0.01}
@@ -0,0 +1,169 @@
+# networth_nightly.py
+"""
+Batch nuit : complète l'historique de patrimoine net (net_worth_history) de
+chaque utilisateur jusqu'à la veille.
+
+- seuls les jours manquants sont calculés ; si le journal asset_events d'un
+  utilisateur a changé depuis le dernier passage, son historique est recalculé
+  entièrement (cf. networth_history.update_history)
+- utilisateurs lus par paquets (pagination par clé), une transaction par utilisateur
+- --check : compare ensuite les jours stockés à un recalcul complet
+  (networth_history.check_history), écarts comptés dans "mismatch"
+- puis TWR / MWR de tous les portefeuilles (performance_engine.refresh_performance),
+  une passe vectorisée par paquet de portefeuilles
+
+Usage : python networth_nightly.py [--date YYYY-MM-DD] [--chunk-size 200] [--force]
+                                   [--check] [--skip-performance] [--verbose]
+"""
+import os, sys, time, argparse
+from datetime import date, datetime, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy import text as sqltext
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import sessionmaker
+from models import User
+from networth_history import check_history, update_history
+from performance_engine import refresh_performance
+import json
+
+DB_URL = os.environ["DATABASE_URL"]
+engine = create_engine(DB_URL, future=True, poolclass=NullPool)
+Session = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+JOB_NAME = "networth-history"
+
+
+def run_history(as_of: date, chunk_size: int = 200, force: bool = False, check: bool = False,
+                verbose: bool = False):
+    stats = {"inserted": 0, "skipped": 0, "failed": 0, "full": 0, "mismatch": 0, "details": []}
+    last_id = 0
+    s = Session()
+    try:
+        while True:
+            ids = [uid for (uid,) in (s.query(User.id)
+                                       .filter(User.id > last_id)
+                                       .order_by(User.id)
+                                       .limit(chunk_size).all())]
+            if not ids:
+                break
+            last_id = ids[-1]
+            for uid in ids:
+                try:
+                    res = update_history(s, uid, as_of, force=force)
+                    chk = check_history(s, uid) if check else None
+                except Exception as e:
+                    s.rollback()
+                    stats["failed"] += 1
+                    stats["details"].append({"user_id": uid, "error": str(e)[:200]})
+                    continue
+                if res["days"]:
+                    stats["inserted"] += res["days"]
+                    stats["full"] += int(res["full"])
+                else:
+                    stats["skipped"] += 1
+                if verbose:
+                    print(f"user {uid}: {res['days']} jours{' (recalcul complet)' if res['full'] else ''}")
+                if chk is not None and not chk["ok"]:
+                    stats["mismatch"] += 1
+                    stats["details"].append({"user_id": uid, "check": chk})
+        return True, stats
+    except Exception as e:
+        s.rollback()
+        return False, {"error": str(e), **stats}
+    finally:
+        s.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--date", help="dernier jour calculé, YYYY-MM-DD (par défaut: hier UTC)")
+    parser.add_argument("--chunk-size", type=int, default=int(os.getenv("NETWORTH_HISTORY_CHUNK", "200")))
+    parser.add_argument("--force", action="store_true", help="recalcule tout l'historique")
+    parser.add_argument("--check", action="store_true", help="compare l'historique stocké à un recalcul complet")
+    parser.add_argument("--skip-performance", action="store_true", help="ne recalcule pas portfolio_performance")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    as_of = (datetime.utcnow().date() - timedelta(days=1)) if not args.date else date.fromisoformat(args.date)
+
+    # 1) job_runs: running
+    s = Session()
+    try:
+        run_id = s.execute(
+            sqltext("""
+                INSERT INTO job_runs (job_name, run_date, started_at, state)
+                VALUES (:name, :run_date, now(), 'running')
+                RETURNING id
+            """),
+            {"name": JOB_NAME, "run_date": as_of}
+        ).scalar_one()
+        s.commit()
+    except:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+    # 2) run
+    t0 = time.perf_counter()
+    ok, stats = run_history(as_of, chunk_size=args.chunk_size, force=args.force,
+                            check=args.check, verbose=args.verbose)
+    performance = None
+    if not args.skip_performance:
+        s = Session()
+        try:
+            performance = refresh_performance(s, as_of, chunk_size=args.chunk_size, verbose=args.verbose)
+        except Exception as e:
+            s.rollback()
+            performance = {"error": str(e)[:200]}
+        finally:
+            s.close()
+    elapsed = round(time.perf_counter() - t0, 1)
+
+    # 3) job_runs: finalize
+    s = Session()
+    try:
+        msg_obj = {"stats": {"days_written": stats.get("inserted", 0),
+                             "users_up_to_date": stats.get("skipped", 0),
+                             "users_full_rebuild": stats.get("full", 0),
+                             "failed": stats.get("failed", 0),
+                             "mismatch": stats.get("mismatch", 0),
+                             "seconds": elapsed},
+                   "performance": performance,
+                   "details": stats.get("details", [])[:20]}
+        if "error" in stats:
+            msg_obj["error"] = stats["error"]
+        msg = json.dumps(msg_obj, ensure_ascii=False)[:1000]
+
+        s.execute(
+            sqltext("""
+                UPDATE job_runs
+                SET finished_at = now(),
+                    state        = :state,
+                    ok           = :ok,
+                    items_inserted = :ins,
+                    items_skipped  = :skp,
+                    items_failed   = :fld,
+                    message        = :msg
+                WHERE id = :id
+            """),
+            {
+                "state": "done" if ok else "error",
+                "ok": bool(ok),
+                "ins": int(stats.get("inserted", 0)),
+                "skp": int(stats.get("skipped", 0)),
+                "fld": int(stats.get("failed", 0)),
+                "msg": msg,
+                "id": run_id
+            }
+        )
+        s.commit()
+    except:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+    print(("OK" if ok else "ERROR"), {k: v for k, v in stats.items() if k != "details"}, f"{elapsed}s")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# partitions.py
+"""
+Partitionnement par plage des tables de cours (PostgreSQL, déclaratif) :
+- produits_histo    : par année sur date   (produits_histo_y2025, ...)
+- produits_intraday : par mois sur ts      (produits_intraday_m202510, ...)
+plus une partition DEFAULT par table (valeurs hors plages, doit rester vide).
+
+Les requêtes filtrent toujours produit_id + plage de date / ts sur la colonne
+brute (sans fonction ni cast) : le planificateur n'ouvre que les partitions
+concernées, puis l'index (produit_id, date|ts) de chacune.
+
+- ensure_partitions() : crée les partitions manquantes d'une plage (appelé par
+  histo_ingest.py et intraday_nightly.py, en avance sur les données)
+- drop_partitions_before() : rétention par DROP de partitions entières, au lieu
+  de gros DELETE (cf. intraday_rollup.prune)
+- migrate() : bascule d'une table existante non partitionnée (copie par
+  partition, séquence d'id conservée, ancienne table renommée *_legacy) ; seul
+  chemin de création du partitionnement : models.py décrit des tables simples
+  (clé primaire id, portable SQLite), db_init.py bascule les tables vides
+
+Usage : python partitions.py ensure
+        python partitions.py migrate [--table produits_histo] [--drop-legacy]
+"""
+import os, argparse
+from datetime import date, datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy import text as sqltext
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import sessionmaker
+
+# table -> (colonne, granularité)
+PARTITIONED = {"produits_histo": ("date", "year"), "produits_intraday": ("ts", "month")}
+HISTO_AHEAD_YEARS = 1
+INTRADAY_AHEAD_MONTHS = 3
+
+IS_PARTITIONED_SQL = sqltext("""
+    SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid
+    WHERE c.relname = :table
+""")
+
+PARTITIONS_SQL = sqltext("""
+    SELECT c.relname FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_class p ON p.oid = i.inhparent
+    WHERE p.relname = :table
+""")
+
+
+def _floor(d: date, grain: str) -> date:
+    return date(d.year, 1, 1) if grain == "year" else date(d.year, d.month, 1)
+
+def _next(d: date, grain: str) -> date:
+    if grain == "year":
+        return date(d.year + 1, 1, 1)
+    return date(d.year + (d.month == 12), d.month % 12 + 1, 1)
+
+def partition_name(table: str, d: date) -> str:
+    grain = PARTITIONED[table][1]
+    return f"{table}_y{d.year}" if grain == "year" else f"{table}_m{d.year}{d.month:02d}"
+
+def partition_bounds(table: str, start: date, end: date) -> list[tuple[str, date, date]]:
+    """(nom, début inclus, fin exclue) des partitions couvrant [start, end]."""
+    grain = PARTITIONED[table][1]
+    out, d = [], _floor(start, grain)
+    while d <= end:
+        out.append((partition_name(table, d), d, _next(d, grain)))
+        d = _next(d, grain)
+    return out
+
+def is_partitioned(session, table: str) -> bool:
+    return session.execute(IS_PARTITIONED_SQL, {"table": table}).first() is not None
+
+def _bound(table: str, d: date) -> str:
+    """Borne littérale ; minuit UTC pour les colonnes timestamptz."""
+    return d.isoformat() if PARTITIONED[table][0] == "date" else f"{d.isoformat()} 00:00:00+00"
+
+def ensure_partitions(session, table: str, start: date, end: date, commit: bool = True) -> list[str]:
+    """Crée (IF NOT EXISTS) les partitions de [start, end] ; sans effet si la table n'est pas partitionnée."""
+    if not is_partitioned(session, table):
+        return []
+    existing = {r[0] for r in session.execute(PARTITIONS_SQL, {"table": table}).all()}
+    created = []
+    for name, lo, hi in partition_bounds(table, start, end):
+        if name in existing:
+            continue
+        session.execute(sqltext(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{_bound(table, lo)}') TO ('{_bound(table, hi)}')"))
+        created.append(name)
+    if f"{table}_default" not in existing:
+        session.execute(sqltext(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+        created.append(f"{table}_default")
+    if commit:
+        session.commit()
+    return created
+
+def ensure_default_partitions(session, today: date | None = None) -> dict:
+    """Partitions courantes et à venir des deux tables (HISTO_AHEAD_YEARS / INTRADAY_AHEAD_MONTHS)."""
+    today = today or datetime.utcnow().date()
+    ahead = today
+    for _ in range(INTRADAY_AHEAD_MONTHS):
+        ahead = _next(ahead, "month")
+    return {
+        "produits_histo": ensure_partitions(session, "produits_histo", today, date(today.year + HISTO_AHEAD_YEARS, 1, 1)),
+        "produits_intraday": ensure_partitions(session, "produits_intraday", today, ahead),
+    }
+
+def drop_partitions_before(session, table: str, cutoff: date) -> list[str]:
+    """Détache et supprime les partitions entièrement antérieures à `cutoff`."""
+    if not is_partitioned(session, table):
+        return []
+    grain = PARTITIONED[table][1]
+    dropped = []
+    # partitions du parent uniquement (noms générés par partition_name)
+    for (name,) in session.execute(PARTITIONS_SQL, {"table": table}).all():
+        if name.endswith("_default"):
+            continue
+        tag = name.rsplit("_", 1)[-1]
+        lo = date(int(tag[1:5]), 1, 1) if grain == "year" else date(int(tag[1:5]), int(tag[5:7]), 1)
+        if _next(lo, grain) <= cutoff:
+            session.execute(sqltext(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            session.execute(sqltext(f"DROP TABLE {name}"))
+            dropped.append(name)
+    session.commit()
+    return dropped
+
+def migrate(session, table: str, drop_legacy: bool = False, verbose: bool = False) -> dict:
+    """
+    Bascule `table` vers une table partitionnée de même schéma :
+    1) renommage en {table}_legacy, création du parent partitionné (clé primaire
+       (id, colonne), contrainte / index (produit_id, colonne)), séquence d'id reprise
+    2) partitions couvrant les données existantes (+ avance), copie partition par partition
+    Une seule transaction : en cas d'erreur, la table d'origine reste en place.
+    """
+    if is_partitioned(session, table):
+        return {"table": table, "migrated": False, "reason": "already partitioned"}
+    col, grain = PARTITIONED[table]
+    legacy = f"{table}_legacy"
+    bounds = session.execute(sqltext(f"SELECT min({col}), max({col}) FROM {table}")).first()
+
+    index = "uq_produits_histo_produit_date" if table == "produits_histo" else "ix_produits_intraday_produit_ts"
+    session.execute(sqltext(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    # noms d'index uniques par schéma : ceux de l'ancienne table sont renommés (contraintes comprises)
+    session.execute(sqltext(f"ALTER INDEX IF EXISTS {table}_pkey RENAME TO {legacy}_pkey"))
+    session.execute(sqltext(f"ALTER INDEX IF EXISTS {index} RENAME TO {index}_legacy"))
+    session.execute(sqltext(
+        f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        f"PARTITION BY RANGE ({col})"))
+    session.execute(sqltext(f"ALTER TABLE {table} ADD PRIMARY KEY (id, {col})"))
+    session.execute(sqltext(
+        f"ALTER TABLE {table} ADD CONSTRAINT {table}_produit_id_fkey FOREIGN KEY (produit_id) "
+        f"REFERENCES produits_invest (id) ON DELETE CASCADE"))
+    if table == "produits_histo":
+        session.execute(sqltext(f"ALTER TABLE {table} ADD CONSTRAINT {index} UNIQUE (produit_id, {col})"))
+    else:
+        session.execute(sqltext(f"CREATE INDEX {index} ON {table} (produit_id, {col})"))
+    seq = session.execute(sqltext("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": legacy}).scalar()
+    if seq:
+        session.execute(sqltext(f"ALTER SEQUENCE {seq} OWNED BY {table}.id"))
+
+    today = datetime.utcnow().date()
+    lo = bounds[0] if bounds[0] is not None else today
+    lo = lo.date() if isinstance(lo, datetime) else lo
+    created = ensure_partitions(session, table, lo, _next(_next(today, grain), grain), commit=False)
+
+    copied = 0
+    for name, p_lo, p_hi in partition_bounds(table, lo, today):
+        n = session.execute(sqltext(
+            f"INSERT INTO {table} SELECT * FROM {legacy} WHERE {col} >= :lo AND {col} < :hi"),
+            {"lo": _bound(table, p_lo), "hi": _bound(table, p_hi)}).rowcount
+        copied += n
+        if verbose:
+            print(f"{name}: {n} lignes")
+    copied += session.execute(sqltext(
+        f"INSERT INTO {table} SELECT * FROM {legacy} WHERE {col} >= :hi"),
+        {"hi": _bound(table, _next(_floor(today, grain), grain))}).rowcount
+    if drop_legacy:
+        session.execute(sqltext(f"DROP TABLE {legacy}"))
+    session.commit()
+    return {"table": table, "migrated": True, "partitions": len(created), "rows": copied}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=("ensure", "migrate"))
+    parser.add_argument("--table", choices=tuple(PARTITIONED), help="par défaut : les deux tables")
+    parser.add_argument("--drop-legacy", action="store_true", help="supprime l'ancienne table après copie")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    engine = create_engine(os.environ["DATABASE_URL"], future=True, poolclass=NullPool)
+    s = sessionmaker(bind=engine, autoflush=False, autocommit=False)()
+    try:
+        if args.action == "ensure":
+            print(ensure_default_partitions(s))
+        else:
+            for table in ([args.table] if args.table else list(PARTITIONED)):
+                print(migrate(s, table, drop_legacy=args.drop_legacy, verbose=args.verbose))
+    except Exception:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+# performance_engine.py
+"""
+Performance réalisée des portefeuilles (AssetPortfolio) et de leurs lignes
+(PortfolioLine, par ISIN), à partir des portfolio_trade / dividend postés et
+des clôtures ProduitHisto.
+
+Périmètre : les titres (unités × cours), hors espèces non investies. Du point
+de vue de l'investisseur, un achat est un apport, une vente ou un dividende un
+retrait. Les unités d'un jour sont les unités actuelles (PortfolioLine.units,
+sinon la somme des trades) moins les trades postérieurs ; la position
+d'ouverture est valorisée au premier jour de la fenêtre.
+
+- TWR : rendements chaînés entre deux flux externes,
+      r = (V_fin - flux) / V_début - 1,  TWR = Π (1 + r) - 1
+  les sous-périodes sont délimitées par les jours de flux du portefeuille
+  (pas de valorisation quotidienne inutile)
+- MWR : TRI annualisé (XIRR) des flux + valeur finale, résolu par Newton
+  vectorisé sur toutes les lignes / portefeuilles à la fois
+
+Tout le calcul d'un lot d'actifs (plusieurs utilisateurs pour le batch nuit)
+se fait en une passe : points (ligne, jour) indexés par une clé composite,
+jointures as-of par searchsorted, sommes par ligne par bincount.
+Résultats mis en cache par actif + empreinte (écritures + lignes) : un nouvel
+événement invalide l'entrée.
+"""
+import hashlib
+import json
+import os
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy import text as sqltext
+from sqlalchemy.orm import joinedload
+
+from models import Asset, AssetEvent, AssetPortfolio, PortfolioLine, PortfolioPerformance
+from networth_history import load_prices, signed_quantity, trade_cash
+from projection_engine import safe_float
+from utils import LRUCache
+
+PERFORMANCE_KINDS = ("portfolio_trade", "dividend")
+DEFAULT_WINDOW_DAYS = 365   # fenêtre par défaut d'un portefeuille sans trade
+XIRR_MAX_ITER = 60
+XIRR_TOL = 1e-10
+
+_perf_cache = LRUCache(int(os.getenv("PERFORMANCE_CACHE_SIZE", "1024")))
+
+UPSERT_SQL = sqltext("""
+    INSERT INTO portfolio_performance (asset_id, as_of, from_date, version, metrics, computed_at)
+    VALUES (:asset_id, :as_of, :from_date, :version, :metrics, :computed_at)
+    ON CONFLICT (asset_id) DO UPDATE SET
+        as_of = EXCLUDED.as_of,
+        from_date = EXCLUDED.from_date,
+        version = EXCLUDED.version,
+        metrics = EXCLUDED.metrics,
+        computed_at = EXCLUDED.computed_at
+""")
+
+
+def asset_versions(session, asset_ids: list[int]) -> dict:
+    """{asset_id: empreinte} des écritures trade / dividende postées et des unités des lignes."""
+    if not asset_ids:
+        return {}
+    agg = {aid: (n, mx, upd) for aid, n, mx, upd in
+           (session.query(AssetEvent.asset_id, func.count(AssetEvent.id), func.max(AssetEvent.id),
+                          func.max(AssetEvent.updated_at))
+            .filter(AssetEvent.asset_id.in_(asset_ids),
+                    AssetEvent.status == "posted",
+                    AssetEvent.kind.in_(PERFORMANCE_KINDS))
+            .group_by(AssetEvent.asset_id).all())}
+    lines = {}
+    for aid, lid, isin, units in (session.query(AssetPortfolio.asset_id, PortfolioLine.id, PortfolioLine.isin,
+                                                PortfolioLine.units)
+                                  .join(PortfolioLine, PortfolioLine.portfolio_id == AssetPortfolio.id)
+                                  .filter(AssetPortfolio.asset_id.in_(asset_ids))
+                                  .order_by(PortfolioLine.id).all()):
+        lines.setdefault(aid, []).append((lid, isin, str(units)))
+    return {aid: hashlib.sha1(f"{agg.get(aid)}|{lines.get(aid)}".encode("utf-8")).hexdigest()
+            for aid in asset_ids}
+
+def load_portfolios(session, asset_ids: list[int]) -> list[dict]:
+    """Lignes et écritures (toutes dates) des portefeuilles `asset_ids`."""
+    assets = (session.query(Asset)
+              .filter(Asset.id.in_(asset_ids), Asset.type == "portfolio")
+              .options(joinedload(Asset.portfolio).joinedload(AssetPortfolio.lines))
+              .order_by(Asset.id).all())
+    events = (session.query(AssetEvent)
+              .filter(AssetEvent.asset_id.in_([a.id for a in assets]),
+                      AssetEvent.status == "posted",
+                      AssetEvent.kind.in_(PERFORMANCE_KINDS),
+                      AssetEvent.isin.isnot(None))
+              .order_by(AssetEvent.asset_id, AssetEvent.value_date, AssetEvent.id).all())
+    by_asset = {}
+    for ev in events:
+        by_asset.setdefault(ev.asset_id, []).append(ev)
+
+    out = []
+    for a in assets:
+        pf = {"asset_id": a.id, "user_id": a.user_id, "label": a.label, "lines": {}, "trades": [], "dividends": []}
+        for ln in (a.portfolio.lines if a.portfolio else None) or []:
+            if ln.isin:
+                pf["lines"][ln.isin.strip().upper()] = {"line_id": ln.id, "units": safe_float(ln.units, None),
+                                                        "avg_price": safe_float(ln.avg_price, None)}
+        for ev in by_asset.get(a.id, []):
+            isin = ev.isin.strip().upper()
+            if ev.kind == "dividend":
+                amount = safe_float(ev.amount, 0.0)
+                if amount:
+                    pf["dividends"].append((isin, ev.value_date.toordinal(), abs(amount)))
+                continue
+            qty = signed_quantity(ev.amount, ev.quantity, ev.unit_price)
+            if qty:
+                pf["trades"].append((isin, ev.value_date.toordinal(), qty, trade_cash(ev.amount, ev.quantity, ev.unit_price)))
+        out.append(pf)
+    return out
+
+def _group_cumsum_after(keys: np.ndarray, vals: np.ndarray, qkeys: np.ndarray, group_lo: np.ndarray,
+                        group_hi: np.ndarray) -> np.ndarray:
+    """Σ vals de clé > qkey dans le même groupe [group_lo, group_hi[ de clés (clés triées)."""
+    if not len(keys):
+        return np.zeros(len(qkeys))
+    c = np.r_[0.0, np.cumsum(vals)]
+    at = np.searchsorted(keys, qkeys, side="right")
+    hi = np.searchsorted(keys, group_hi, side="left")
+    return c[hi] - c[np.maximum(at, np.searchsorted(keys, group_lo, side="left"))]
+
+def xirr(rows: np.ndarray, years: np.ndarray, cf: np.ndarray, n: int) -> np.ndarray:
+    """
+    TRI annualisé de n séries de flux données en triplets (série, années depuis
+    le premier flux, montant). Newton sur x = log(1 + r), toutes séries en même
+    temps. NaN si pas de changement de signe ou non convergé.
+    """
+    if not n:
+        return np.zeros(0)
+    pos = np.bincount(rows, weights=(cf > 0).astype(float), minlength=n) > 0
+    neg = np.bincount(rows, weights=(cf < 0).astype(float), minlength=n) > 0
+    x = np.full(n, 0.05)
+    step = np.full(n, np.inf)
+    for _ in range(XIRR_MAX_ITER):
+        e = cf * np.exp(-x[rows] * years)
+        f = np.bincount(rows, weights=e, minlength=n)
+        fp = np.bincount(rows, weights=-years * e, minlength=n)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = np.where(fp != 0, f / fp, 0.0)
+        step = np.clip(np.nan_to_num(step), -1.0, 1.0)
+        x = x - step
+        if np.all(np.abs(step) < XIRR_TOL):
+            break
+    ok = pos & neg & (np.abs(step) < 1e-6) & np.isfinite(x)
+    return np.where(ok, np.expm1(x), np.nan)
+
+def evaluate(portfolios: list[dict], prices: dict, end: date, start: date | None = None) -> dict:
+    """
+    Performance de chaque portefeuille (et de ses lignes) sur [start, end] ;
+    start=None : premier trade / dividende, sinon DEFAULT_WINDOW_DAYS avant `end`.
+    Retourne {asset_id: {...}}.
+    """
+    end_o = end.toordinal()
+    today_o = max(end, datetime.utcnow().date()).toordinal()
+
+    # --- lignes (pf, isin) et points (ligne, jour) : jours de flux du portefeuille + ouverture + fin ---
+    rows, pts_row, pts_day, pf_meta = [], [], [], []
+    for pf in portfolios:
+        isins = sorted(set(pf["lines"]) | {t[0] for t in pf["trades"]} | {d[0] for d in pf["dividends"]})
+        flow_days = [t[1] for t in pf["trades"]] + [d[1] for d in pf["dividends"]]
+        s_o = start.toordinal() if start else (min(flow_days) if flow_days else end_o - DEFAULT_WINDOW_DAYS)
+        s_o = min(s_o, end_o)
+        days = np.unique(np.array([s_o - 1, end_o] + [d for d in flow_days if s_o <= d <= end_o], dtype=np.int64))
+        pf_meta.append({"pf": pf, "from": s_o, "days": days, "rows": range(len(rows), len(rows) + len(isins))})
+        for isin in isins:
+            pts_row.append(np.full(len(days), len(rows)))
+            pts_day.append(days)
+            rows.append((pf, isin))
+    if not rows:
+        return {pf["asset_id"]: _empty_result(pf, end) for pf in portfolios}
+
+    H = len(rows)
+    pts_row = np.concatenate(pts_row)
+    pts_day = np.concatenate(pts_day)
+    all_days = [int(pts_day.min()), int(pts_day.max()), today_o]
+    all_days += [t[1] for pf in portfolios for t in pf["trades"]] + [d[1] for pf in portfolios for d in pf["dividends"]]
+    all_days += [int(v[0][0]) for v in prices.values() if len(v[0])] + [int(v[0][-1]) for v in prices.values() if len(v[0])]
+    base = min(all_days) - 1
+    span = max(all_days) - base + 1
+    pkey = pts_row * span + (pts_day - base)          # clé composite triée (ligne, jour)
+
+    # --- écritures indexées par ligne ---
+    row_of = {(id(pf), isin): h for h, (pf, isin) in enumerate(rows)}
+    t_key, t_qty, t_cash, d_key, d_amt = [], [], [], [], []
+    for pf in portfolios:
+        for isin, o, qty, cash in pf["trades"]:
+            h = row_of[(id(pf), isin)]
+            t_key.append(h * span + (o - base)); t_qty.append(qty); t_cash.append(cash)
+        for isin, o, amount in pf["dividends"]:
+            d_key.append(row_of[(id(pf), isin)] * span + (o - base)); d_amt.append(amount)
+    order = np.argsort(t_key, kind="stable")
+    t_key = np.asarray(t_key, dtype=np.int64)[order]
+    t_qty = np.asarray(t_qty, dtype=float)[order]
+    t_cash = np.asarray(t_cash, dtype=float)[order]
+    order = np.argsort(d_key, kind="stable")
+    d_key = np.asarray(d_key, dtype=np.int64)[order]
+    d_amt = np.asarray(d_amt, dtype=float)[order]
+
+    # --- unités à chaque point : unités actuelles - trades postérieurs ---
+    h_all = np.arange(H)
+    lo, hi = h_all * span, (h_all + 1) * span
+    total_q = _group_cumsum_after(t_key, t_qty, lo - 1, lo, hi)
+    units_now = np.array([total_q[h] if (pf["lines"].get(isin) or {}).get("units") is None
+                          else pf["lines"][isin]["units"] for h, (pf, isin) in enumerate(rows)])
+    units = np.maximum(units_now[pts_row] - _group_cumsum_after(t_key, t_qty, pkey, lo[pts_row], hi[pts_row]), 0.0)
+
+    # --- cours as-of (première clôture avant tout historique, sinon PRU) ---
+    isin_list = sorted({isin for _, isin in rows})
+    k_of = {isin: k for k, isin in enumerate(isin_list)}
+    hk, hc, first = [], [], np.zeros(len(isin_list))
+    for isin, k in k_of.items():
+        if isin in prices:
+            hk.append(k * span + (np.asarray(prices[isin][0]) - base))
+            hc.append(np.asarray(prices[isin][1], dtype=float))
+            first[k] = prices[isin][1][0]
+    hk = np.concatenate(hk) if hk else np.zeros(0, dtype=np.int64)
+    hc = np.concatenate(hc) if hc else np.zeros(0)
+    fallback = np.array([first[k_of[isin]] or (pf["lines"].get(isin) or {}).get("avg_price") or 0.0
+                         for pf, isin in rows])
+    row_k = np.array([k_of[isin] for _, isin in rows])
+    px = fallback[pts_row]
+    if len(hk):
+        q = row_k[pts_row] * span + (pts_day - base)
+        idx = np.maximum(np.searchsorted(hk, q, side="right") - 1, 0)
+        hit = (hk[idx] <= q) & (hk[idx] // span == row_k[pts_row])
+        px = np.where(hit, hc[idx], px)
+    value = units * px
+
+    # --- flux externes par point (apports + / retraits -) : trades et dividendes du jour ---
+    flow = np.zeros(len(pkey))
+    for keys, vals in ((t_key, -t_cash), (d_key, -d_amt)):
+        if len(keys):
+            at = np.searchsorted(pkey, keys)
+            ok = (at < len(pkey)) & (pkey[np.minimum(at, len(pkey) - 1)] == keys)
+            np.add.at(flow, at[ok], vals[ok])
+    first_pt = np.r_[True, pts_row[1:] != pts_row[:-1]]
+    flow[first_pt] = 0.0                               # flux antérieurs : inclus dans l'ouverture
+    units_end = np.zeros(H)
+    units_end[pts_row[np.r_[first_pt[1:], True]]] = units[np.r_[first_pt[1:], True]]
+
+    # --- agrégats portefeuille : mêmes jours pour toutes ses lignes ---
+    pf_of_row = np.zeros(H, dtype=int)
+    for j, m in enumerate(pf_meta):
+        pf_of_row[list(m["rows"])] = j
+    pf_day_key = pf_of_row[pts_row] * span + (pts_day - base)
+    ukeys, inv = np.unique(pf_day_key, return_inverse=True)
+    pf_value = np.bincount(inv, weights=value)
+    pf_flow = np.bincount(inv, weights=flow)
+    pf_row = ukeys // span
+
+    # séries : lignes (0..H-1) puis portefeuilles (H..H+P-1)
+    s_row = np.r_[pts_row, H + pf_row]
+    s_day = np.r_[pts_day, ukeys % span + base]
+    s_val = np.r_[value, pf_value]
+    s_flow = np.r_[flow, pf_flow]
+    n = H + len(pf_meta)
+    res = _series_metrics(s_row, s_day, s_val, s_flow, n)
+
+    out = {}
+    for j, m in enumerate(pf_meta):
+        pf = m["pf"]
+        lines = []
+        for h in m["rows"]:
+            isin = rows[h][1]
+            lines.append({"isin": isin, "line_id": (pf["lines"].get(isin) or {}).get("line_id"),
+                          "units": round(float(units_end[h]), 6), **_metrics_dict(res, h)})
+        out[pf["asset_id"]] = {
+            "asset_id": pf["asset_id"], "label": pf["label"],
+            "from": date.fromordinal(int(m["from"])).isoformat(), "to": end.isoformat(),
+            **_metrics_dict(res, H + j), "lines": lines,
+        }
+    for pf in portfolios:
+        out.setdefault(pf["asset_id"], _empty_result(pf, end))
+    return out
+
+def _series_metrics(row, day, val, flow, n) -> dict:
+    """TWR / XIRR de n séries de points (triées par série puis jour)."""
+    first = np.r_[True, row[1:] != row[:-1]]
+    last = np.r_[row[1:] != row[:-1], True]
+    prev_val = np.r_[0.0, val[:-1]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        growth = np.where(~first & (prev_val > 0), (val - flow) / prev_val, 1.0)
+    growth = np.where(np.isfinite(growth) & (growth > 0), growth, 1.0)
+    twr = np.expm1(np.bincount(row, weights=np.log(growth), minlength=n))
+
+    d0 = np.zeros(n); d0[row[first]] = day[first]
+    d1 = np.zeros(n); d1[row[last]] = day[last]
+    open_v = np.zeros(n); open_v[row[first]] = val[first]
+    end_v = np.zeros(n); end_v[row[last]] = val[last]
+    invested = np.bincount(row, weights=flow, minlength=n)
+    years = np.maximum(d1 - d0, 1) / 365.25
+    with np.errstate(over="ignore", invalid="ignore"):
+        twr_ann = np.where(years >= 1.0, np.power(1.0 + twr, 1.0 / years) - 1.0, twr)
+
+    # XIRR : ouverture (-V0), flux (-apports), valeur finale (+V)
+    cf = -flow.copy()
+    cf[first] -= val[first]
+    cf[last] += val[last]
+    t = (day - d0[row]) / 365.25
+    keep = cf != 0
+    mwr = xirr(row[keep], t[keep], cf[keep], n)
+    active = (open_v > 0) | (invested != 0) | (end_v > 0)
+    return {"twr": np.where(active, twr, np.nan), "twr_annualized": np.where(active, twr_ann, np.nan),
+            "mwr": mwr, "value": end_v, "open_value": open_v, "net_invested": invested,
+            "gain": end_v - open_v - invested}
+
+def _metrics_dict(res: dict, k: int) -> dict:
+    clean = lambda v, nd: None if not np.isfinite(v) else round(float(v), nd)
+    return {
+        "value": clean(res["value"][k], 2), "open_value": clean(res["open_value"][k], 2),
+        "net_invested": clean(res["net_invested"][k], 2), "gain": clean(res["gain"][k], 2),
+        "twr": clean(res["twr"][k], 6), "twr_annualized": clean(res["twr_annualized"][k], 6),
+        "mwr": clean(res["mwr"][k], 6),
+    }
+
+def _empty_result(pf: dict, end: date) -> dict:
+    return {"asset_id": pf["asset_id"], "label": pf["label"], "from": None, "to": end.isoformat(),
+            "value": 0.0, "open_value": 0.0, "net_invested": 0.0, "gain": 0.0,
+            "twr": None, "twr_annualized": None, "mwr": None, "lines": []}
+
+def portfolio_performance(session, asset_ids: list[int], end: date, start: date | None = None) -> dict:
+    """
+    {asset_id: performance}, avec cache mémoire par actif : seuls les actifs
+    dont l'empreinte a changé (nouvel événement, lignes modifiées) sont recalculés.
+    """
+    versions = asset_versions(session, asset_ids)
+    out, todo = {}, []
+    for aid in asset_ids:
+        hit = _perf_cache.get((aid, versions[aid], start, end))
+        if hit is None:
+            todo.append(aid)
+        else:
+            out[aid] = hit
+    if todo:
+        pfs = load_portfolios(session, todo)
+        isins = {i for pf in pfs for i in set(pf["lines"]) | {t[0] for t in pf["trades"]}}
+        since = start or min((date.fromordinal(t[1]) for pf in pfs for t in pf["trades"] + pf["dividends"]),
+                             default=end - timedelta(days=DEFAULT_WINDOW_DAYS))
+        prices = load_prices(session, isins, min(since, end - timedelta(days=DEFAULT_WINDOW_DAYS)),
+                             max(end, datetime.utcnow().date()))
+        for aid, res in evaluate(pfs, prices, end, start).items():
+            out[aid] = _perf_cache.put((aid, versions[aid], start, end), res)
+    return out
+
+def refresh_performance(session, as_of: date, chunk_size: int = 200, verbose: bool = False) -> dict:
+    """
+    Batch nuit : performance de tous les portefeuilles par paquets (une passe
+    vectorisée par paquet), stockée dans portfolio_performance si l'empreinte
+    ou la date ont changé.
+    """
+    stats = {"computed": 0, "unchanged": 0}
+    last_id = 0
+    while True:
+        ids = [aid for (aid,) in (session.query(Asset.id)
+                                  .filter(Asset.type == "portfolio", Asset.id > last_id)
+                                  .order_by(Asset.id).limit(chunk_size).all())]
+        if not ids:
+            break
+        last_id = ids[-1]
+        stored = {aid: (v, d) for aid, v, d in
+                  (session.query(PortfolioPerformance.asset_id, PortfolioPerformance.version, PortfolioPerformance.as_of)
+                   .filter(PortfolioPerformance.asset_id.in_(ids)).all())}
+        versions = asset_versions(session, ids)
+        todo = [aid for aid in ids if stored.get(aid) != (versions[aid], as_of)]
+        stats["unchanged"] += len(ids) - len(todo)
+        if not todo:
+            continue
+        res = portfolio_performance(session, todo, as_of)
+        now = datetime.utcnow()
+        session.execute(UPSERT_SQL, [{
+            "asset_id": aid, "as_of": as_of, "from_date": date.fromisoformat(r["from"]) if r["from"] else None,
+            "version": versions[aid], "metrics": json.dumps(r), "computed_at": now,
+        } for aid, r in res.items()])
+        session.commit()
+        stats["computed"] += len(res)
+        if verbose:
+            print(f"portfolio_performance: {len(res)} portefeuilles recalculés")
+    return stats
@@ -0,0 +1,260 @@
+# price_store.py
+"""
+Magasin colonnaire des clôtures journalières (produits_histo), en fichiers
+NumPy mappés en mémoire (np.load(mmap_mode="r")).
+
+Une « arène » par version, sous PRICE_STORE_DIR/<version>/ :
+- produit_id.npy (n,) int64 trié, isin.npy (n,), offset.npy (n + 1,) int64
+- day.npy (jours ordinaux int64), close.npy (float64), volume.npy (float64, NaN si nul)
+  concaténés par produit puis par date : les séances du produit k sont
+  [offset[k], offset[k + 1])
+- meta.json (built_at, last_date, produits, rows)
+Le fichier CURRENT désigne la version active ; il est remplacé atomiquement
+(os.replace) après écriture complète, les lecteurs ne voient jamais d'arène partielle.
+
+Les workers gunicorn mappent les mêmes fichiers : les pages sont partagées via
+le cache du noyau, et series() renvoie des vues (tranches) sans copie ni
+conversion Numeric -> float. Les séances sans clôture ne sont pas stockées.
+
+Reconstruction : par histo_ingest.py après le chargement de la nuit, ou
+`python price_store.py build`. Côté application, get_store() relit CURRENT
+quand il change et, si une ingestion plus récente que l'arène a réussi
+(job_runs "histo-ohlcv"), reconstruit en tâche de fond (un seul worker, verrou
+fcntl) ; en attendant, et pour les produits absents, lecture Postgres.
+"""
+import os
+import json
+import time
+import shutil
+import fcntl
+import logging
+import argparse
+import threading
+from datetime import date, datetime, timezone
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy import text as sqltext
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import sessionmaker
+
+from models import ProduitHisto, ProduitInvest
+
+STORE_DIR = os.getenv("PRICE_STORE_DIR", os.path.join(".cache", "price_store"))
+ENABLED = os.getenv("PRICE_STORE", "1") != "0"
+CHECK_SECONDS = float(os.getenv("PRICE_STORE_CHECK_SECONDS", "300"))
+CHUNK_SIZE = int(os.getenv("PRICE_STORE_CHUNK", "500"))
+KEEP_VERSIONS = 2
+INGEST_JOB = "histo-ohlcv"
+ARRAYS = ("produit_id", "isin", "offset", "day", "close", "volume")
+
+logger = logging.getLogger(__name__)
+
+LAST_INGEST_SQL = sqltext("""
+    SELECT max(finished_at) FROM job_runs WHERE job_name = :name AND ok IS TRUE
+""")
+
+
+class PriceStore:
+    """Arène ouverte en lecture seule (mmap)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        # index isin -> position (quelques milliers d'entrées)
+        self._by_isin = {str(isin).upper(): k for k, isin in enumerate(self.isin.tolist()) if isin}
+
+    @property
+    def built_at(self) -> datetime:
+        return datetime.fromisoformat(self.meta["built_at"])
+
+    def position(self, pid: int) -> int | None:
+        k = int(np.searchsorted(self.produit_id, pid))
+        return k if k < len(self.produit_id) and self.produit_id[k] == pid else None
+
+    def position_isin(self, isin: str) -> int | None:
+        return self._by_isin.get((isin or "").upper())
+
+    def series_at(self, k: int, dfrom: date | None = None, dto: date | None = None) -> dict:
+        """Vues day / close / volume du produit en position k, bornées à [dfrom, dto]."""
+        a, b = int(self.offset[k]), int(self.offset[k + 1])
+        day = self.day[a:b]
+        lo = int(np.searchsorted(day, dfrom.toordinal())) if dfrom else 0
+        hi = int(np.searchsorted(day, dto.toordinal(), side="right")) if dto else len(day)
+        return {"day": day[lo:hi], "close": self.close[a + lo:a + hi], "volume": self.volume[a + lo:a + hi]}
+
+    def series(self, pid: int, dfrom: date | None = None, dto: date | None = None) -> dict | None:
+        k = self.position(pid)
+        return None if k is None else self.series_at(k, dfrom, dto)
+
+
+def build(session, root: str = STORE_DIR, chunk_size: int = CHUNK_SIZE, verbose: bool = False) -> dict:
+    """
+    Matérialise toutes les clôtures dans une nouvelle arène puis l'active.
+    Lecture par paquets de produits (pagination par clé), une requête triée (produit, date) par paquet.
+    """
+    t0 = time.perf_counter()
+    started = datetime.utcnow()     # une ingestion terminée pendant la lecture rendra l'arène périmée
+    pids, isins, counts, days, closes, volumes = [], [], [], [], [], []
+    last_id = 0
+    while True:
+        chunk = (session.query(ProduitInvest.id, ProduitInvest.isin)
+                 .filter(ProduitInvest.id > last_id)
+                 .order_by(ProduitInvest.id)
+                 .limit(chunk_size).all())
+        if not chunk:
+            break
+        last_id = chunk[-1][0]
+        rows = (session.query(ProduitHisto.produit_id, ProduitHisto.date, ProduitHisto.close, ProduitHisto.volume)
+                .filter(ProduitHisto.produit_id.in_([pid for pid, _ in chunk]), ProduitHisto.close.isnot(None))
+                .order_by(ProduitHisto.produit_id, ProduitHisto.date).all())
+        n = len(rows)
+        rp = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+        days.append(np.fromiter((r[1].toordinal() for r in rows), dtype=np.int64, count=n))
+        closes.append(np.fromiter((float(r[2]) for r in rows), dtype=float, count=n))
+        volumes.append(np.fromiter((np.nan if r[3] is None else float(r[3]) for r in rows), dtype=float, count=n))
+        uniq, cnt = np.unique(rp, return_counts=True)
+        isin_of = dict(chunk)
+        pids.append(uniq)
+        counts.append(cnt)
+        isins.extend(isin_of[int(p)] or "" for p in uniq.tolist())
+        if verbose:
+            print(f"price_store: {len(uniq)} produits, {n} séances (id <= {last_id})")
+
+    arrays = {
+        "produit_id": _concat(pids, np.int64),
+        "isin": np.array(isins, dtype="U20"),
+        "offset": np.r_[0, np.cumsum(_concat(counts, np.int64))].astype(np.int64),
+        "day": _concat(days, np.int64),
+        "close": _concat(closes, float),
+        "volume": _concat(volumes, float),
+    }
+    meta = {"built_at": started.isoformat(), "produits": len(arrays["produit_id"]), "rows": len(arrays["day"]),
+            "last_date": date.fromordinal(int(arrays["day"].max())).isoformat() if len(arrays["day"]) else None}
+
+    version = datetime.utcnow().strftime("v%Y%m%dT%H%M%S%f")
+    path = os.path.join(root, version)
+    os.makedirs(path, exist_ok=True)
+    for name, arr in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), arr)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    tmp = os.path.join(root, f"CURRENT.{os.getpid()}")
+    with open(tmp, "w") as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(root, "CURRENT"))
+    _prune_versions(root, version)
+    return {**meta, "version": version, "seconds": round(time.perf_counter() - t0, 2)}
+
+def _concat(parts: list, dtype) -> np.ndarray:
+    return np.concatenate(parts).astype(dtype, copy=False) if parts else np.zeros(0, dtype=dtype)
+
+def _prune_versions(root: str, current: str):
+    # les lecteurs qui mappent encore une ancienne arène gardent leurs pages (fichiers supprimés, inodes vivants)
+    versions = sorted(d for d in os.listdir(root) if d.startswith("v") and d != current)
+    for d in versions[:max(len(versions) - (KEEP_VERSIONS - 1), 0)]:
+        shutil.rmtree(os.path.join(root, d), ignore_errors=True)
+
+def open_store(root: str = STORE_DIR) -> PriceStore | None:
+    try:
+        with open(os.path.join(root, "CURRENT")) as f:
+            return PriceStore(os.path.join(root, f.read().strip()))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+# --- accès partagé dans un process (workers gunicorn) ---
+
+_lock = threading.Lock()
+_state = {"store": None, "mtime": None, "checked": 0.0, "building": False}
+
+def get_store(session_factory=None, root: str = STORE_DIR) -> PriceStore | None:
+    """
+    Arène courante (rouverte si CURRENT a changé), None si absente ou désactivée.
+    Avec `session_factory`, vérifie au plus toutes les CHECK_SECONDS qu'aucune
+    ingestion plus récente n'a réussi, sinon lance la reconstruction en arrière-plan.
+    """
+    if not ENABLED:
+        return None
+    try:
+        mtime = os.stat(os.path.join(root, "CURRENT")).st_mtime
+    except OSError:
+        mtime = None
+    with _lock:
+        if mtime != _state["mtime"]:
+            _state["store"] = open_store(root) if mtime is not None else None
+            _state["mtime"] = mtime
+        store = _state["store"]
+        due = session_factory is not None and not _state["building"] and time.time() - _state["checked"] >= CHECK_SECONDS
+        if due:
+            _state["checked"] = time.time()
+    if due and _is_stale(session_factory, store):
+        with _lock:
+            _state["building"] = True
+        threading.Thread(target=_background_build, args=(session_factory, root), daemon=True).start()
+    return store
+
+def _is_stale(session_factory, store) -> bool:
+    s = session_factory()
+    try:
+        last = s.execute(LAST_INGEST_SQL, {"name": INGEST_JOB}).scalar()
+    except Exception:
+        s.rollback()
+        logger.exception("❌ price_store: lecture job_runs impossible")
+        return False
+    finally:
+        s.close()
+    if store is None:
+        return True
+    if last is None:
+        return False
+    if last.tzinfo is not None:     # timestamptz -> UTC naïf, comme built_at
+        last = last.astimezone(timezone.utc).replace(tzinfo=None)
+    return last > store.built_at
+
+def _background_build(session_factory, root: str):
+    try:
+        os.makedirs(root, exist_ok=True)
+        with open(os.path.join(root, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return      # un autre worker reconstruit déjà
+            s = session_factory()
+            try:
+                info = build(s, root)
+                logger.info(f"✅ price_store: arène {info['version']} ({info['rows']} séances, {info['seconds']}s)")
+            finally:
+                s.close()
+    except Exception:
+        # lecture Postgres en attendant ; nouvel essai après CHECK_SECONDS
+        logger.exception("❌ price_store: reconstruction en arrière-plan échouée")
+    finally:
+        with _lock:
+            _state["building"] = False
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=("build", "info"))
+    parser.add_argument("--dir", default=STORE_DIR)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.action == "info":
+        store = open_store(args.dir)
+        print({"path": store.path, **store.meta} if store else "absent")
+        return
+    engine = create_engine(os.environ["DATABASE_URL"], future=True, poolclass=NullPool)
+    s = sessionmaker(bind=engine, autoflush=False, autocommit=False)()
+    try:
+        os.makedirs(args.dir, exist_ok=True)
+        print(build(s, args.dir, verbose=args.verbose))
+    finally:
+        s.close()
+
+if __name__ == "__main__":
+    main()
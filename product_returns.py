@@ -0,0 +1,250 @@
+# product_returns.py
+"""
+Rendements attendus par produit, estimés sur l'historique ProduitHisto.
+
+Pour chaque produit (clôtures triées par produit puis date, fenêtre de
+PRODUCT_RETURNS_LOOKBACK_YEARS ans) :
+- rendements log journaliers r = log(close_t / close_t-1), calculés en un
+  seul passage NumPy sur tous les produits (pas de boucle par produit)
+- drift annuel = Σ r / durée en années (taux de croissance géométrique,
+  robuste aux jours fériés et trous de cotation)
+- volatilité annuelle = écart-type de r × √(observations par an)
+- apy = exp(drift) - 1 : c'est ce taux qui remplace portfolio_apy pour la ligne
+
+Les statistiques sont stockées dans produits_stats (refresh_product_stats,
+lancé par le batch nuit) et gardées en mémoire par processus quelques minutes
+(product_stats_for). Un produit sans ligne en base est calculé à la volée.
+
+Frais : les cours d'un ETF / fonds sont déjà nets de frais de gestion ; la
+déduction du TER (produits_meta, en %) est donc optionnelle (net_ter), utile
+pour des produits dont l'historique est celui d'un indice.
+"""
+import os
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from sqlalchemy import bindparam
+from sqlalchemy import text as sqltext
+
+from models import ProduitHisto, ProduitInvest, ProduitStats
+from utils import LRUCache
+
+RETURN_MODES = ("scenario", "products")
+
+LOOKBACK_YEARS = float(os.getenv("PRODUCT_RETURNS_LOOKBACK_YEARS", "10"))
+MIN_OBS = int(os.getenv("PRODUCT_RETURNS_MIN_OBS", "250"))
+CACHE_TTL = int(os.getenv("PRODUCT_RETURNS_CACHE_TTL", "900"))
+CHUNK_SIZE = int(os.getenv("PRODUCT_RETURNS_CHUNK", "200"))
+
+_stats_cache = LRUCache(int(os.getenv("PRODUCT_RETURNS_CACHE_SIZE", "4096")))
+
+UPSERT_SQL = sqltext("""
+    INSERT INTO produits_stats (produit_id, as_of, n_obs, drift, vol, apy, first_date, last_date, computed_at)
+    VALUES (:produit_id, :as_of, :n_obs, :drift, :vol, :apy, :first_date, :last_date, :computed_at)
+    ON CONFLICT (produit_id) DO UPDATE SET
+        as_of = EXCLUDED.as_of,
+        n_obs = EXCLUDED.n_obs,
+        drift = EXCLUDED.drift,
+        vol = EXCLUDED.vol,
+        apy = EXCLUDED.apy,
+        first_date = EXCLUDED.first_date,
+        last_date = EXCLUDED.last_date,
+        computed_at = EXCLUDED.computed_at
+""")
+
+TER_SQL = sqltext("SELECT produit_id, ter FROM produits_meta WHERE produit_id IN :ids").bindparams(
+    bindparam("ids", expanding=True))
+
+
+def return_stats(pids: np.ndarray, days: np.ndarray, close: np.ndarray, min_obs: int = MIN_OBS) -> dict:
+    """
+    Statistiques de rendement de plusieurs produits en une passe.
+    pids, days (ordinaux), close : (N,) triés par (produit, date).
+    Retourne {produit_id: {n_obs, drift, vol, apy, first_date, last_date}} pour
+    les produits ayant au moins `min_obs` rendements.
+    """
+    pids = np.asarray(pids, dtype=np.int64)
+    days = np.asarray(days, dtype=np.int64)
+    close = np.asarray(close, dtype=float)
+    ok = np.isfinite(close) & (close > 0)
+    pids, days, close = pids[ok], days[ok], close[ok]
+    if len(pids) < 2:
+        return {}
+
+    same = pids[1:] == pids[:-1]
+    r = np.log(close[1:] / close[:-1])[same]
+    owner = pids[1:][same]
+    if not len(r):
+        return {}
+
+    # bornes de dates par produit (la série commence à la première clôture)
+    starts = np.flatnonzero(np.r_[True, ~same])
+    ends = np.r_[starts[1:], len(pids)] - 1
+    span_of = dict(zip(pids[starts].tolist(), zip(days[starts].tolist(), days[ends].tolist())))
+
+    uniq, inv = np.unique(owner, return_inverse=True)
+    n = np.bincount(inv)
+    s1 = np.bincount(inv, weights=r)
+    s2 = np.bincount(inv, weights=r * r)
+    first = np.array([span_of[p][0] for p in uniq.tolist()])
+    last = np.array([span_of[p][1] for p in uniq.tolist()])
+    years = np.maximum(last - first, 1) / 365.25
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = s1 / n
+        var = np.maximum(s2 - n * mean * mean, 0.0) / np.maximum(n - 1, 1)
+        drift = s1 / years
+        vol = np.sqrt(var * n / years)
+    apy = np.expm1(drift)
+
+    out = {}
+    for k, pid in enumerate(uniq.tolist()):
+        if n[k] < min_obs or not np.isfinite(apy[k]):
+            continue
+        out[pid] = {
+            "n_obs": int(n[k]),
+            "drift": float(drift[k]),
+            "vol": float(vol[k]),
+            "apy": float(apy[k]),
+            "first_date": date.fromordinal(int(first[k])),
+            "last_date": date.fromordinal(int(last[k])),
+        }
+    return out
+
+def _load_closes(session, produit_ids: list[int], as_of: date):
+    """Clôtures de la fenêtre d'estimation, triées par (produit, date)."""
+    since = as_of - timedelta(days=int(LOOKBACK_YEARS * 365.25))
+    rows = (session.query(ProduitHisto.produit_id, ProduitHisto.date, ProduitHisto.close)
+            .filter(ProduitHisto.produit_id.in_(produit_ids),
+                    ProduitHisto.date >= since,
+                    ProduitHisto.date <= as_of,
+                    ProduitHisto.close.isnot(None))
+            .order_by(ProduitHisto.produit_id, ProduitHisto.date)
+            .all())
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    pids, dates, closes = zip(*rows)
+    return (np.fromiter(pids, dtype=np.int64, count=len(rows)),
+            np.fromiter((d.toordinal() for d in dates), dtype=np.int64, count=len(rows)),
+            np.array(closes, dtype=float))
+
+def compute_product_stats(session, produit_ids: list[int], as_of: date | None = None) -> dict:
+    """Statistiques calculées depuis ProduitHisto (sans écrire en base)."""
+    if not produit_ids:
+        return {}
+    as_of = as_of or datetime.utcnow().date()
+    return return_stats(*_load_closes(session, list(produit_ids), as_of))
+
+def refresh_product_stats(session, as_of: date | None = None, chunk_size: int = CHUNK_SIZE,
+                          verbose: bool = False) -> dict:
+    """
+    Batch nuit : recalcule produits_stats pour tous les produits ayant un
+    historique, par paquets de `chunk_size` produits (pagination par clé).
+    """
+    as_of = as_of or datetime.utcnow().date()
+    stats = {"computed": 0, "insufficient": 0}
+    last_id = 0
+    while True:
+        ids = [pid for (pid,) in (session.query(ProduitInvest.id)
+                                  .filter(ProduitInvest.id > last_id)
+                                  .order_by(ProduitInvest.id)
+                                  .limit(chunk_size).all())]
+        if not ids:
+            break
+        last_id = ids[-1]
+        computed = compute_product_stats(session, ids, as_of)
+        now = datetime.utcnow()
+        rows = [{"produit_id": pid, "as_of": as_of, "computed_at": now, **st} for pid, st in computed.items()]
+        if rows:
+            session.execute(UPSERT_SQL, rows)
+            session.commit()
+        stats["computed"] += len(rows)
+        stats["insufficient"] += len(ids) - len(rows)
+        if verbose:
+            print(f"produits_stats: {len(rows)} calculés / {len(ids)} produits")
+    _stats_cache.clear()
+    return stats
+
+def product_ters(session, produit_ids: list[int]) -> dict:
+    """{produit_id: TER en fraction} depuis produits_meta (ProduitMeta ; vide tant que update_market_data_pg.py n'a pas tourné)."""
+    if not produit_ids:
+        return {}
+    try:
+        rows = session.execute(TER_SQL, {"ids": list(produit_ids)}).all()
+    except Exception:
+        session.rollback()
+        return {}
+    return {pid: float(ter) / 100.0 for pid, ter in rows if ter is not None}
+
+def product_stats_for(session, isins, as_of: date | None = None) -> dict:
+    """
+    {isin: stats + produit_id + ter} pour les ISIN connus de produits_invest.
+    Lecture de produits_stats, cache mémoire par produit (CACHE_TTL secondes),
+    calcul à la volée pour les produits absents de la table.
+    """
+    isins = sorted({i.strip().upper() for i in isins if i and i.strip()})
+    if not isins:
+        return {}
+    by_isin = dict(session.query(ProduitInvest.isin, ProduitInvest.id)
+                   .filter(ProduitInvest.isin.in_(isins)).all())
+    bucket = int(time.time() // max(CACHE_TTL, 1))
+
+    out, missing = {}, []
+    for isin, pid in by_isin.items():
+        cached = _stats_cache.get((pid, bucket), False)
+        if cached is False:
+            missing.append(pid)
+        elif cached is not None:
+            out[isin] = cached
+
+    if missing:
+        found = {}
+        for row in session.query(ProduitStats).filter(ProduitStats.produit_id.in_(missing)).all():
+            found[row.produit_id] = {
+                "n_obs": row.n_obs, "drift": float(row.drift), "vol": float(row.vol), "apy": float(row.apy),
+                "first_date": row.first_date, "last_date": row.last_date,
+            }
+        absent = [pid for pid in missing if pid not in found]
+        found.update(compute_product_stats(session, absent, as_of))
+        ters = product_ters(session, missing)
+        pid_isin = {pid: isin for isin, pid in by_isin.items()}
+        for pid in missing:
+            st = found.get(pid)
+            if st is not None:
+                st = {**st, "produit_id": pid, "ter": ters.get(pid)}
+                out[pid_isin[pid]] = st
+            _stats_cache.put((pid, bucket), st)
+    return out
+
+def apply_product_returns(state: dict, stats: dict, default_apy: float, net_ter: bool = False) -> list[dict]:
+    """
+    Fixe le rendement ("apy") des lignes de portefeuille dont l'ISIN a des
+    statistiques ; les autres restent au taux scénario `default_apy`.
+    Retourne le détail par portefeuille (rendement attendu pondéré par la valeur).
+    """
+    out = []
+    for st in state["portfolios"]:
+        lines, w_sum, w_apy = [], 0.0, 0.0
+        for ln in st.get("lines") or []:
+            ps = stats.get((ln.get("isin") or "").strip().upper())
+            apy, source = default_apy, "scenario"
+            if ps is not None:
+                apy = ps["apy"]
+                if net_ter and ps.get("ter"):
+                    apy = (1.0 + apy) * (1.0 - ps["ter"]) - 1.0
+                ln["apy"], source = apy, "histo"
+            lines.append({
+                "line_id": ln["line_id"], "isin": ln.get("isin"), "value": round(ln["value"], 2),
+                "apy": round(apy, 6), "vol": round(ps["vol"], 6) if ps else None,
+                "ter": ps.get("ter") if ps else None, "n_obs": ps["n_obs"] if ps else None,
+                "source": source,
+            })
+            w_sum += ln["value"]
+            w_apy += ln["value"] * apy
+        out.append({
+            "asset_id": st["asset_id"], "label": st["label"], "value": round(st["value"], 2),
+            "expected_apy": round(w_apy / w_sum, 6) if w_sum > 0 else round(default_apy, 6),
+            "lines": lines,
+        })
+    return out
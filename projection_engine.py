@@ -0,0 +1,1000 @@
+# projection_engine.py
+"""
+Moteur de projection patrimoniale.
+
+- load_state()  : lit les actifs / revenus / charges d'un utilisateur et les
+                  fige en structures Python simples (aucune référence ORM)
+- simulate()    : simulation mensuelle vectorisée NumPy ; chaque taux peut être
+                  un scalaire ou un tableau 1-D (un point de grille par valeur)
+  Les AssetEvent planifiés (rrule) sont appliqués via rrule_engine.
+- simulate_incremental() : même résultat (taux scalaires) assemblé depuis des
+                  séries par actif mises en cache
+- projection_payload() : mise en forme JSON de /api/projection
+"""
+import base64
+from datetime import datetime
+from math import isfinite
+import hashlib
+import json
+import os
+
+import numpy as np
+from sqlalchemy.orm import joinedload
+
+from models import Asset, AssetEvent, AssetImmo, AssetPortfolio, UserIncome, UserExpense
+from rrule_engine import event_flows, monthly_occurrences
+from utils import LRUCache, amortization_batch, amortization_monthly_payment
+
+
+# presets de scénarios
+SCENARIOS = {
+    "base": {"portfolio_apy": 0.06, "livret_apy": 0.03, "immo_app_apy": 0.015, "inflation_apy": 0.02, "vacancy": 0.06},
+    "doux": {"portfolio_apy": 0.04, "livret_apy": 0.025, "immo_app_apy": 0.01,  "inflation_apy": 0.02, "vacancy": 0.08},
+    "soft": {"portfolio_apy": 0.04, "livret_apy": 0.025, "immo_app_apy": 0.01,  "inflation_apy": 0.02, "vacancy": 0.08},
+    "choc": {"portfolio_apy": -0.02, "livret_apy": 0.02, "immo_app_apy": -0.005,"inflation_apy": 0.03, "vacancy": 0.12},
+    "shock":{"portfolio_apy": -0.02, "livret_apy": 0.02, "immo_app_apy": -0.005,"inflation_apy": 0.03, "vacancy": 0.12},
+}
+
+# paramètres numériques de la simulation (tous "balayables")
+RATE_KEYS = ("portfolio_apy", "livret_apy", "immo_app_apy", "inflation_apy", "vacancy", "dca_mult")
+
+STACK_KEYS = ("livrets", "portfolios", "immo_equity", "other")
+CASHFLOW_KEYS = ("inflows", "outflows", "net", "capacity")
+
+# paramètres par défaut de /api/projection (ceux des snapshots du batch nuit)
+DEFAULT_MONTHS = 120
+
+def default_params(start) -> dict:
+    return {
+        "start": start,
+        "months": DEFAULT_MONTHS,
+        "scenario": "base",
+        "rates": {**SCENARIOS["base"], "dca_mult": 1.0},
+        "snapshot_at": None,
+        "breakdown": False,
+        "resolution": "monthly",
+        "encoding": "json",
+        "returns": "scenario",
+        "net_ter": False,
+    }
+
+def is_default_params(params: dict) -> bool:
+    """Vrai si `params` (cf. default_params) produit la réponse par défaut, donc servable depuis un snapshot."""
+    return all(params.get(k) == v for k, v in default_params(params.get("start")).items())
+
+# événements planifiés pris en compte, par type d'actif
+CASH_EVENT_KINDS = ("cash_op", "transfer")
+IMMO_EVENT_KINDS = ("loan_prepayment", "rent_change", "expense_change")
+
+
+# ---------------------------------------------------------
+# Helpers dates / taux
+# ---------------------------------------------------------
+def first_of_month(d):
+    return datetime(d.year, d.month, 1).date()
+
+def add_months(d, k: int):
+    y = d.year + (d.month - 1 + k) // 12
+    m = ((d.month - 1 + k) % 12) + 1
+    return datetime(y, m, 1).date()
+
+def months_between(a, b) -> int:
+    # nombre de mois entiers (b - a) en prenant 1er du mois
+    a1, b1 = first_of_month(a), first_of_month(b)
+    return (b1.year - a1.year) * 12 + (b1.month - a1.month)
+
+def freq_to_monthly(freq: str | None) -> float:
+    if not freq:
+        return 0.0
+    f = str(freq).strip().lower()
+    if f in ("mensuel", "monthly"):
+        return 1.0
+    if f in ("trimestriel", "quarterly"):
+        return 1.0 / 3.0
+    if f in ("annuel", "annual", "yearly"):
+        return 1.0 / 12.0
+    return 0.0
+
+def apy_to_monthly(apy):
+    """Taux annuel -> taux mensuel équivalent (accepte scalaire ou tableau)."""
+    if np.ndim(apy):
+        a = np.asarray(apy, dtype=float)
+        return np.power(np.maximum(1.0 + a, 0.0), 1.0 / 12.0) - 1.0
+    try:
+        return (1.0 + float(apy)) ** (1.0 / 12.0) - 1.0
+    except Exception:
+        return 0.0
+
+def safe_float(x, default=0.0):
+    try:
+        v = float(x) if x is not None else None
+    except Exception:
+        v = None
+    return v if (v is not None and isfinite(v)) else default
+
+def loan_monthly_payment(P: float, r_apy: float, n_months: int) -> float:
+    """Renvoie mensualité (hors assurance). Utilise utils.amortization_monthly_payment si possible."""
+    if P is None or n_months is None or n_months <= 0:
+        return 0.0
+    try:
+        if r_apy is None:
+            return amortization_monthly_payment(P, 0.0, n_months)
+        return amortization_monthly_payment(P, r_apy, n_months)
+    except Exception:
+        r = (r_apy or 0.0) / 12.0
+        if abs(r) < 1e-9:
+            return P / max(n_months, 1)
+        return P * (r * (1 + r) ** n_months) / ((1 + r) ** n_months - 1)
+
+
+# ---------------------------------------------------------
+# Chargement de l'état utilisateur
+# ---------------------------------------------------------
+def _portfolio_line_states(pf, value0: float, contrib_m: float, bene_id, envelopes: list) -> list[dict]:
+    """
+    Répartit valeur et DCA d'un portefeuille sur ses lignes.
+    - valeur : au prorata units × avg_price (la valeur du portefeuille reste `value0`)
+    - DCA    : amount_allocated de chaque ligne
+    - bénéficiaire / enveloppe : ceux de la ligne, sinon ceux du portefeuille
+    Le reliquat (pas de poids, DCA portefeuille) forme une ligne sans line_id ;
+    sans enveloppe connue, une ligne est répartie à parts égales sur les
+    enveloppes du portefeuille (ou "CTO").
+    """
+    product_types = {p.id: p.product_type for p in (pf.products or []) if p.product_type}
+    default_envs = envelopes or ["CTO"]
+
+    weights, rows = [], []
+    for ln in pf.lines or []:
+        units, avg = safe_float(ln.units, None), safe_float(ln.avg_price, None)
+        weights.append(max(units * avg, 0.0) if (units is not None and avg is not None) else 0.0)
+        env = product_types.get(ln.product_id)
+        rows.append({
+            "line_id": ln.id,
+            "isin": ln.isin,
+            "bene_id": ln.beneficiary_id if ln.beneficiary_id is not None else bene_id,
+            "envelopes": [env] if env else default_envs,
+            "contrib_m": max(safe_float(ln.amount_allocated) * freq_to_monthly(ln.allocation_frequency), 0.0),
+        })
+
+    w_sum = sum(weights)
+    for row, w in zip(rows, weights):
+        row["value"] = value0 * w / w_sum if w_sum > 0 else 0.0
+
+    rest_value = value0 - sum(r["value"] for r in rows)
+    rest_contrib = contrib_m - sum(r["contrib_m"] for r in rows)
+    if rest_value > 1e-9 or rest_contrib > 1e-9:
+        rows.append({"line_id": None, "bene_id": bene_id, "envelopes": default_envs,
+                     "value": max(rest_value, 0.0), "contrib_m": max(rest_contrib, 0.0)})
+    return rows
+
+def load_state(session, uid: int, start) -> dict:
+    """
+    Charge et normalise le patrimoine de `uid` à la date `start`.
+    Le résultat ne contient que des types Python natifs : réutilisable
+    pour plusieurs simulations (sweep, goal-seek) et sérialisable (pickle).
+    Les contributions portefeuille sont stockées SANS dca_mult.
+    """
+    assets = (session.query(Asset)
+                .filter(Asset.user_id == uid)
+                .options(
+                    joinedload(Asset.livret),
+                    joinedload(Asset.other),
+                    joinedload(Asset.portfolio).joinedload(AssetPortfolio.lines),
+                    joinedload(Asset.portfolio).joinedload(AssetPortfolio.products),
+                    joinedload(Asset.immo).joinedload(AssetImmo.loans),
+                    joinedload(Asset.immo).joinedload(AssetImmo.expenses),
+                ).all())
+
+    incomes = session.query(UserIncome).filter(UserIncome.user_id == uid).all()
+    try:
+        expenses = session.query(UserExpense).filter(UserExpense.user_id == uid).all()
+    except Exception:
+        expenses = []  # si le modèle n'existe pas encore
+
+    # événements planifiés (récurrents ou ponctuels), rattachés à leur actif
+    planned = (session.query(AssetEvent)
+                 .filter(AssetEvent.user_id == uid,
+                         AssetEvent.status == "planned",
+                         AssetEvent.kind.in_(CASH_EVENT_KINDS + IMMO_EVENT_KINDS))
+                 .order_by(AssetEvent.id).all())
+    events_by_asset = {}
+    for ev in planned:
+        events_by_asset.setdefault(ev.asset_id, []).append({
+            "id": ev.id, "kind": ev.kind, "value_date": ev.value_date, "rrule": ev.rrule,
+            "end_date": ev.end_date, "amount": safe_float(ev.amount, 0.0),
+            "loan_id": (ev.data or {}).get("loan_id"),
+        })
+    events_of = lambda a, kinds: [e for e in events_by_asset.get(a.id, []) if e["kind"] in kinds]
+
+    livret_states = []  # [{asset_id, label, value, bene_id, contrib_m}]
+    pf_states = []      # [{asset_id, label, value, bene_id, contrib_m, envelopes:[str]}]
+    immo_states = []    # [{asset_id, label, bene_id, prop_value, loans:[...], insurance_m, rent_m, expenses_m, ownership_pct}]
+    other_states = []   # [{asset_id, label, value, bene_id}]
+
+    for a in assets:
+        bene_id = a.beneficiary_id
+        if a.type == "livret" and a.livret:
+            lv = a.livret
+            value0 = safe_float(getattr(lv, "balance_effective", None), None)
+            if value0 is None:
+                value0 = safe_float(lv.balance, safe_float(a.current_value))
+            contrib_m = safe_float(lv.recurring_amount) * freq_to_monthly(lv.recurring_frequency)
+            livret_states.append({
+                "asset_id": a.id, "label": a.label, "value": max(value0, 0.0), "bene_id": bene_id,
+                "contrib_m": max(contrib_m, 0.0),
+                "events": events_of(a, CASH_EVENT_KINDS),
+            })
+
+        elif a.type == "portfolio" and a.portfolio:
+            pf = a.portfolio
+            value0 = safe_float(a.current_value, 0.0)
+            # DCA par lignes si dispo, sinon fallback au recurring du portefeuille
+            dca_total = 0.0
+            for ln in pf.lines or []:
+                dca_total += safe_float(ln.amount_allocated) * freq_to_monthly(ln.allocation_frequency)
+            if dca_total <= 0 and pf.recurring_frequency:
+                dca_total = safe_float(pf.recurring_amount) * freq_to_monthly(pf.recurring_frequency)
+
+            envelopes = [p.product_type for p in (pf.products or []) if p.product_type]
+            pf_states.append({
+                "asset_id": a.id, "label": a.label, "value": max(value0, 0.0), "bene_id": bene_id,
+                "contrib_m": max(dca_total, 0.0),
+                "envelopes": envelopes or [],
+                "lines": _portfolio_line_states(pf, max(value0, 0.0), max(dca_total, 0.0), bene_id, envelopes),
+                "events": events_of(a, CASH_EVENT_KINDS),
+            })
+
+        elif a.type == "immo" and a.immo:
+            im = a.immo
+            prop0 = safe_float(im.last_estimation_value, safe_float(im.purchase_price))
+            insurance_m = safe_float(im.insurance_monthly, 0.0)
+
+            # loyer: direct si renseigné, sinon 0 (l’association UserIncome éventuelle est ignorée ici)
+            rent_m = safe_float(im.rental_income, 0.0)
+
+            # dépenses immo récurrentes (mensualisées)
+            expenses_m = 0.0
+            for ex in im.expenses or []:
+                expenses_m += safe_float(ex.amount) * freq_to_monthly(ex.frequency)
+
+            # prêts
+            loans = []
+            for ln in im.loans or []:
+                P = safe_float(ln.loan_amount, 0.0)
+                r_apy = safe_float(ln.loan_rate, 0.0) / 100.0 if ln.loan_rate and ln.loan_rate > 1 else safe_float(ln.loan_rate, 0.0)
+                r_m = (r_apy) / 12.0
+                n = ln.loan_duration_months or 0
+                pay = safe_float(ln.monthly_payment, None)
+                if not pay:
+                    pay = loan_monthly_payment(P, r_apy, n)
+
+                # capital restant dû à la date 'start'
+                k_elapsed = 0
+                if ln.loan_start_date:
+                    try:
+                        k_elapsed = max(0, months_between(ln.loan_start_date, start))
+                    except Exception:
+                        k_elapsed = 0
+                remain = float(P)
+                # avance jusqu'à 'start' (forme close)
+                k_paid = min(k_elapsed, max(n, 0))
+                if k_paid > 0:
+                    remain = float(amortization_batch([P], [r_apy * 100.0], [n], horizon=k_paid,
+                                                      payments=[pay])["balance"][0, -1])
+
+                months_left = max(0, n - k_elapsed)
+                end_date = add_months(ln.loan_start_date or start, months_left)
+                loans.append({
+                    "loan_id": ln.id,
+                    "remain": max(remain, 0.0), "r_m": r_m, "pay_no_ins": pay,
+                    "months_left": months_left, "end_date": end_date
+                })
+
+            immo_states.append({
+                "asset_id": a.id, "label": a.label, "bene_id": bene_id,
+                "prop_value": max(prop0, 0.0),
+                "loans": loans,
+                "insurance_m": insurance_m,
+                "rent_m": max(rent_m, 0.0),
+                "expenses_m": max(expenses_m, 0.0),
+                "ownership_pct": safe_float(im.ownership_percentage, 100.0),
+                "events": events_of(a, IMMO_EVENT_KINDS),
+            })
+
+        elif a.type == "other" and a.other:
+            oth = a.other
+            value0 = safe_float(oth.estimated_value, safe_float(a.current_value))
+            other_states.append({"asset_id": a.id, "label": a.label, "value": max(value0, 0.0), "bene_id": bene_id,
+                                 "events": events_of(a, CASH_EVENT_KINDS)})
+
+        else:
+            # si 'current_value' existe quand même
+            v0 = safe_float(a.current_value, 0.0)
+            if v0 > 0:
+                other_states.append({"asset_id": a.id, "label": a.label, "value": v0, "bene_id": bene_id,
+                                     "events": events_of(a, CASH_EVENT_KINDS)})
+
+    # revenus (mensualisés), avec end_date
+    income_defs = []
+    for inc in incomes or []:
+        m = safe_float(inc.amount) * freq_to_monthly(inc.frequency)
+        income_defs.append({"amount_m": max(m, 0.0), "end": inc.end_date})
+
+    # dépenses utilisateur (mensualisées)
+    expense_defs = []
+    for ex in expenses or []:
+        m = safe_float(ex.amount) * freq_to_monthly(ex.frequency)
+        expense_defs.append({"amount_m": max(m, 0.0)})
+
+    return {
+        "start": start,
+        "livrets": livret_states,
+        "portfolios": pf_states,
+        "immo": immo_states,
+        "others": other_states,
+        "incomes": income_defs,
+        "expenses": expense_defs,
+    }
+
+
+# ---------------------------------------------------------
+# Simulation vectorisée
+# ---------------------------------------------------------
+def _grid_rates(rates: dict) -> tuple[dict, int]:
+    """Diffuse chaque paramètre sur une grille 1-D commune de taille G."""
+    arrs = {k: np.atleast_1d(np.asarray(rates[k], dtype=float)) for k in RATE_KEYS}
+    g = np.broadcast_shapes(*(a.shape for a in arrs.values()))
+    if len(g) != 1:
+        raise ValueError("rates must be scalars or 1-D arrays")
+    return {k: np.broadcast_to(a, g) for k, a in arrs.items()}, g[0]
+
+def _growth(apy, steps):
+    """Facteurs de capitalisation (1+r)^k et d'annuité sum_{j<k}(1+r)^j, shape (G, M)."""
+    r = apy_to_monthly(apy)[:, None]
+    g = np.power(1.0 + r, steps)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        annuity = np.where(np.abs(r) < 1e-12, steps, (g - 1.0) / r)
+    return g, annuity
+
+def _capitalized(v0: np.ndarray, contrib: np.ndarray, flows: np.ndarray, apy, steps, per_asset: bool,
+                 fixed: np.ndarray | None = None):
+    """
+    Compartiment capitalisé (livrets, portefeuilles) : v(t) = v(t-1)·(1+r) + c + x(t).
+    v0 (n,), contrib (G|1, n), flows (n, M) = flux planifiés par mois,
+    fixed (G|1, n, M) = part déjà projetée à un autre taux (lignes à rendement propre).
+    Retourne (somme (G, M), séries par actif (G, n, M) ou None).
+    """
+    g, a = _growth(apy, steps)
+    if flows.any() or fixed is not None:
+        per = v0[None, :, None] * g[:, None, :] + contrib[:, :, None] * a[:, None, :]
+        if fixed is not None:
+            per = per + fixed
+        if flows.any():
+            # x(i) capitalisé jusqu'à t : (1+r)^(t-i) = b(t) / b(i), b(t) = (1+r)^t
+            b = g / (1.0 + apy_to_monthly(apy))[:, None]
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                extra = b[:, None, :] * np.cumsum(flows[None, :, :] / b[:, None, :], axis=-1)
+            per = np.maximum(per + extra, 0.0)
+        return per.sum(axis=1), per
+    total = v0.sum() * g + contrib.sum(axis=1)[:, None] * a
+    per = (v0[None, :, None] * g[:, None, :] + contrib[:, :, None] * a[:, None, :]) if per_asset else None
+    return total, per
+
+def _line_rate_parts(pf: list, steps, dca):
+    """
+    Lignes de portefeuille à rendement propre (ligne "apy" renseignée, cf. product_returns) :
+    séries agrégées par portefeuille (G, nP, M) + valeur / DCA qu'elles retirent de la part au taux scénario.
+    """
+    rows = [(j, ln) for j, st in enumerate(pf) for ln in st.get("lines") or [] if ln.get("apy") is not None]
+    if not rows:
+        return None, 0.0, 0.0
+    owner = np.array([j for j, _ in rows])
+    v = np.array([ln["value"] for _, ln in rows], dtype=float)
+    c = np.array([ln["contrib_m"] for _, ln in rows], dtype=float)
+    g, a = _growth(np.array([ln["apy"] for _, ln in rows], dtype=float), steps)    # (R, M)
+    O = np.zeros((len(pf), len(rows)))
+    O[owner, np.arange(len(rows))] = 1.0
+    fixed = (O @ (v[:, None] * g))[None, :, :] + dca[:, :, None] * (O @ (c[:, None] * a))[None, :, :]
+    return fixed, np.bincount(owner, weights=v, minlength=len(pf)), np.bincount(owner, weights=c, minlength=len(pf))
+
+def _portfolio_block(pf: list, start, months: int, p: dict, steps, per_asset: bool):
+    """Portefeuilles : taux scénario portfolio_apy, sauf lignes à rendement propre ; (somme (G, M), séries (G, nP, M))."""
+    v0 = np.array([st["value"] for st in pf], dtype=float)
+    c = np.array([st["contrib_m"] for st in pf], dtype=float)
+    x = _asset_flows(pf, start, months, CASH_EVENT_KINDS)
+    dca = p["dca_mult"][:, None]
+    fixed, v_fixed, c_fixed = _line_rate_parts(pf, steps, dca)
+    return _capitalized(np.maximum(v0 - v_fixed, 0.0), np.maximum(c - c_fixed, 0.0)[None, :] * dca, x,
+                        p["portfolio_apy"], steps, per_asset, fixed)
+
+def _loan_paths(loans: list, months: int, prepay: np.ndarray | None = None):
+    """
+    Amortit tous les prêts en parallèle (une ligne par prêt).
+    `prepay` (nL, M) : remboursements anticipés planifiés, imputés sur le capital
+    après l'échéance du mois (mensualité inchangée -> durée raccourcie).
+    Retourne (capital restant après chaque mois, mensualité payée, anticipé réellement payé), shape (nL, M).
+    """
+    n = len(loans)
+    remain_out = np.zeros((n, months))
+    paid_out = np.zeros((n, months))
+    prepaid_out = np.zeros((n, months))
+    if not n:
+        return remain_out, paid_out, prepaid_out
+    remain = np.array([ln["remain"] for ln in loans], dtype=float)
+    r_m = np.array([ln["r_m"] for ln in loans], dtype=float)
+    pay = np.array([ln["pay_no_ins"] for ln in loans], dtype=float)
+    left = np.array([ln["months_left"] for ln in loans], dtype=float)
+    has_prepay = prepay is not None and prepay.any()
+    for i in range(months):
+        active = (remain > 1e-8) & (left > 0)
+        paid_out[:, i] = np.where(active, pay, 0.0)
+        principal = np.minimum(np.maximum(pay - remain * r_m, 0.0), remain)
+        remain = np.where(active, remain - principal, remain)
+        left = np.where(active, left - 1, left)
+        if has_prepay:
+            pp = np.where(left > 0, np.minimum(prepay[:, i], remain), 0.0)
+            remain = remain - pp
+            prepaid_out[:, i] = pp
+        remain_out[:, i] = remain
+    return remain_out, paid_out, prepaid_out
+
+def _asset_flows(states: list, start, months: int, kinds) -> np.ndarray:
+    """Flux planifiés par actif (n, M) pour les événements de `kinds`."""
+    if not states:
+        return np.zeros((0, months))
+    return np.array([event_flows(st.get("events"), start, months, kinds) for st in states]).reshape(len(states), months)
+
+def loan_prepayments(ims: list, start, months: int) -> np.ndarray:
+    """Remboursements anticipés planifiés par prêt (nL, M), prêts aplatis dans l'ordre des biens."""
+    rows = []
+    for im in ims:
+        loans = im["loans"]
+        mat = np.zeros((len(loans), months))
+        for ev in im.get("events") or []:
+            if ev["kind"] != "loan_prepayment" or not loans or not ev.get("amount"):
+                continue
+            # prêt visé : data.loan_id, sinon le premier prêt du bien
+            j = next((k for k, ln in enumerate(loans) if str(ln.get("loan_id")) == str(ev.get("loan_id"))), 0)
+            mat[j] += abs(ev["amount"]) * monthly_occurrences(ev["value_date"], ev.get("rrule"), ev.get("end_date"), start, months)
+        rows.append(mat)
+    return np.vstack(rows) if rows else np.zeros((0, months))
+
+def step_series(base: list, states: list, start, months: int, kind: str) -> np.ndarray:
+    """Montant mensuel de base + variations planifiées cumulées (ex: rent_change), borné à 0, (n, M)."""
+    deltas = _asset_flows(states, start, months, (kind,))
+    return np.maximum(np.array(base, dtype=float)[:, None] + np.cumsum(deltas, axis=1), 0.0)
+
+def simulate(state: dict, start, months: int, rates: dict, per_asset: bool = False) -> dict:
+    """
+    Simule `months` mois à partir de `start`.
+
+    `rates` contient RATE_KEYS ; chaque valeur est un scalaire ou un tableau 1-D
+    de G points (grille de sensibilité). Toutes les séries renvoyées ont la
+    forme (G, months). Avec per_asset=True, ajoute "assets" : une entrée par
+    actif (ordre livrets, portefeuilles, immo, autres) avec sa série (G, months).
+
+    Les événements planifiés attachés aux actifs ("events") sont appliqués :
+    cash_op / transfer (valeur des livrets, portefeuilles, autres), loan_prepayment
+    (capital restant dû), rent_change / expense_change (loyer et charges du bien).
+    """
+    p, G = _grid_rates(rates)
+    M = max(int(months), 0)
+    steps = np.arange(1, M + 1, dtype=float)   # capitalisations cumulées après le mois i
+    times = [add_months(start, i) for i in range(M)]
+
+    lv = state["livrets"]; pf = state["portfolios"]; ims = state["immo"]; ots = state["others"]
+
+    # --- livrets / portefeuilles : forme close v0·(1+r)^k + c·annuité(k) (+ flux planifiés) ---
+    lv_v0 = np.array([st["value"] for st in lv], dtype=float)
+    lv_c = np.array([st["contrib_m"] for st in lv], dtype=float)
+    lv_x = _asset_flows(lv, start, M, CASH_EVENT_KINDS)
+    stack_lv, per_lv = _capitalized(lv_v0, lv_c[None, :], lv_x, p["livret_apy"], steps, per_asset)
+
+    pf_c = np.array([st["contrib_m"] for st in pf], dtype=float)
+    dca = p["dca_mult"][:, None]
+    stack_pf, per_pf = _portfolio_block(pf, start, M, p, steps, per_asset)
+
+    # --- immobilier : valeur du bien - capital restant dû (par bien) ---
+    prop0 = np.array([im["prop_value"] for im in ims], dtype=float)
+    g_im, _ = _growth(p["immo_app_apy"], steps)
+    prop = prop0[None, :, None] * g_im[:, None, :]                   # (G, nI, M)
+
+    loans = [ln for im in ims for ln in im["loans"]]
+    loan_owner = np.array([j for j, im in enumerate(ims) for _ in im["loans"]], dtype=int)
+    remain_l, paid_l, prepaid_l = _loan_paths(loans, M, loan_prepayments(ims, start, M))
+    remain_im = np.zeros((len(ims), M))
+    if loans:
+        np.add.at(remain_im, loan_owner, remain_l)
+    im_equity = np.maximum(prop - remain_im[None, :, :], 0.0)        # (G, nI, M)
+    stack_im = im_equity.sum(axis=1)
+
+    # --- autres : inchangés (pas de capitalisation par défaut), hors flux planifiés ---
+    ot_v = np.array([st["value"] for st in ots], dtype=float)
+    ot_x = _asset_flows(ots, start, M, CASH_EVENT_KINDS)
+    per_ot = np.maximum(ot_v[:, None] + np.cumsum(ot_x, axis=1), 0.0)  # (nO, M)
+    stack_ot = np.broadcast_to(per_ot.sum(axis=0), (G, M)).copy()
+
+    total = stack_lv + stack_pf + stack_im + stack_ot
+
+    # --- cashflows ---
+    t_ord = np.array([t.toordinal() for t in times], dtype=np.int64)
+    income_m = np.zeros(M)
+    for inc in state["incomes"]:
+        if inc["end"]:
+            income_m += np.where(t_ord <= inc["end"].toordinal(), inc["amount_m"], 0.0)
+        else:
+            income_m += inc["amount_m"]
+    rent_m = step_series([im["rent_m"] for im in ims], ims, start, M, "rent_change").sum(axis=0)
+    inflows = income_m[None, :] + rent_m[None, :] * np.maximum(0.0, 1.0 - p["vacancy"])[:, None]
+
+    # indexation CPI des dépenses : facteur (1+r)^i au mois i
+    cpi = np.power(1.0 + apy_to_monthly(p["inflation_apy"])[:, None], steps - 1.0)
+    im_exp_m = step_series([im["expenses_m"] for im in ims], ims, start, M, "expense_change").sum(axis=0)
+    indexed_m = im_exp_m + sum(ex["amount_m"] for ex in state["expenses"])
+    fixed_m = sum(im["insurance_m"] for im in ims)
+    charges = fixed_m + indexed_m[None, :] * cpi + paid_l.sum(axis=0)[None, :]
+
+    # opérations de caisse planifiées : dépôt = sortie d'épargne, retrait = entrée
+    # (les transferts sont internes au patrimoine et n'affectent pas les cashflows)
+    cash_ops = sum(_asset_flows(sts, start, M, ("cash_op",)).sum(axis=0) for sts in (lv, pf, ots))
+    inflows = inflows + np.maximum(-cash_ops, 0.0)[None, :]
+    contribs = lv_c.sum() + pf_c.sum() * dca + np.maximum(cash_ops, 0.0)[None, :] + prepaid_l.sum(axis=0)[None, :]
+    outflows = charges + contribs
+    shape = (G, M)
+
+    out = {
+        "times": times,
+        "total": np.broadcast_to(total, shape),
+        "livrets": np.broadcast_to(stack_lv, shape),
+        "portfolios": np.broadcast_to(stack_pf, shape),
+        "immo_equity": np.broadcast_to(stack_im, shape),
+        "other": stack_ot,
+        "inflows": np.broadcast_to(inflows, shape),
+        "outflows": np.broadcast_to(outflows, shape),
+        "net": np.broadcast_to(inflows - outflows, shape),
+        "capacity": np.broadcast_to(inflows - charges, shape),
+        "loans_remain": remain_l,
+        "loans_prepaid": prepaid_l,
+        "loans_paid": paid_l,
+        "immo_equity_by_asset": im_equity,
+    }
+    if per_asset:
+        groups = (("livrets", lv, per_lv), ("portfolios", pf, per_pf), ("immo", ims, im_equity),
+                  ("others", ots, np.broadcast_to(per_ot[None, :, :], (G, len(ots), M))))
+        out["assets"] = [{
+            "asset_id": st["asset_id"], "type": PART_TYPE[kind], "label": st["label"], "values": per[:, j, :],
+        } for kind, sts, per in groups for j, st in enumerate(sts)]
+    return out
+
+
+# ---------------------------------------------------------
+# Projection incrémentale : décomposition par actif + cache
+# ---------------------------------------------------------
+# Chaque sortie de simulate() est une somme de trajectoires indépendantes par actif
+# (+ un terme "flows" pour revenus / dépenses utilisateur). On met en cache chaque
+# trajectoire, clé = (type, version de l'actif, start, months, taux qui la concernent) :
+# modifier un actif ne recalcule que sa série, les autres sont re-sommées depuis le cache.
+PART_RATES = {
+    "livrets": ("livret_apy",),
+    "portfolios": ("portfolio_apy", "dca_mult"),
+    "immo": ("immo_app_apy", "inflation_apy", "vacancy"),
+    "others": (),
+    "flows": ("inflation_apy",),
+}
+PART_STACK = {"livrets": "livrets", "portfolios": "portfolios", "immo": "immo_equity", "others": "other"}
+PART_TYPE = {"livrets": "livret", "portfolios": "portfolio", "immo": "immo", "others": "other"}
+
+SERIES_CACHE_SIZE = int(os.getenv("PROJECTION_SERIES_CACHE_SIZE", "1024"))
+_series_cache = LRUCache(SERIES_CACHE_SIZE)
+
+def _empty_state(start) -> dict:
+    return {"start": start, "livrets": [], "portfolios": [], "immo": [], "others": [], "incomes": [], "expenses": []}
+
+def state_version(obj) -> str:
+    """Empreinte de contenu : tient lieu de version d'actif (pas de updated_at sur Asset)."""
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def _compute_part(kind: str, st: dict, start, months: int, rates: dict) -> dict:
+    part_state = _empty_state(start)
+    if kind == "flows":
+        part_state["incomes"], part_state["expenses"] = st["incomes"], st["expenses"]
+    else:
+        part_state[kind] = [st]
+    sim = simulate(part_state, start, months, rates)
+    part = {k: np.array(sim[k][0]) for k in CASHFLOW_KEYS}
+    part["value"] = np.array(sim[PART_STACK[kind]][0]) if kind in PART_STACK else np.zeros(len(sim["times"]))
+    if kind == "immo":
+        part["loans_remain"], part["loans_prepaid"] = sim["loans_remain"], sim["loans_prepaid"]
+    for a in part.values():
+        a.flags.writeable = False
+    return part
+
+def _cached_part(kind: str, st: dict, start, months: int, rates: dict, stats: dict) -> dict:
+    key = (kind, state_version(st), start.isoformat(), int(months),
+           tuple(float(rates[k]) for k in PART_RATES[kind]))
+    part = _series_cache.get(key)
+    if part is not None:
+        stats["hits"] += 1
+        return part
+    stats["misses"] += 1
+    return _series_cache.put(key, _compute_part(kind, st, start, months, rates))
+
+def simulate_incremental(state: dict, start, months: int, rates: dict) -> dict:
+    """
+    Équivalent de simulate() pour des taux scalaires (G=1), assemblé à partir des
+    séries par actif mises en cache. Ajoute "assets" (série de valeur par actif)
+    et "cache" (hits / misses) sans coût supplémentaire.
+    """
+    M = max(int(months), 0)
+    stats = {"hits": 0, "misses": 0}
+    acc = {k: np.zeros(M) for k in STACK_KEYS + CASHFLOW_KEYS}
+    assets, immo_values, loans_remain, loans_prepaid = [], [], [], []
+
+    for kind in ("livrets", "portfolios", "immo", "others"):
+        for st in state[kind]:
+            part = _cached_part(kind, st, start, M, rates, stats)
+            acc[PART_STACK[kind]] += part["value"]
+            for k in CASHFLOW_KEYS:
+                acc[k] += part[k]
+            assets.append({"asset_id": st["asset_id"], "type": PART_TYPE[kind], "label": st["label"], "values": part["value"]})
+            if kind == "immo":
+                immo_values.append(part["value"])
+                loans_remain.append(part["loans_remain"]); loans_prepaid.append(part["loans_prepaid"])
+
+    flows = _cached_part("flows", {"incomes": state["incomes"], "expenses": state["expenses"]}, start, M, rates, stats)
+    for k in CASHFLOW_KEYS:
+        acc[k] += flows[k]
+
+    out = {k: acc[k][None, :] for k in STACK_KEYS + CASHFLOW_KEYS}
+    out["total"] = (acc["livrets"] + acc["portfolios"] + acc["immo_equity"] + acc["other"])[None, :]
+    out["times"] = [add_months(start, i) for i in range(M)]
+    out["immo_equity_by_asset"] = (np.stack(immo_values) if immo_values else np.zeros((0, M)))[None, :, :]
+    out["loans_remain"] = np.vstack(loans_remain) if loans_remain else np.zeros((0, M))
+    out["loans_prepaid"] = np.vstack(loans_prepaid) if loans_prepaid else np.zeros((0, M))
+    out["assets"] = assets
+    out["cache"] = stats
+    return out
+
+
+# ---------------------------------------------------------
+# Séries par bénéficiaire / enveloppe (réductions groupées)
+# ---------------------------------------------------------
+def _group_sum(keys: list, series: np.ndarray, months: int) -> dict:
+    """Somme les lignes de `series` (n, M) par clé -> {clé: (M,)}."""
+    if not keys:
+        return {}
+    uniq = list(dict.fromkeys(keys))
+    pos = {k: i for i, k in enumerate(uniq)}
+    out = np.zeros((len(uniq), months))
+    np.add.at(out, np.array([pos[k] for k in keys]), series)
+    return dict(zip(uniq, out))
+
+def group_series(state: dict, sim: dict, rates: dict) -> dict:
+    """
+    Séries exactes (G=1) par bénéficiaire et par enveloppe, à partir des
+    valeurs et contributions ligne à ligne des portefeuilles.
+    Immobilier : equity × ownership_pct affectée au bénéficiaire de l'actif.
+    """
+    M = len(sim["times"])
+    steps = np.arange(1, M + 1, dtype=float)
+    one = lambda k: np.atleast_1d(np.asarray(rates[k], dtype=float))[:1]
+
+    bene_keys, bene_rows = [], []
+
+    start = sim["times"][0] if M else state["start"]
+
+    lv = state["livrets"]
+    if lv:
+        v0 = np.array([st["value"] for st in lv]); c = np.array([st["contrib_m"] for st in lv])
+        _, per = _capitalized(v0, c[None, :], _asset_flows(lv, start, M, CASH_EVENT_KINDS),
+                              one("livret_apy"), steps, True)
+        bene_keys += [st["bene_id"] for st in lv]
+        bene_rows.append(per[0])
+
+    # portefeuilles : une ligne par (ligne de portefeuille, enveloppe)
+    # (taux de la ligne si rendement propre, sinon portfolio_apy)
+    env_keys, v0, c, apy = [], [], [], []
+    line_benes = []
+    pf_apy = float(one("portfolio_apy")[0])
+    for st in state["portfolios"]:
+        for ln in st.get("lines") or []:
+            n = len(ln["envelopes"])
+            for e in ln["envelopes"]:
+                env_keys.append(e); line_benes.append(ln["bene_id"])
+                v0.append(ln["value"] / n); c.append(ln["contrib_m"] / n)
+                apy.append(pf_apy if ln.get("apy") is None else ln["apy"])
+    env_rows = np.zeros((0, M))
+    dca = float(one("dca_mult")[0])
+    if env_keys:
+        g, a = _growth(np.array(apy), steps)
+        env_rows = np.array(v0)[:, None] * g + (np.array(c) * dca)[:, None] * a
+    # flux planifiés d'un portefeuille : écart entre sa série complète et la somme
+    # de ses lignes, affecté au bénéficiaire / aux enveloppes par défaut du portefeuille
+    extra_rows, k = [], 0
+    for st in state["portfolios"]:
+        rows = [e for ln in st.get("lines") or [] for e in ln["envelopes"]]
+        if st.get("events"):
+            x = _asset_flows([st], start, M, CASH_EVENT_KINDS)
+            if x.any():
+                _, per = _portfolio_block([st], start, M, {k: one(k) for k in RATE_KEYS}, steps, True)
+                delta = per[0, 0] - env_rows[k:k + len(rows)].sum(axis=0)
+                envs = st.get("envelopes") or ["CTO"]
+                for e in envs:
+                    env_keys.append(e); line_benes.append(st["bene_id"])
+                    extra_rows.append(delta / len(envs))
+        k += len(rows)
+    if extra_rows:
+        env_rows = np.vstack([env_rows] + extra_rows)
+    if env_keys:
+        bene_keys += line_benes
+        bene_rows.append(env_rows)
+
+    ims = state["immo"]
+    if ims:
+        fr = np.array([(im["ownership_pct"] or 100.0) / 100.0 for im in ims])
+        bene_keys += [im["bene_id"] for im in ims]
+        bene_rows.append(sim["immo_equity_by_asset"][0] * fr[:, None])
+
+    ots = state["others"]
+    if ots:
+        bene_keys += [st["bene_id"] for st in ots]
+        x = _asset_flows(ots, start, M, CASH_EVENT_KINDS)
+        bene_rows.append(np.maximum(np.array([st["value"] for st in ots])[:, None] + np.cumsum(x, axis=1), 0.0))
+
+    return {
+        "by_beneficiary": _group_sum(bene_keys, np.vstack(bene_rows) if bene_rows else np.zeros((0, M)), M),
+        "by_envelope": _group_sum(env_keys, env_rows, M),
+    }
+
+
+# ---------------------------------------------------------
+# Mise en forme
+# ---------------------------------------------------------
+RESOLUTIONS = {"monthly": 1, "quarterly": 3, "yearly": 12}
+ENCODINGS = ("json", "compact")
+
+def round_list(a) -> list:
+    return np.round(np.asarray(a, dtype=float), 2).tolist()
+
+def encode_f32(a) -> str:
+    """Tableau de floats -> base64 float32 little-endian (encodage compact)."""
+    return base64.b64encode(np.ascontiguousarray(a, dtype="<f4").tobytes()).decode("ascii")
+
+def period_bounds(times: list, resolution: str) -> tuple[np.ndarray, np.ndarray, list]:
+    """
+    Découpe les mois simulés en périodes calendaires (mois / trimestre / année).
+    Retourne (indice du 1er mois, indice du dernier mois, libellé) pour chaque
+    période ; la 1re et la dernière peuvent être partielles. Le libellé est le
+    1er mois projeté de la période (début calendaire sauf pour une 1re période
+    partielle : départ en 2026-10 en annuel -> 1er point daté 2026-10).
+    """
+    step = RESOLUTIONS[resolution]
+    if not times:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), []
+    pid = np.array([(t.year * 12 + t.month - 1) // step for t in times])
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(pid)) + 1))
+    ends = np.concatenate((starts[1:] - 1, [len(times) - 1]))
+    labels = [times[i] for i in starts]
+    return starts, ends, labels
+
+def resample_stock(a, starts, ends) -> np.ndarray:
+    """Grandeur de stock (patrimoine) : valeur en fin de période."""
+    return np.asarray(a)[..., ends]
+
+def resample_flow(a, starts, ends) -> np.ndarray:
+    """Grandeur de flux (cashflow) : somme sur la période."""
+    a = np.asarray(a)
+    if not len(starts):
+        return a[..., :0]
+    return np.add.reduceat(a, starts, axis=-1)
+
+def loan_milestones(state: dict, sim: dict | None = None) -> list[dict]:
+    """
+    Jalons fin de prêt (indépendants des taux simulés).
+    Avec `sim`, la fin d'un prêt raccourci par des remboursements anticipés
+    planifiés est avancée du nombre de mensualités économisées.
+    """
+    milestones = []
+    i = 0
+    for im in state["immo"]:
+        for ln in im["loans"]:
+            end_date = ln["end_date"]
+            if sim is not None and sim["loans_prepaid"][i].any():
+                paid_off = np.flatnonzero(sim["loans_remain"][i] <= 1e-8)
+                if len(paid_off):
+                    saved = max(ln["months_left"] - 1 - int(paid_off[0]), 0)
+                    end_date = add_months(end_date, -saved)
+            i += 1
+            if ln["months_left"] > 0:
+                milestones.append({
+                    "date": end_date.isoformat(),
+                    "kind": "loan_end",
+                    "label": f"Fin prêt · {im['label']}",
+                    "amount": ln["pay_no_ins"]
+                })
+    return milestones
+
+def projection_payload(state: dict, sim: dict, params: dict, snapshot_at=None, breakdown: bool = False) -> dict:
+    """
+    Réponse JSON de /api/projection pour une simulation à un seul point (G=1).
+    Si `sim` vient de simulate_incremental(), ajoute la répartition par actif
+    (valeur finale ; séries complètes si breakdown=True).
+
+    params["resolution"] (monthly | quarterly | yearly) agrège les séries par
+    période calendaire : patrimoine = fin de période, cashflows = somme.
+    params["encoding"] = compact remplace `times` par {start, period_start, step_months, count}
+    et chaque série par une chaîne base64 float32 little-endian.
+    """
+    times = sim["times"]
+    start = params["start"]
+    series = {k: sim[k][0] for k in ("total",) + STACK_KEYS + CASHFLOW_KEYS}
+
+    # ---------- snapshot donut (au mois demandé, défaut = dernier mois projeté) ----------
+    snap_idx = len(times) - 1
+    if snapshot_at and times:
+        snap_idx = min(max(months_between(start, snapshot_at), 0), len(times) - 1)
+    at = lambda arr: float(arr[snap_idx]) if len(times) else 0.0
+
+    # by type
+    donut_by_type = [
+        {"label": "Immobilier (equity)", "value": round(at(series["immo_equity"]), 2)},
+        {"label": "Portefeuilles",       "value": round(at(series["portfolios"]), 2)},
+        {"label": "Livrets",             "value": round(at(series["livrets"]), 2)},
+        {"label": "Autres",              "value": round(at(series["other"]), 2)},
+    ]
+
+    groups = group_series(state, sim, params["rates"])
+    donut_by_beneficiary = [
+        {"beneficiary_id": k, "value": round(at(v), 2)} for k, v in groups["by_beneficiary"].items()
+    ]
+    donut_by_envelope = [{"label": k, "value": round(at(v), 2)} for k, v in groups["by_envelope"].items()]
+
+    # ---------- résolution / encodage ----------
+    resolution = params.get("resolution") or "monthly"
+    compact = params.get("encoding") == "compact"
+    starts, ends, labels = period_bounds(times, resolution)
+    enc = encode_f32 if compact else round_list
+    stock = lambda a: enc(resample_stock(a, starts, ends))
+    flow = lambda a: enc(resample_flow(a, starts, ends))
+
+    if compact:
+        # point k >= 1 : period_start + k * step_months (seul le 1er peut être en milieu de période)
+        step = RESOLUTIONS[resolution]
+        first = labels[0] if labels else start
+        times_out = {"start": first.isoformat(),
+                     "period_start": add_months(datetime(first.year, 1, 1).date(), ((first.month - 1) // step) * step).isoformat(),
+                     "step_months": step, "count": len(labels)}
+    else:
+        times_out = [t.isoformat() for t in labels]
+
+    payload = {
+        "ok": True,
+        "params": {
+            "start": start.isoformat(),
+            "months": params["months"],
+            "scenario": params["scenario"],
+            "rates_used": {k: params["rates"][k] for k in RATE_KEYS},
+            "resolution": resolution,
+            "encoding": "compact" if compact else "json",
+            "returns": params.get("returns") or "scenario",
+        },
+        "times": times_out,
+        "net_worth": {
+            "total": stock(series["total"]),
+            "stack": {k: stock(series[k]) for k in STACK_KEYS},
+            "by_beneficiary": [{"beneficiary_id": k, "values": stock(v)} for k, v in groups["by_beneficiary"].items()],
+            "by_envelope": [{"label": k, "values": stock(v)} for k, v in groups["by_envelope"].items()],
+        },
+        "cashflow": {k: flow(series[k]) for k in CASHFLOW_KEYS},
+        "snapshot": {
+            "at": (times[snap_idx] if times else start).isoformat(),
+            "donut": {
+                "by_type": donut_by_type,
+                "by_beneficiary": donut_by_beneficiary,
+                "by_envelope": donut_by_envelope,
+            }
+        },
+        "milestones": loan_milestones(state, sim)
+    }
+    if compact:
+        payload["encoding"] = {"floats": "base64-float32-le"}
+
+    if "assets" in sim:
+        payload["by_asset"] = [{
+            "asset_id": a["asset_id"],
+            "type": a["type"],
+            "label": a["label"],
+            "value": round(float(a["values"][-1]), 2) if len(times) else 0.0,
+            **({"values": stock(a["values"])} if breakdown else {}),
+        } for a in sim["assets"]]
+    return payload
+
+
+# ---------------------------------------------------------
+# Goal-seek (résolution inverse sur le modèle)
+# ---------------------------------------------------------
+GOAL_TOLERANCE = 1.0            # €, écart admis entre patrimoine validé et cible
+GOAL_TOLERANCE_REL = 1e-6
+
+def _net_worth_at_end(state: dict, start, months: int, rates: dict) -> np.ndarray:
+    return simulate(state, start, months, rates)["total"][:, -1]
+
+def goal_seek_dca(state: dict, start, months: int, rates: dict, target: float) -> dict:
+    """
+    DCA mensuel (total portefeuilles) pour atteindre `target` à la fin du mois `months`-1.
+    Le patrimoine est linéaire en contributions : NW = NW(dca_mult=0) + dca_mult · pente.
+    La pente est mesurée sur le modèle (grille dca_mult = [0, 1] en une simulation),
+    donc juste aussi quand les lignes ont leur propre rendement (returns=products) ;
+    une seconde simulation valide la solution à GOAL_TOLERANCE près.
+    """
+    # DCA réparti comme les contributions actuelles, sinon dans un portefeuille fictif à 1 €/mois
+    pf_c = sum(st["contrib_m"] for st in state["portfolios"])
+    if pf_c > 0:
+        basis, unit = state, pf_c
+    else:
+        synthetic = {"asset_id": None, "label": "DCA", "value": 0.0, "bene_id": None, "contrib_m": 1.0, "envelopes": []}
+        basis, unit = {**state, "portfolios": state["portfolios"] + [synthetic]}, 1.0
+    nw0, nw1 = (float(x) for x in _net_worth_at_end(basis, start, months, {**rates, "dca_mult": np.array([0.0, 1.0])}))
+    slope = (nw1 - nw0) / unit                       # patrimoine final par € mensuel
+    dca = max((target - nw0) / slope, 0.0) if slope > 0 else 0.0
+
+    nw = float(_net_worth_at_end(basis, start, months, {**rates, "dca_mult": dca / unit})[0])
+    tol = max(GOAL_TOLERANCE, GOAL_TOLERANCE_REL * abs(target))
+
+    return {
+        "value": dca,
+        "dca_mult": (dca / pf_c) if pf_c > 0 else None,
+        "current_dca_monthly": pf_c * float(rates["dca_mult"]),
+        "already_reached": nw0 >= target,
+        "reached": nw >= target if nw0 >= target else abs(nw - target) <= tol,
+        "net_worth_at_date": nw,
+        "method": "linear_slope",
+        "evaluations": 2,
+    }
+
+def goal_seek_rate(state: dict, start, months: int, rates: dict, param: str, target: float,
+                   lo: float = -0.5, hi: float = 1.0, tol: float = 1e-6, max_iter: int = 60) -> dict:
+    """
+    Valeur de `param` (ex: portfolio_apy) pour atteindre `target` à l'horizon.
+    1) balayage vectorisé de [lo, hi] en une passe pour encadrer la racine,
+    2) bisection sur l'intervalle trouvé jusqu'à |hi - lo| < tol.
+    Suppose le patrimoine croissant en `param`.
+    """
+    xs = np.linspace(lo, hi, 16)
+    f = _net_worth_at_end(state, start, months, {**rates, param: xs}) - target
+    evaluations, points = 1, len(xs)
+
+    if f[0] >= 0 or f[-1] < 0:
+        best = 0 if f[0] >= 0 else len(xs) - 1
+        return {
+            "value": float(xs[best]),
+            "reached": bool(f[best] >= 0),
+            "already_reached": bool(f[0] >= 0),
+            "net_worth_at_date": float(f[best] + target),
+            "method": "bracket_bisection",
+            "evaluations": evaluations,
+            "points": points,
+        }
+
+    i = int(np.argmax(f >= 0))
+    a, b, fb = float(xs[i - 1]), float(xs[i]), float(f[i])
+    for _ in range(max_iter):
+        if b - a < tol:
+            break
+        mid = 0.5 * (a + b)
+        fm = float(_net_worth_at_end(state, start, months, {**rates, param: mid})[0]) - target
+        evaluations += 1; points += 1
+        if fm >= 0:
+            b, fb = mid, fm
+        else:
+            a = mid
+
+    return {
+        "value": b,
+        "reached": True,
+        "already_reached": False,
+        "net_worth_at_date": fb + target,
+        "method": "bracket_bisection",
+        "evaluations": evaluations,
+        "points": points,
+    }
@@ -0,0 +1,233 @@
+# projection_nightly.py
+"""
+Batch nuit : précalcule la projection par défaut (/api/projection sans paramètre,
+scénario base) de chaque utilisateur et la stocke gzippée dans projection_snapshots.
+
+- utilisateurs lus par paquets (--chunk-size), un paquet = une tâche du ProcessPoolExecutor
+- chaque worker ouvre sa propre session (NullPool : rien n'est partagé au fork)
+- un utilisateur dont l'empreinte de données (state_version) n'a pas bougé est sauté
+- écriture des snapshots par le processus parent (upsert par paquet)
+- au préalable, rafraîchit produits_stats (rendements estimés par produit,
+  utilisés par /api/projection?returns=products ; cf. product_returns.py)
+
+Usage : python projection_nightly.py [--date YYYY-MM-DD] [--chunk-size 200] [--workers N] [--force]
+                                    [--skip-product-stats] [--verbose]
+"""
+import os, sys, time, gzip, argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date, datetime
+from sqlalchemy import create_engine
+from sqlalchemy import text as sqltext
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import sessionmaker
+from models import User, ProjectionSnapshot
+from projection_engine import (
+    first_of_month, default_params, state_version, load_state, simulate_incremental, projection_payload,
+)
+from product_returns import refresh_product_stats
+import json
+
+DB_URL = os.environ["DATABASE_URL"]
+engine = create_engine(DB_URL, future=True, poolclass=NullPool)
+Session = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+JOB_NAME = "projection-snapshots"
+
+UPSERT_SQL = sqltext("""
+    INSERT INTO projection_snapshots (user_id, start, months, scenario, state_version, payload, duration_ms, computed_at)
+    VALUES (:user_id, :start, :months, :scenario, :state_version, :payload, :duration_ms, :computed_at)
+    ON CONFLICT (user_id) DO UPDATE SET
+        start = EXCLUDED.start,
+        months = EXCLUDED.months,
+        scenario = EXCLUDED.scenario,
+        state_version = EXCLUDED.state_version,
+        payload = EXCLUDED.payload,
+        duration_ms = EXCLUDED.duration_ms,
+        computed_at = EXCLUDED.computed_at
+""")
+
+
+def iter_user_chunks(chunk_size: int):
+    """Ids utilisateurs par paquets (pagination par clé, pas d'OFFSET)."""
+    last_id = 0
+    while True:
+        s = Session()
+        try:
+            ids = [uid for (uid,) in (s.query(User.id)
+                                       .filter(User.id > last_id)
+                                       .order_by(User.id)
+                                       .limit(chunk_size).all())]
+        finally:
+            s.close()
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+def snapshot_chunk(user_ids: list[int], start: date, force: bool = False) -> dict:
+    """Worker : calcule les snapshots d'un paquet d'utilisateurs (sans écrire en base)."""
+    params = default_params(start)
+    out = {"rows": [], "skipped": 0, "failed": []}
+    s = Session()
+    try:
+        existing = dict(s.query(ProjectionSnapshot.user_id, ProjectionSnapshot.state_version)
+                         .filter(ProjectionSnapshot.user_id.in_(user_ids),
+                                 ProjectionSnapshot.start == start,
+                                 ProjectionSnapshot.months == params["months"])
+                         .all())
+        for uid in user_ids:
+            t0 = time.perf_counter()
+            try:
+                state = load_state(s, uid, start)
+                version = state_version(state)
+                if not force and existing.get(uid) == version:
+                    out["skipped"] += 1
+                    continue
+                sim = simulate_incremental(state, start, params["months"], params["rates"])
+                payload = projection_payload(state, sim, params)
+                blob = gzip.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+                out["rows"].append({
+                    "user_id": uid, "start": start, "months": params["months"], "scenario": params["scenario"],
+                    "state_version": version, "payload": blob,
+                    "duration_ms": int((time.perf_counter() - t0) * 1000), "computed_at": datetime.utcnow(),
+                })
+            except Exception as e:
+                s.rollback()
+                out["failed"].append({"user_id": uid, "error": str(e)[:200]})
+    finally:
+        s.close()
+    return out
+
+def store_chunk(result: dict, stats: dict, verbose: bool = False):
+    """Parent : upsert des snapshots calculés par un worker."""
+    rows = result["rows"]
+    if rows:
+        s = Session()
+        try:
+            s.execute(UPSERT_SQL, rows)
+            s.commit()
+        except Exception:
+            s.rollback()
+            raise
+        finally:
+            s.close()
+    stats["inserted"] += len(rows)
+    stats["skipped"] += result["skipped"]
+    stats["failed"] += len(result["failed"])
+    stats["details"].extend(result["failed"])
+    if verbose:
+        print(f"chunk: {len(rows)} écrits, {result['skipped']} inchangés, {len(result['failed'])} en erreur")
+
+def run_snapshots(start: date, chunk_size: int = 200, workers: int | None = None,
+                  force: bool = False, verbose: bool = False):
+    stats = {"inserted": 0, "skipped": 0, "failed": 0, "details": []}
+    workers = workers or os.cpu_count() or 1
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for ids in iter_user_chunks(chunk_size):
+                pending.add(pool.submit(snapshot_chunk, ids, start, force))
+                # borne le nombre de paquets en vol (mémoire du parent)
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        store_chunk(fut.result(), stats, verbose)
+            for fut in pending:
+                store_chunk(fut.result(), stats, verbose)
+        return True, stats
+    except Exception as e:
+        return False, {"error": str(e), **stats}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--date", help="YYYY-MM-DD (par défaut: aujourd'hui UTC, comme /api/projection)")
+    parser.add_argument("--chunk-size", type=int, default=int(os.getenv("PROJECTION_SNAPSHOT_CHUNK", "200")))
+    parser.add_argument("--workers", type=int, default=None, help="processus (défaut: nb de CPU)")
+    parser.add_argument("--force", action="store_true", help="recalcule même si les données n'ont pas changé")
+    parser.add_argument("--skip-product-stats", action="store_true", help="ne recalcule pas produits_stats")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    today = datetime.utcnow().date() if not args.date else date.fromisoformat(args.date)
+    start = first_of_month(today)
+
+    # 1) job_runs: running
+    s = Session()
+    try:
+        run_id = s.execute(
+            sqltext("""
+                INSERT INTO job_runs (job_name, run_date, started_at, state)
+                VALUES (:name, :run_date, now(), 'running')
+                RETURNING id
+            """),
+            {"name": JOB_NAME, "run_date": today}
+        ).scalar_one()
+        s.commit()
+    except:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+    # 2) run : statistiques produits puis snapshots
+    t0 = time.perf_counter()
+    product_stats = None
+    if not args.skip_product_stats:
+        s = Session()
+        try:
+            product_stats = refresh_product_stats(s, as_of=today, verbose=args.verbose)
+        except Exception as e:
+            s.rollback()
+            product_stats = {"error": str(e)[:200]}
+        finally:
+            s.close()
+    ok, stats = run_snapshots(start, chunk_size=args.chunk_size, workers=args.workers,
+                              force=args.force, verbose=args.verbose)
+    elapsed = round(time.perf_counter() - t0, 1)
+
+    # 3) job_runs: finalize
+    s = Session()
+    try:
+        msg_obj = {"stats": {"inserted": stats.get("inserted", 0),
+                             "skipped": stats.get("skipped", 0),
+                             "failed": stats.get("failed", 0),
+                             "seconds": elapsed},
+                   "product_stats": product_stats,
+                   "details": stats.get("details", [])[:20]}
+        if "error" in stats:
+            msg_obj["error"] = stats["error"]
+        msg = json.dumps(msg_obj, ensure_ascii=False)[:1000]
+
+        s.execute(
+            sqltext("""
+                UPDATE job_runs
+                SET finished_at = now(),
+                    state        = :state,
+                    ok           = :ok,
+                    items_inserted = :ins,
+                    items_skipped  = :skp,
+                    items_failed   = :fld,
+                    message        = :msg
+                WHERE id = :id
+            """),
+            {
+                "state": "done" if ok else "error",
+                "ok": bool(ok),
+                "ins": int(stats.get("inserted", 0)),
+                "skp": int(stats.get("skipped", 0)),
+                "fld": int(stats.get("failed", 0)),
+                "msg": msg,
+                "id": run_id
+            }
+        )
+        s.commit()
+    except:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+    print(("OK" if ok else "ERROR"), {k: v for k, v in stats.items() if k != "details"}, f"{elapsed}s")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
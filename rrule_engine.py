@@ -0,0 +1,138 @@
+# rrule_engine.py
+"""
+Expansion des AssetEvent planifiés (status="planned") en flux mensuels denses.
+
+Sous-ensemble RFC 5545 couvert : FREQ=DAILY|WEEKLY|MONTHLY|YEARLY, INTERVAL,
+COUNT, UNTIL, BYMONTH, BYMONTHDAY (une valeur, -1 = dernier jour), BYDAY (WEEKLY).
+Comme dans scheduler_nightly, un jour absent du mois (31 en avril) retombe
+sur le dernier jour du mois au lieu d'être sauté.
+
+Les occurrences sont générées en datetime64 puis ventilées par mois avec
+np.bincount ; le résultat (occurrences par mois de l'horizon) est mis en
+cache par (événement, horizon) — le montant est appliqué après coup.
+"""
+import os
+from datetime import date
+
+import numpy as np
+
+from utils import LRUCache
+
+_WEEKDAYS = {"MO": 0, "TU": 1, "WE": 2, "TH": 3, "FR": 4, "SA": 5, "SU": 6}
+
+_expansion_cache = LRUCache(int(os.getenv("RRULE_CACHE_SIZE", "4096")))
+
+
+def parse_rrule(rrule: str | None) -> dict:
+    """'FREQ=MONTHLY;BYMONTHDAY=1' -> {'FREQ': 'MONTHLY', 'BYMONTHDAY': '1'}"""
+    if not rrule:
+        return {}
+    s = rrule.strip()
+    if s.upper().startswith("RRULE:"):
+        s = s[6:]
+    out = {}
+    for part in s.split(";"):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            out[k.strip().upper()] = v.strip().upper()
+    return out
+
+def _parse_until(v: str | None):
+    if not v:
+        return None
+    try:
+        return date(int(v[0:4]), int(v[4:6]), int(v[6:8]))
+    except Exception:
+        return None
+
+def _month_index(d) -> int:
+    return d.year * 12 + d.month - 1
+
+def _monthly_dates(months: np.ndarray, day: int) -> np.ndarray:
+    """Une date par mois (indices année*12+mois-1), jour borné à la longueur du mois."""
+    mstart = (months - 1970 * 12).astype("datetime64[M]")
+    d0 = mstart.astype("datetime64[D]")
+    mlen = ((mstart + 1).astype("datetime64[D]") - d0).astype(int)
+    if day < 0:
+        d = np.maximum(mlen + day + 1, 1)
+    else:
+        d = np.minimum(max(day, 1), mlen)
+    return d0 + (d - 1)
+
+def occurrences(value_date, rrule: str | None, until) -> np.ndarray:
+    """Toutes les occurrences (datetime64[D], triées) entre value_date et until inclus."""
+    dtstart = np.datetime64(value_date, "D")
+    stop = np.datetime64(until, "D")
+    rule = parse_rrule(rrule)
+    if not rule:
+        return np.array([dtstart] if dtstart <= stop else [], dtype="datetime64[D]")
+
+    freq = rule.get("FREQ", "MONTHLY")
+    interval = max(int(rule.get("INTERVAL", "1") or 1), 1)
+    rule_until = _parse_until(rule.get("UNTIL"))
+    if rule_until:
+        stop = min(stop, np.datetime64(rule_until, "D"))
+    if stop < dtstart:
+        return np.array([], dtype="datetime64[D]")
+    last = stop.astype(object)
+
+    if freq in ("MONTHLY", "YEARLY"):
+        bymonth = [int(m) for m in rule.get("BYMONTH", "").split(",") if m.strip()]
+        m0, m1 = _month_index(value_date), _month_index(last)
+        if freq == "YEARLY" and bymonth:
+            years = np.arange(value_date.year, last.year + 1, interval)
+            months = (years[:, None] * 12 + (np.array(bymonth) - 1)[None, :]).ravel()
+        else:
+            months = np.arange(m0, m1 + 1, interval * (12 if freq == "YEARLY" else 1))
+            if bymonth:
+                months = months[np.isin(months % 12 + 1, bymonth)]
+        bymonthday = rule.get("BYMONTHDAY", "").split(",")[0]
+        day = int(bymonthday) if bymonthday.lstrip("-").isdigit() else value_date.day
+        dates = _monthly_dates(np.sort(months), day)
+    elif freq == "WEEKLY":
+        offsets = sorted({_WEEKDAYS[d[-2:]] for d in rule.get("BYDAY", "").split(",") if d[-2:] in _WEEKDAYS}) \
+            or [value_date.weekday()]
+        monday = dtstart - value_date.weekday()
+        weeks = np.arange(monday, stop + 1, 7 * interval)
+        dates = np.sort((weeks[:, None] + np.array(offsets)[None, :]).ravel())
+    elif freq == "DAILY":
+        dates = np.arange(dtstart, stop + 1, interval)
+    else:
+        return np.array([dtstart], dtype="datetime64[D]")
+
+    dates = dates[(dates >= dtstart) & (dates <= stop)]
+    count = rule.get("COUNT")
+    if count and count.isdigit():
+        dates = dates[:int(count)]
+    return dates
+
+def monthly_occurrences(value_date, rrule: str | None, end_date, start, months: int) -> np.ndarray:
+    """
+    Nombre d'occurrences de l'événement pour chacun des `months` mois à partir
+    de `start` (tableau (M,) en lecture seule, mis en cache par événement × horizon).
+    """
+    key = (value_date, rrule or "", end_date, start, int(months))
+    cached = _expansion_cache.get(key)
+    if cached is not None:
+        return cached
+
+    M = max(int(months), 0)
+    horizon_end = (np.datetime64(start, "M") + M).astype("datetime64[D]") - 1
+    until = horizon_end if not end_date else min(horizon_end, np.datetime64(end_date, "D"))
+    dates = occurrences(value_date, rrule, until.astype(object))
+    idx = (dates.astype("datetime64[M]") - np.datetime64(start, "M")).astype(int)
+    idx = idx[(idx >= 0) & (idx < M)]
+    counts = np.bincount(idx, minlength=M).astype(float)[:M]
+    counts.flags.writeable = False
+    return _expansion_cache.put(key, counts)
+
+def event_flows(events: list, start, months: int, kinds=None) -> np.ndarray:
+    """Somme des montants (montant × occurrences) par mois pour les événements de `kinds`."""
+    out = np.zeros(max(int(months), 0))
+    for ev in events or []:
+        if kinds and ev["kind"] not in kinds:
+            continue
+        if not ev.get("amount"):
+            continue
+        out += ev["amount"] * monthly_occurrences(ev["value_date"], ev.get("rrule"), ev.get("end_date"), start, months)
+    return out
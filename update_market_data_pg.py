@@ -1,159 +1,389 @@
+"""
+Mise à jour de l'univers ETF (JustETF) dans produits_invest / produits_meta.
+
+Pipeline en masse, une seule transaction :
+1) téléchargement de l'overview JustETF
+2) typage vectorisé (pandas) des colonnes, une ligne par ISIN
+3) empreinte du contenu de chaque ligne (content_hash, stockée dans la ligne)
+   et diff avec la base : inserted / changed / unchanged / disappeared
+4) COPY des seules lignes nouvelles ou modifiées dans deux tables temporaires
+   (stg_invest, stg_meta)
+5) un INSERT ... SELECT ... ON CONFLICT par table cible, produits_meta joint
+   à produits_invest sur l'ISIN
+
+Les lignes inchangées ne sont pas réécrites (ni WAL, ni mise à jour d'index) ;
+les ETF disparus de JustETF sont seulement signalés (ils peuvent être détenus).
+Résumé du diff et durée de chaque phase enregistrés dans job_runs.
+
+Cache local de l'overview (étape la plus lente) : Parquet + date de
+téléchargement dans les métadonnées du fichier, réutilisé tant qu'il a moins de
+--max-age-hours ; en cas d'échec du téléchargement, un cache périmé est
+utilisé plutôt que rien. --offline FICHIER rejoue tout le pipeline depuis un
+fixture (Parquet ou CSV indexé par isin), sans réseau ni justetf_scraping.
+
+Usage : python update_market_data_pg.py [--max-age-hours 20] [--refresh] [--offline FICHIER]
+"""
 import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from sqlalchemy import create_engine, text
 from sqlalchemy.pool import NullPool
 from dotenv import load_dotenv
-from justetf_scraping import overview
+from utils import copy_dataframe
 
 # Charger les variables d'environnement
 load_dotenv()
 DB_URL = os.getenv("DATABASE_URL")
+JOB_NAME = "market-data-etf"
+CACHE_PATH = os.getenv("JUSTETF_CACHE_PATH", os.path.join(".cache", "justetf_overview.parquet"))
+CACHE_MAX_AGE_HOURS = float(os.getenv("JUSTETF_CACHE_MAX_AGE_HOURS", "20"))
+
+INVEST_COLUMNS = ["isin", "ticker_yahoo", "label", "currency", "type"]
+META_COLUMNS = [
+    "isin", "inception_date", "domicile", "replication", "ter", "size", "number_of_holdings",
+    "is_sustainable", "hedged", "securities_lending", "distribution_policy", "last_dividend_date",
+]
+BOOL_VALUES = {"true": True, "yes": True, "1": True, "false": False, "no": False, "0": False}
+
+# migration ponctuelle des bases antérieures à content_hash (models.py) : DDL seulement si absente
+HASH_COLUMNS_SQL = """
+    ALTER TABLE produits_invest ADD COLUMN IF NOT EXISTS content_hash varchar(16);
+    ALTER TABLE produits_meta ADD COLUMN IF NOT EXISTS content_hash varchar(16);
+"""
+
+MISSING_HASH_COLUMNS_SQL = text("""
+    SELECT count(*) FROM (VALUES ('produits_invest'), ('produits_meta')) t(name)
+    WHERE NOT EXISTS (SELECT 1 FROM information_schema.columns c
+                      WHERE c.table_name = t.name AND c.column_name = 'content_hash')
+""")
+
+EXISTING_SQL = text("""
+    SELECT p.isin, p.type, p.content_hash AS invest_hash, m.content_hash AS meta_hash
+    FROM produits_invest p
+    LEFT JOIN produits_meta m ON m.produit_id = p.id
+    WHERE p.isin IS NOT NULL
+""")
+
+STAGING_SQL = """
+    CREATE TEMP TABLE stg_invest (
+        isin text, ticker_yahoo text, label text, currency text, type text, content_hash text
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE stg_meta (
+        isin text, inception_date date, domicile text, replication text,
+        ter double precision, size double precision, number_of_holdings bigint,
+        is_sustainable boolean, hedged boolean, securities_lending boolean,
+        distribution_policy text, last_dividend_date date, content_hash text
+    ) ON COMMIT DROP;
+"""
+
+UPSERT_INVEST_SQL = text("""
+    INSERT INTO produits_invest (isin, ticker_yahoo, label, currency, type, content_hash)
+    SELECT isin, ticker_yahoo, label, currency, type, content_hash FROM stg_invest
+    ON CONFLICT (isin) DO UPDATE SET
+        ticker_yahoo = EXCLUDED.ticker_yahoo,
+        label = EXCLUDED.label,
+        currency = EXCLUDED.currency,
+        type = EXCLUDED.type,
+        content_hash = EXCLUDED.content_hash
+    WHERE produits_invest.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+""")
+
+UPSERT_META_SQL = text("""
+    INSERT INTO produits_meta (
+        produit_id, inception_date, domicile, replication,
+        ter, size, number_of_holdings, is_sustainable,
+        hedged, securities_lending, distribution_policy, last_dividend_date, content_hash
+    )
+    SELECT p.id, m.inception_date, m.domicile, m.replication,
+           m.ter, m.size, m.number_of_holdings, m.is_sustainable,
+           m.hedged, m.securities_lending, m.distribution_policy, m.last_dividend_date, m.content_hash
+    FROM stg_meta m
+    JOIN produits_invest p ON p.isin = m.isin
+    ON CONFLICT (produit_id) DO UPDATE SET
+        inception_date = EXCLUDED.inception_date,
+        domicile = EXCLUDED.domicile,
+        replication = EXCLUDED.replication,
+        ter = EXCLUDED.ter,
+        size = EXCLUDED.size,
+        number_of_holdings = EXCLUDED.number_of_holdings,
+        is_sustainable = EXCLUDED.is_sustainable,
+        hedged = EXCLUDED.hedged,
+        securities_lending = EXCLUDED.securities_lending,
+        distribution_policy = EXCLUDED.distribution_policy,
+        last_dividend_date = EXCLUDED.last_dividend_date,
+        content_hash = EXCLUDED.content_hash
+    WHERE produits_meta.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+""")
 
 
-def to_python(val, expected_type=None):
+def _text(s: pd.Series) -> pd.Series:
+    """Texte nettoyé, chaîne vide -> NULL."""
+    s = s.astype("string").str.strip()
+    return s.mask(s == "")
+
+def _number(s: pd.Series, integer: bool = False) -> pd.Series:
+    s = pd.to_numeric(s, errors="coerce")
+    return s.round().astype("Int64") if integer else s.astype("Float64")
+
+def _bool(s: pd.Series) -> pd.Series:
+    return s.astype("string").str.strip().str.lower().map(BOOL_VALUES).astype("boolean")
+
+def _date(s: pd.Series) -> pd.Series:
+    """Dates (Timestamp ou texte) ; les nombres (ex. montant du dernier dividende) -> NULL."""
+    if not pd.api.types.is_datetime64_any_dtype(s):
+        s = s.where(s.map(lambda v: isinstance(v, (str, pd.Timestamp)))).astype("string")
+        s = s.mask(pd.to_numeric(s, errors="coerce").notna())
+    d = pd.to_datetime(s, errors="coerce")
+    return d.dt.strftime("%Y-%m-%d").astype("string")
+
+def build_frames(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Convertit proprement les types NumPy/pandas en types Python natifs compatibles PostgreSQL.
-    expected_type: peut forcer un type cible (ex: "date")
+    Overview JustETF -> (produits_invest, produits_meta) typés, une ligne par ISIN
+    (première occurrence conservée), sans boucle par ligne.
     """
-    if pd.isna(val):
-        return None
-
-    if expected_type == "date":
-        # Si c’est une date pandas
-        if isinstance(val, (pd.Timestamp, )):
-            return val.date()
-        # Si c’est un string de date
-        if isinstance(val, str):
-            try:
-                return pd.to_datetime(val).date()
-            except Exception:
-                return None
-        # Si c’est un nombre → on ignore
-        return None
-
-    if isinstance(val, (pd.Timestamp, pd.NaT.__class__)):
-        return val.to_pydatetime()
-    if hasattr(val, "item"):  # numpy scalars
-        return val.item()
-    return val
+    raw = df.reset_index()
+    raw["isin"] = _text(raw["isin"]).str.upper()
+    raw = raw[raw["isin"].notna()].drop_duplicates("isin", keep="first")
 
+    df_invest = pd.DataFrame({
+        "isin": raw["isin"],
+        "ticker_yahoo": _text(raw["ticker"]),
+        "label": _text(raw["name"]),
+        "currency": _text(raw["currency"]),
+        "type": "etf",
+    })[INVEST_COLUMNS]
 
+    df_meta = pd.DataFrame({
+        "isin": raw["isin"],
+        "inception_date": _date(raw["inception_date"]),
+        "domicile": _text(raw["domicile_country"]),
+        "replication": _text(raw["replication"]),
+        "ter": _number(raw["ter"]),
+        "size": _number(raw["size"]),
+        "number_of_holdings": _number(raw["number_of_holdings"], integer=True),
+        "is_sustainable": _bool(raw["is_sustainable"]),
+        "hedged": _bool(raw["hedged"]),
+        "securities_lending": _bool(raw["securities_lending"]),
+        "distribution_policy": _text(raw["dividends"]),
+        "last_dividend_date": _date(raw["last_dividends"]),
+    })[META_COLUMNS]
+    return df_invest.reset_index(drop=True), df_meta.reset_index(drop=True)
 
-def main():
-    print("[*] Récupération des ETFs depuis JustETF...")
-    df = overview.load_overview()
-    print(f"✅ {len(df)} ETFs récupérés")
-
-    # ---- produits_invest ----
-    df_invest = df.reset_index()[["isin", "ticker", "name", "currency"]].rename(
-        columns={
-            "ticker": "ticker_yahoo",
-            "name": "label",
-        }
-    )
-    df_invest["type"] = "etf"
-    df_invest = df_invest.where(pd.notnull(df_invest), None)
-
-    print("[*] Exemple produits_invest :")
-    print(df_invest.head(), "\n")
-
-    # ---- produits_meta ----
-    df_meta = df.reset_index()[[
-        "isin",
-        "inception_date",
-        "domicile_country",
-        "replication",
-        "ter",
-        "size",
-        "number_of_holdings",
-        "is_sustainable",
-        "hedged",
-        "securities_lending",
-        "dividends",  # sera mappé sur distribution_policy
-        "last_dividends"  # sera mappé sur last_dividend_date
-    ]].rename(
-        columns={
-            "domicile_country": "domicile",
-            "dividends": "distribution_policy",
-            "last_dividends": "last_dividend_date",
-        }
-    )
-    df_meta = df_meta.where(pd.notnull(df_meta), None)
+def read_cache(path: str):
+    """(overview, fetched_at) depuis le cache Parquet, (None, None) s'il est absent ou illisible."""
+    if not os.path.exists(path):
+        return None, None
+    try:
+        table = pq.read_table(path)
+        fetched_at = datetime.fromisoformat((table.schema.metadata or {})[b"fetched_at"].decode())
+        return table.to_pandas(), fetched_at
+    except Exception as e:
+        print(f"⚠️ cache illisible ({path}) : {e}")
+        return None, None
+
+def write_cache(df: pd.DataFrame, path: str, fetched_at: datetime):
+    """Écrit l'overview en Parquet ; colonnes objet hétérogènes stockées en texte."""
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        if df[col].dropna().map(type).nunique() > 1:
+            df[col] = df[col].astype("string")
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           b"fetched_at": fetched_at.isoformat().encode()})
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    pq.write_table(table, tmp)
+    os.replace(tmp, path)
+
+def read_fixture(path: str) -> pd.DataFrame:
+    if path.endswith(".csv"):
+        return pd.read_csv(path, index_col="isin")
+    return pd.read_parquet(path)
+
+def load_overview_cached(path: str = CACHE_PATH, max_age_hours: float = CACHE_MAX_AGE_HOURS,
+                         refresh: bool = False, offline: str | None = None) -> tuple[pd.DataFrame, dict]:
+    """
+    Overview JustETF : fixture (offline), cache s'il a moins de `max_age_hours`,
+    sinon téléchargement (et mise à jour du cache). Retourne (df, {source, fetched_at}).
+    """
+    if offline:
+        return read_fixture(offline), {"source": "fixture", "path": offline}
 
-    print("[*] Exemple produits_meta :")
-    print(df_meta.head(), "\n")
+    cached, fetched_at = (None, None) if refresh else read_cache(path)
+    age_h = (datetime.utcnow() - fetched_at).total_seconds() / 3600 if fetched_at else None
+    if cached is not None and age_h < max_age_hours:
+        return cached, {"source": "cache", "fetched_at": fetched_at.isoformat(), "age_hours": round(age_h, 1)}
+
+    try:
+        from justetf_scraping import overview
+        df = overview.load_overview()
+    except Exception as e:
+        if cached is None:
+            raise
+        print(f"⚠️ téléchargement JustETF en échec ({e}), cache de {age_h:.1f} h utilisé")
+        return cached, {"source": "stale_cache", "fetched_at": fetched_at.isoformat(), "age_hours": round(age_h, 1)}
+    fetched_at = datetime.utcnow()
+    try:
+        write_cache(df, path, fetched_at)
+    except Exception as e:
+        print(f"⚠️ écriture du cache impossible ({path}) : {e}")
+    return df, {"source": "download", "fetched_at": fetched_at.isoformat()}
+
+def content_hash(df: pd.DataFrame) -> pd.Series:
+    """Empreinte 64 bits (hex) de chaque ligne, calculée en une passe (colonnes déjà typées)."""
+    return pd.util.hash_pandas_object(df, index=False).map("{:016x}".format).astype("string")
+
+def diff_frames(df_invest: pd.DataFrame, df_meta: pd.DataFrame, existing: pd.DataFrame) -> dict:
+    """
+    Compare les lignes JustETF (avec content_hash) à la base.
+    existing : isin, type, invest_hash, meta_hash. Retourne les ISIN
+    inserted / changed / unchanged / disappeared et les lignes à écrire par table.
+    """
+    new = df_invest[["isin", "content_hash"]].merge(
+        df_meta[["isin", "content_hash"]], on="isin", suffixes=("_invest", "_meta"))
+    m = new.merge(existing, on="isin", how="outer", indicator=True)
+    both = m["_merge"] == "both"
+    invest_diff = (m["content_hash_invest"] != m["invest_hash"]).fillna(True).astype(bool)
+    meta_diff = (m["content_hash_meta"] != m["meta_hash"]).fillna(True).astype(bool)
+    changed = both & (invest_diff | meta_diff)
+
+    inserted = m.loc[m["_merge"] == "left_only", "isin"]
+    write_invest = set(inserted) | set(m.loc[both & invest_diff, "isin"])
+    write_meta = set(inserted) | set(m.loc[both & meta_diff, "isin"])
+    return {
+        "inserted": inserted.tolist(),
+        "changed": m.loc[changed, "isin"].tolist(),
+        "unchanged": m.loc[both & ~changed, "isin"].tolist(),
+        # seuls les ETF (les actions / fonds saisis à la main ne viennent pas de JustETF)
+        "disappeared": m.loc[(m["_merge"] == "right_only") & (m["type"] == "etf"), "isin"].tolist(),
+        "invest": df_invest[df_invest["isin"].isin(write_invest)],
+        "meta": df_meta[df_meta["isin"].isin(write_meta)],
+    }
+
+def upsert(engine, df_invest: pd.DataFrame, df_meta: pd.DataFrame, timings: dict) -> dict:
+    """Diff avec la base, COPY des lignes modifiées puis deux upserts ensemblistes, une transaction."""
+    df_invest = df_invest.assign(content_hash=content_hash(df_invest))
+    df_meta = df_meta.assign(content_hash=content_hash(df_meta))
+    with engine.begin() as conn:
+        t = time.perf_counter()
+        if conn.execute(MISSING_HASH_COLUMNS_SQL).scalar():
+            conn.exec_driver_sql(HASH_COLUMNS_SQL)
+        existing = pd.DataFrame(conn.execute(EXISTING_SQL).all(),
+                                columns=["isin", "type", "invest_hash", "meta_hash"]).astype("string")
+        diff = diff_frames(df_invest, df_meta, existing)
+        timings["diff"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        conn.exec_driver_sql(STAGING_SQL)
+        copy_dataframe(conn, "stg_invest", diff["invest"])
+        copy_dataframe(conn, "stg_meta", diff["meta"])
+        timings["copy"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        n_invest = conn.execute(UPSERT_INVEST_SQL).rowcount if len(diff["invest"]) else 0
+        timings["upsert_invest"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        n_meta = conn.execute(UPSERT_META_SQL).rowcount if len(diff["meta"]) else 0
+        timings["upsert_meta"] = time.perf_counter() - t
+    return {
+        "inserted": len(diff["inserted"]),
+        "changed": len(diff["changed"]),
+        "unchanged": len(diff["unchanged"]),
+        "disappeared": len(diff["disappeared"]),
+        "rows_written": {"produits_invest": n_invest, "produits_meta": n_meta},
+        "disappeared_isins": diff["disappeared"][:20],
+    }
+
+def _job_start(engine) -> int:
+    with engine.begin() as conn:
+        return conn.execute(
+            text("""
+                INSERT INTO job_runs (job_name, run_date, started_at, state)
+                VALUES (:name, :run_date, now(), 'running')
+                RETURNING id
+            """),
+            {"name": JOB_NAME, "run_date": datetime.utcnow().date()}
+        ).scalar_one()
+
+def _job_finish(engine, run_id: int, ok: bool, summary: dict):
+    msg = json.dumps(summary, ensure_ascii=False, default=str)[:1000]
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE job_runs
+                SET finished_at = now(),
+                    state        = :state,
+                    ok           = :ok,
+                    items_inserted = :ins,
+                    items_skipped  = :skp,
+                    items_failed   = :fld,
+                    message        = :msg
+                WHERE id = :id
+            """),
+            {
+                "state": "done" if ok else "error",
+                "ok": bool(ok),
+                "ins": int(summary.get("inserted", 0)) + int(summary.get("changed", 0)),
+                "skp": int(summary.get("unchanged", 0)),
+                "fld": 0 if ok else 1,
+                "msg": msg,
+                "id": run_id,
+            }
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-age-hours", type=float, default=CACHE_MAX_AGE_HOURS,
+                        help="âge maximal du cache de l'overview avant re-téléchargement")
+    parser.add_argument("--refresh", action="store_true", help="ignore le cache et re-télécharge")
+    parser.add_argument("--offline", metavar="FICHIER", help="overview lue depuis un fixture Parquet / CSV")
+    parser.add_argument("--cache-path", default=CACHE_PATH)
+    args = parser.parse_args()
 
     # Connexion SQLAlchemy
     engine = create_engine(DB_URL, poolclass=NullPool)
+    run_id = _job_start(engine)
 
-    with engine.begin() as conn:
-        for _, row in df_invest.iterrows():
-            # 1) Insert/Update produits_invest
-            result = conn.execute(
-                text("""
-                    INSERT INTO produits_invest (isin, ticker_yahoo, label, currency, type)
-                    VALUES (:isin, :ticker_yahoo, :label, :currency, :type)
-                    ON CONFLICT (isin) DO UPDATE SET
-                        ticker_yahoo = EXCLUDED.ticker_yahoo,
-                        label = EXCLUDED.label,
-                        currency = EXCLUDED.currency,
-                        type = EXCLUDED.type
-                    RETURNING id;
-                """),
-                {
-                    "isin": to_python(row["isin"]),
-                    "ticker_yahoo": to_python(row["ticker_yahoo"]),
-                    "label": to_python(row["label"]),
-                    "currency": to_python(row["currency"]),
-                    "type": to_python(row["type"]),
-                }
-            )
-            produit_id = result.scalar()
-
-            # 2) Récupérer la ligne meta correspondante
-            meta_row = df_meta[df_meta["isin"] == row["isin"]]
-            if not meta_row.empty:
-                meta_row = meta_row.iloc[0]
-
-                conn.execute(
-                    text("""
-                        INSERT INTO produits_meta (
-                            produit_id, inception_date, domicile, replication,
-                            ter, size, number_of_holdings, is_sustainable,
-                            hedged, securities_lending, distribution_policy, last_dividend_date
-                        ) VALUES (
-                            :produit_id, :inception_date, :domicile, :replication,
-                            :ter, :size, :number_of_holdings, :is_sustainable,
-                            :hedged, :securities_lending, :distribution_policy, :last_dividend_date
-                        )
-                        ON CONFLICT (produit_id) DO UPDATE SET
-                            inception_date = EXCLUDED.inception_date,
-                            domicile = EXCLUDED.domicile,
-                            replication = EXCLUDED.replication,
-                            ter = EXCLUDED.ter,
-                            size = EXCLUDED.size,
-                            number_of_holdings = EXCLUDED.number_of_holdings,
-                            is_sustainable = EXCLUDED.is_sustainable,
-                            hedged = EXCLUDED.hedged,
-                            securities_lending = EXCLUDED.securities_lending,
-                            distribution_policy = EXCLUDED.distribution_policy,
-                            last_dividend_date = EXCLUDED.last_dividend_date;
-                    """),
-                    {
-                        "produit_id": produit_id,
-                        "inception_date": to_python(meta_row["inception_date"]),
-                        "domicile": to_python(meta_row["domicile"]),
-                        "replication": to_python(meta_row["replication"]),
-                        "ter": to_python(meta_row["ter"]),
-                        "size": to_python(meta_row["size"]),
-                        "number_of_holdings": to_python(meta_row["number_of_holdings"]),
-                        "is_sustainable": to_python(meta_row["is_sustainable"]),
-                        "hedged": to_python(meta_row["hedged"]),
-                        "securities_lending": to_python(meta_row["securities_lending"]),
-                        "distribution_policy": to_python(meta_row["distribution_policy"]),
-                        "last_dividend_date": to_python(meta_row["last_dividend_date"], expected_type="date"),
-                    }
-                )
+    timings, summary, ok = {}, {}, True
+    try:
+        print("[*] Récupération des ETFs depuis JustETF...")
+        t = time.perf_counter()
+        df, origin = load_overview_cached(args.cache_path, args.max_age_hours,
+                                          refresh=args.refresh, offline=args.offline)
+        timings["download"] = time.perf_counter() - t
+        summary["overview"] = origin
+        print(f"✅ {len(df)} ETFs récupérés ({origin['source']})")
+
+        t = time.perf_counter()
+        df_invest, df_meta = build_frames(df)
+        timings["coerce"] = time.perf_counter() - t
+
+        print("[*] Exemple produits_invest :")
+        print(df_invest.head(), "\n")
+        print("[*] Exemple produits_meta :")
+        print(df_meta.head(), "\n")
+
+        summary.update(upsert(engine, df_invest, df_meta, timings))
+        print(f"✅ {summary['inserted']} nouveaux, {summary['changed']} modifiés, "
+              f"{summary['unchanged']} inchangés, {summary['disappeared']} disparus")
+    except Exception as e:
+        ok = False
+        summary["error"] = str(e)[:300]
+        print("❌", e)
+    finally:
+        summary["seconds"] = {k: round(v, 2) for k, v in timings.items()}
+        _job_finish(engine, run_id, ok, summary)
+
+    print("[*] Durées : " + ", ".join(f"{k} {v:.2f}s" for k, v in timings.items()))
+    sys.exit(0 if ok else 1)
 
 
 if __name__ == "__main__":
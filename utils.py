@@ -1,4 +1,12 @@
 # utils.py
+import io
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
 def amortization_monthly_payment(principal: float, annual_rate_percent: float, months: int) -> float:
     if months <= 0:
         return 0.0
@@ -8,24 +16,123 @@ def amortization_monthly_payment(principal: float, annual_rate_percent: float, m
     payment = principal * (r / (1 - (1 + r) ** (-months)))
     return round(payment, 2)
 
+def amortization_batch(principals, annual_rates_percent, months, offsets=None, horizon=None, payments=None) -> dict:
+    """
+    Amortit L prêts d'un coup, sans boucle sur les mois (forme close).
+    - principals, annual_rates_percent, months : tableaux (L,)
+    - offsets  : mois de la 1re échéance sur l'axe commun (défaut 0 ; négatif = prêt déjà en cours)
+    - horizon  : nb de colonnes (défaut : dernière échéance de tous les prêts)
+    - payments : mensualités imposées (NaN / absent = annuité constante)
+    Retourne {"payment", "interest", "principal", "balance"} en tableaux (L, horizon).
+    balance = capital restant dû après l'échéance du mois (0 avant le début du prêt).
+    """
+    P = np.atleast_1d(np.asarray(principals, dtype=float))
+    r = np.atleast_1d(np.asarray(annual_rates_percent, dtype=float)) / 100.0 / 12.0
+    n = np.atleast_1d(np.asarray(months, dtype=float))
+    off = np.zeros_like(P) if offsets is None else np.atleast_1d(np.asarray(offsets, dtype=float))
+    H = int(horizon if horizon is not None else max(int((off + n).max()) if len(P) else 0, 0))
+
+    zero_rate = np.abs(r) < 1e-12
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        annuity = np.where(zero_rate, P / np.maximum(n, 1), P * r / (1.0 - np.power(1.0 + r, -np.maximum(n, 1))))
+    pay = annuity if payments is None else np.where(np.isnan(np.asarray(payments, dtype=float)), annuity, payments)
+
+    # k = nombre d'échéances payées à la fin de chaque colonne (colonne -1 incluse pour le solde d'ouverture)
+    k = np.arange(-1, H, dtype=float)[None, :] - off[:, None] + 1.0
+    kk = np.clip(k, 0.0, n[:, None])
+    g = np.power(1.0 + r[:, None], kk)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bal = np.where(zero_rate[:, None], P[:, None] - pay[:, None] * kk,
+                       P[:, None] * g - pay[:, None] * (g - 1.0) / r[:, None])
+    # mensualité < intérêts : le capital ne baisse pas (mais n'augmente pas non plus)
+    bal = np.maximum(np.minimum.accumulate(bal, axis=1), 0.0)
+
+    before, after, k = bal[:, :-1], bal[:, 1:], k[:, 1:]
+    active = (k >= 1) & (k <= n[:, None]) & (before > 1e-8)
+    interest = np.where(active, before * r[:, None], 0.0)
+    principal = np.where(active, before - after, 0.0)
+    return {
+        "payment": interest + principal,
+        "interest": interest,
+        "principal": principal,
+        "balance": np.where(k >= 1, after, 0.0),
+    }
+
 def amortization_schedule(principal: float, annual_rate_percent: float, months: int):
-    r = annual_rate_percent / 100.0 / 12.0
+    """Tableau d'amortissement d'un prêt en liste de dicts (enveloppe de amortization_batch)."""
     if months <= 0:
         return []
+    r = annual_rate_percent / 100.0 / 12.0
+    monthly = principal / months if r == 0 else amortization_monthly_payment(principal, annual_rate_percent, months)
+    res = amortization_batch([principal], [annual_rate_percent], [months], payments=[monthly])
+    interest, remaining = res["interest"][0].tolist(), res["balance"][0].tolist()
     if r == 0:
-        monthly = principal / months
-        schedule = []
-        rem = principal
-        for m in range(1, months+1):
-            rem -= monthly
-            schedule.append({'month': m, 'payment': monthly, 'interest': 0.0, 'principal_paid': monthly, 'remaining': max(rem,0)})
-        return schedule
-    monthly = amortization_monthly_payment(principal, annual_rate_percent, months)
-    schedule = []
-    rem = principal
-    for m in range(1, months+1):
-        interest = rem * r
-        principal_paid = monthly - interest
-        rem -= principal_paid
-        schedule.append({'month': m, 'payment': round(monthly,2), 'interest': round(interest,2), 'principal_paid': round(principal_paid,2), 'remaining': round(max(rem,0),2)})
-    return schedule
+        return [{'month': m, 'payment': monthly, 'interest': 0.0, 'principal_paid': monthly, 'remaining': rem}
+                for m, rem in enumerate(remaining, start=1)]
+    return [{'month': m, 'payment': round(monthly,2), 'interest': round(i,2), 'principal_paid': round(monthly - i,2), 'remaining': round(rem,2)}
+            for m, (i, rem) in enumerate(zip(interest, remaining), start=1)]
+
+
+class LRUCache:
+    """Petit cache LRU thread-safe, local au processus (un par worker gunicorn)."""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = max(int(maxsize), 1)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RateLimiter:
+    """Limite thread-safe à `rate` appels par seconde (espacement régulier entre appels)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def copy_dataframe(conn, table: str, df) -> int:
+    """COPY d'un DataFrame (CSV en mémoire) dans `table`, dans la transaction de `conn` (psycopg2)."""
+    if not len(df):
+        return 0
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False, na_rep="")
+    buf.seek(0)
+    cur = conn.connection.cursor()
+    try:
+        cur.copy_expert(f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+    finally:
+        cur.close()
+    return len(df)